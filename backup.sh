@@ -8,9 +8,10 @@ fi
 out=$(dirname ${bids_dir})/bids_backup.tar.gz
 echo "Creating ${out} ..."
 
-tar --exclude='${bids_dir}/derivatives/dual_regression_rs' \
-    --exclude='${bids_dir}/derivatives/tsnr' \
-    --exclude='${bids_dir}/derivatives/task_fmri' \
-    --exclude='${bids_dir}/derivatives/physio_fmri' \
+tar --exclude="${bids_dir}/derivatives/dual_regression_rs" \
+    --exclude="${bids_dir}/derivatives/tsnr" \
+    --exclude="${bids_dir}/derivatives/task_fmri" \
+    --exclude="${bids_dir}/derivatives/physio_fmri" \
+    --exclude="${bids_dir}/derivatives/.masked_cache" \
     --use-compress-program=pigz \
     -cf ${out} ${bids_dir}
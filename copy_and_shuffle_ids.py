@@ -1,3 +1,4 @@
+import re
 import sys
 import yaml
 import random
@@ -5,11 +6,20 @@ import logging
 import shutil
 import os
 import json
+import mmap
+import gzip
+import struct
+import hashlib
+import sqlite3
 import pandas as pd
 import os.path as op
 from glob import glob
 from tqdm import tqdm
-from joblib import delayed, Parallel
+from joblib import delayed, Parallel, effective_n_jobs
+
+sys.path.insert(0, op.join(op.dirname(op.abspath(__file__)), 'misc_qc'))
+from bids_index import load_index, index_glob
+from id_substitution import CHUNK_SIZE, TRANSFER_MODES, get_substitutor, stream_file
 
 
 logging.basicConfig(
@@ -31,53 +41,43 @@ EXCLUDE_FROM_CHECK = [
     'white'
 ]
 
-
-def _fix_permissions(root_dir):
-    """ Sets default permissions for dirs (0755)
-    and files (0644). """
-    for root, _, files in os.walk(root_dir):
-        os.chmod(root, 0o755)
+# All contexts in which subject IDs may appear (see _id_replacements in
+# id_substitution.py); the label is captured, so a single pass finds all
+# (old and new) IDs at once
+ID_PATTERN = re.compile(
+    rb'(?:"subject_id": "|Subject ID: |participant-label |subject_|sub-)([0-9A-Za-z]{1,64})'
+)
+MAX_ID_LENGTH = 80  # upper bound of the length of a match of ID_PATTERN
+
+
+def _stream_tree(src, dst, mapping, old_id=None, transfer='copy'):
+    """ Copies directory src to dst in a single walk. Directory and file
+    names are renamed, contents are anonymized while streaming, and
+    permissions (0755 for dirs, 0644 for files) are set at creation. In
+    trees that do not belong to a subject (e.g., fmriprep's logs), the
+    subject of each file is derived from its name (like sub-0001_*). """
+    for root, _, files in os.walk(src, followlinks=True):
+        rel = op.relpath(root, src)
+        if old_id is not None:
+            rel = rel.replace(old_id, mapping[old_id])
+
+        root_out = op.normpath(op.join(dst, rel))
+        os.makedirs(root_out)
+        os.chmod(root_out, 0o755)
         for f in files:
-            os.chmod(op.join(root, f), 0o644)
-
-
-def _check_contents_for_id(f):
-
-    with open(f, 'r') as f_in:
-        data = f_in.read()
-
-    if 'sub-' in data:
-        raise ValueError(f"File {f} contains the word 'sub-'.")
-
+            f_out, this_id = f, old_id
+            if 'sub-' in f:
+                file_id = f.split('_')[0].split('.')[0]
+                f_out = f.replace(file_id, mapping[file_id])
+                if this_id is None:
+                    this_id = file_id
 
-def _check_contents_for_id_and_replace(f, old_id, new_id):
-    
-    try:
-        with open(f, 'r') as f_in:
-            data = f_in.read()
-    except UnicodeDecodeError:
-        return 
-
-    data = data.replace(old_id, new_id)
-    data = data.replace(  # for fmriprep work-dir paths
-        'subject_' + old_id.split('-')[1],
-        'subject_' + new_id.split('-')[1],    
-    )
-    data = data.replace(  # for fmriprep HTML reports
-        'Subject ID: ' + old_id.split('-')[1],
-        'Subject ID: ' + new_id.split('-')[1],    
-    )
-    data = data.replace(  # for fmriprep HTML reports
-        'participant-label ' + old_id.split('-')[1],
-        'participant-label ' + new_id.split('-')[1],    
-    )
-    data = data.replace(  # for MRIQC jsons
-        f"\"subject_id\": \"{old_id.split('-')[1]}\"",
-        f"\"subject_id\": \"{new_id.split('-')[1]}\""
-    )
+            ext = f.split('.')[-1]
+            substitutor = None
+            if this_id is not None and ext not in EXCLUDE_FROM_CHECK:
+                substitutor = get_substitutor(this_id, mapping[this_id])
+            stream_file(op.join(root, f), op.join(root_out, f_out), substitutor, transfer)
 
-    with open(f, 'w') as f_out:
-        f_out.write(data)
 
 def _shuffle_tsv_contents(tsv, mapping):
     log.info(f"Shuffling contents of {tsv}")
@@ -93,71 +93,160 @@ def _shuffle_tsv_contents(tsv, mapping):
     df.to_csv(tsv, sep='\t', index=False)
 
 
-def _copy_file_and_check(to_copy, bids_dir, out_dir, mapping, old_id=None):
-    src = op.join(bids_dir, to_copy)
-    if 'sub-' in op.basename(src):
-        old_id = op.basename(src).split('_')[0].split('.')[0]
+def _fingerprint(src):
+    """ Returns the total size, latest mtime and a hash of the (relative) paths,
+    sizes and mtimes of all files in src, which may be a file or a directory.
+    Only metadata is used, so this does not read any file contents. """
+    h = hashlib.sha1()
+    if op.isfile(src):
+        stats = [('', os.stat(src))]
+    else:
+        stats = []
+        for root, dirs, files in os.walk(src, followlinks=True):
+            dirs.sort()
+            for f in sorted(files):
+                f = op.join(root, f)
+                stats.append((op.relpath(f, src), os.stat(f)))
+
+    size, mtime = 0, 0
+    for rel, st in stats:
+        h.update(f'{rel}:{st.st_size}:{st.st_mtime_ns}\n'.encode())
+        size += st.st_size
+        mtime = max(mtime, st.st_mtime_ns)
+
+    return size, mtime, h.hexdigest()
+
+
+def _journal_connect(journal):
+    """ Opens (and if necessary creates) the SQLite journal of finished units. """
+    conn = sqlite3.connect(journal, timeout=600)
+    with conn:
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS units "
+            "(unit TEXT PRIMARY KEY, dst TEXT, size INTEGER, mtime INTEGER, hash TEXT, finished TEXT)"
+        )
+        conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+    return conn
+
+
+def _journal_check_mapping(journal, mapping, clean=False):
+    """ Makes sure the journal was written with the same ID mapping, because
+    finished units are only valid for the mapping they were created with. """
+    key = hashlib.sha1(json.dumps(mapping, sort_keys=True).encode()).hexdigest()
+    conn = _journal_connect(journal)
+    with conn:
+        row = conn.execute("SELECT value FROM meta WHERE key = 'mapping'").fetchone()
+        if row is not None and row[0] != key and not clean:
+            raise ValueError(
+                f"The ID mapping differs from the one in {journal}; "
+                "rerun with --clean to start from scratch."
+            )
+        conn.execute("INSERT OR REPLACE INTO meta VALUES ('mapping', ?)", (key,))
+    conn.close()
+
+
+def _journal_is_done(journal, unit, dst, fp):
+    """ Checks whether unit was finished before from the same source. """
+    conn = _journal_connect(journal)
+    row = conn.execute("SELECT dst, size, mtime, hash FROM units WHERE unit = ?", (unit,)).fetchone()
+    conn.close()
+    return row == (dst, *fp) and op.exists(dst)
+
+
+def _journal_mark_done(journal, unit, dst, fp):
+    conn = _journal_connect(journal)
+    with conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO units VALUES (?, ?, ?, ?, ?, datetime('now'))",
+            (unit, dst, *fp)
+        )
+    conn.close()
+
+
+def _get_dst(to_copy, out_dir, mapping, old_id=None):
+    """ Returns the subject ID (if any) and the (renamed) destination of to_copy. """
+    if 'sub-' in op.basename(to_copy):
+        old_id = op.basename(to_copy).split('_')[0].split('.')[0]
         dst = op.join(out_dir, op.dirname(to_copy), op.basename(to_copy).replace(old_id, mapping[old_id]))
     else:
         dst = op.join(out_dir, to_copy)
 
-    if op.isfile(src) and not op.isfile(dst):
-        shutil.copyfile(src, dst)
-        os.chmod(dst, 0o644)
-    elif op.isfile(dst):
-        log.info(f"Trying to copy to {dst}, but already exists!")
-        return None
-    else:
+    return old_id, dst
+
+
+def _copy_file_and_check(to_copy, bids_dir, out_dir, mapping, old_id=None, journal=None, shuffle=None,
+                         transfer='copy', fp=None):
+    """ Copies (and anonymizes) a single file. If a journal is given, files
+    that were copied before from an unchanged source are skipped and
+    incomplete ones are redone. If `shuffle` (the mapping dataframe) is
+    given, the participant IDs in the (TSV) file are shuffled as well. """
+    if shuffle is not None:  # file is modified in place, so it cannot be a link
+        transfer = 'copy'
+
+    src = op.join(bids_dir, to_copy)
+    old_id, dst = _get_dst(to_copy, out_dir, mapping, old_id)
+    if not op.isfile(src):
         log.info(f"Trying to copy {src}, but it doesn't exist!")
         return None
 
-    if old_id is not None:
-        ext = dst.split('.')[-1]
-        if ext not in EXCLUDE_FROM_CHECK:
-            _check_contents_for_id_and_replace(dst, old_id, mapping[old_id])
+    if journal is not None:
+        if fp is None:
+            fp = _fingerprint(src)
 
-    return dst
+        if _journal_is_done(journal, to_copy, dst, fp):
+            return dst
 
+        if op.isfile(dst):  # left over from an interrupted or outdated run
+            os.remove(dst)
+    elif op.isfile(dst):
+        log.info(f"Trying to copy to {dst}, but already exists!")
+        return None
 
-def _recursive_walk(d, mapping, old_id=None, new_id=None):
-    for root, _, files in os.walk(d):
-        root_base = op.basename(root)
-        if f'sub-{old_id}' in root_base:
-            root_new_base = root_base.replace(old_id, new_id)
-            root_new = op.join(op.dirname(root), root_new_base)
-            os.rename(root, root_new)
-            # Because we renamed, we need to run it again
-            _recursive_walk(root_new, mapping, old_id=old_id, new_id=new_id)
+    os.makedirs(op.dirname(dst), exist_ok=True)
+    substitutor = None
+    if old_id is not None and dst.split('.')[-1] not in EXCLUDE_FROM_CHECK:
+        substitutor = get_substitutor(old_id, mapping[old_id])
+    stream_file(src, dst, substitutor, transfer)
 
-        for f in files:
-            f_full = op.join(root, f)
-            if 'sub-' in f:
-                old_id = f.split('_')[0]
-                f_new = op.join(root, f.replace(old_id, mapping[old_id]))
-                os.rename(f_full, f_new)
-                f_full = f_new
+    if shuffle is not None:
+        _shuffle_tsv_contents(dst, shuffle)
 
-            ext = f.split('.')[-1]
-            if ext not in EXCLUDE_FROM_CHECK and old_id is not None:
-                _check_contents_for_id_and_replace(f_full, old_id, mapping[old_id])
+    if journal is not None:
+        _journal_mark_done(journal, to_copy, dst, fp)
+
+    return dst
 
 
-def _copy_dir_and_check(to_copy, bids_dir, out_dir, mapping, old_id=None):
+def _copy_dir_and_check(to_copy, bids_dir, out_dir, mapping, old_id=None, journal=None, transfer='copy',
+                        fp=None):
+    """ Copies (and anonymizes) a directory tree. If a journal is given,
+    trees that were copied before from an unchanged source are skipped
+    and incomplete ones are redone. """
     src = op.join(bids_dir, to_copy)
-    if 'sub-' in op.basename(src):
-        old_id = op.basename(src).split('_')[0].split('.')[0]
-        new_id = mapping[old_id]
-        dst = op.join(out_dir, op.dirname(to_copy), op.basename(to_copy).replace(old_id, new_id))
-    else:
-        new_id = None
-        dst = op.join(out_dir, to_copy)
-    
-    if op.isdir(src) and not op.isdir(dst):
-        shutil.copytree(src, dst)
-        _fix_permissions(dst)
-        _recursive_walk(dst, mapping, old_id=old_id, new_id=new_id)
-    else:
+    old_id, dst = _get_dst(to_copy, out_dir, mapping, old_id)
+    if not op.isdir(src):
+        print(f"Cannot copy {src} to {dst} because source does not exist!")
+        return
+
+    if journal is not None:
+        if fp is None:
+            fp = _fingerprint(src)
+
+        if _journal_is_done(journal, to_copy, dst, fp):
+            return
+
+        if op.isdir(dst):  # left over from an interrupted or outdated run
+            log.info(f"Removing incomplete {dst}")
+            shutil.rmtree(dst)
+    elif op.isdir(dst):
         print(f"Cannot copy {src} to {dst} because destination already exists!")
+        return
+
+    _stream_tree(src, dst, mapping, old_id=old_id, transfer=transfer)
+
+    if journal is not None:
+        _journal_mark_done(journal, to_copy, dst, fp)
+
 
 def _delete(all_data):
 
@@ -168,9 +257,176 @@ def _delete(all_data):
             shutil.rmtree(d)
 
 
-def main(bids_dir, out_dir, seed=None, n_jobs=1, skip=None):
+def _scan_stream(f_in):
+    """ Yields (offset, label) of all IDs in a (decompressed) stream, read in
+    chunks; the tail of each chunk is carried over to the next one. """
+    offset, carry = 0, b''
+    while True:
+        chunk = f_in.read(CHUNK_SIZE)
+        buf = carry + chunk
+        safe = max(len(buf) - MAX_ID_LENGTH, 0) if chunk else len(buf)
+        for match in ID_PATTERN.finditer(buf):
+            if match.start() >= safe:
+                break
+            yield offset + match.start(), match.group(1)
+
+        offset += safe
+        carry = buf[safe:]
+        if not chunk:
+            break
+
+
+def _nifti_header_size(prefix):
+    """ Returns the number of bytes before the image data (i.e., the header
+    plus extensions) based on the first bytes of a NIfTI-1 file. """
+    for endian in '<>':
+        if struct.unpack(endian + 'i', prefix[:4])[0] == 348:
+            return max(int(struct.unpack(endian + 'f', prefix[108:112])[0]), 352)
+
+    return 352  # not a NIfTI-1 file, so only check the header size
+
+
+def _scan_file_for_ids(f):
+    """ Yields (offset, label) of all IDs in file f. Gzipped files are scanned
+    after decompression and for NIfTI files only the header and header
+    extensions are scanned (the image data cannot contain IDs). Plain
+    files are memory-mapped. """
+    if f.endswith(('.nii', '.nii.gz')):
+        opener = gzip.open if f.endswith('.gz') else open
+        with opener(f, 'rb') as f_in:
+            prefix = f_in.read(352)
+            size = _nifti_header_size(prefix)
+            header = prefix + f_in.read(size - len(prefix))
+
+        for match in ID_PATTERN.finditer(header):
+            yield match.start(), match.group(1)
+    elif f.endswith(('.gz', '.mgz')):
+        with gzip.open(f, 'rb') as f_in:
+            yield from _scan_stream(f_in)
+    elif op.getsize(f) > 0:
+        with open(f, 'rb') as f_in, mmap.mmap(f_in.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            for match in ID_PATTERN.finditer(mm):
+                yield match.start(), match.group(1)
+
+
+def _find_leaks(files, out_dir, old_labels, new_labels, inverse):
+    """ Checks files (relative to out_dir) for IDs that should not be there.
+    Files of a subject (e.g., sub-0001/anat/... or sub-0001.html) should only
+    contain the (new) ID of that subject; files of the dataset as a whole
+    should not contain old IDs. In the latter, old IDs that are also valid
+    new IDs cannot be told apart from new IDs and are reported as
+    'ambiguous'. """
+    leaks = []
+    for f in files:
+        owner = None
+        for part in f.split(os.sep):
+            if part.startswith('sub-'):
+                owner = part[4:].split('_')[0].split('.')[0]
+                break
+
+        found = [('path', None, m.group(1)) for m in ID_PATTERN.finditer(f.encode())]
+        try:
+            found += [('contents', offset, label) for offset, label in _scan_file_for_ids(op.join(out_dir, f))]
+        except (OSError, EOFError) as e:  # e.g., corrupt gzip file
+            leaks.append(dict(file=f, where='contents', offset=None, id=None, reason=f'unreadable: {e}'))
+
+        for where, offset, label in found:
+            label = label.decode()
+            if label not in old_labels:
+                continue
+
+            if owner is None or owner not in new_labels:
+                reason = 'ambiguous' if label in new_labels else 'old ID'
+            elif label == owner:
+                continue
+            elif label == inverse[owner]:
+                reason = 'old ID of this subject'
+            else:
+                reason = 'ID of another subject'
+
+            leaks.append(dict(file=f, where=where, offset=offset, id=f'sub-{label}', reason=reason))
+
+    return leaks
+
+
+def verify(out_dir, key_file, n_jobs=1, report=None):
+    """ Verifies that no original IDs leak into the anonymized directory
+    by scanning all files (in parallel) for all old IDs at once.
+
+    Parameters
+    ----------
+    out_dir : str
+        Path to anonymized (output) directory.
+    key_file : str
+        Path to shuffle-key.tsv with old and new IDs.
+    n_jobs : int
+        Number of parallel jobs.
+    report : str
+        Path to JSON file with the leak report. If None, 'leak-report.json'
+        next to the key file is used.
+
+    Returns
+    -------
+    leaks : list
+        List of dicts with the file, location and reason of each leak
+        (excluding ambiguous hits, which are only listed in the report).
+    """
+    if report is None:
+        report = op.join(op.dirname(op.abspath(key_file)), 'leak-report.json')
+
+    key = pd.read_csv(key_file, sep='\t')
+    old_labels = set(key['old_id'].str.replace('sub-', '', regex=False))
+    new_labels = set(key['new_id'].str.replace('sub-', '', regex=False))
+    inverse = {new[4:]: old[4:] for old, new in zip(key['old_id'], key['new_id'])}
+    overlap = old_labels & new_labels
+    if overlap:
+        log.warning(f"{len(overlap)} old IDs are also new IDs; hits of these outside "
+                    "subject files are reported as ambiguous")
+
+    files, sizes = [], []
+    for root, _, these_files in os.walk(out_dir):
+        for f in these_files:
+            f = op.join(root, f)
+            files.append(op.relpath(f, out_dir))
+            sizes.append(op.getsize(f))
+
+    log.info(f"Verifying {len(files)} files in {out_dir}")
+    # Batches of roughly equal size, largest files first
+    order = sorted(range(len(files)), key=lambda i: sizes[i], reverse=True)
+    n_batches = effective_n_jobs(n_jobs) * 8
+    batches = [[files[i] for i in order[b::n_batches]] for b in range(n_batches)]
+    leaks = Parallel(n_jobs=n_jobs)(delayed(_find_leaks)
+        (batch, out_dir, old_labels, new_labels, inverse)
+        for batch in tqdm(batches, desc='verify') if batch
+    )
+    leaks = sorted([leak for batch in leaks for leak in batch], key=lambda leak: leak['file'])
+    ambiguous = [leak for leak in leaks if leak['reason'] == 'ambiguous']
+    leaks = [leak for leak in leaks if leak['reason'] != 'ambiguous']
+
+    with open(report, 'w') as f_out:
+        json.dump(dict(out_dir=op.abspath(out_dir), n_files=len(files), n_leaks=len(leaks), leaks=leaks,
+                       n_overlapping_ids=len(overlap), n_ambiguous=len(ambiguous), ambiguous=ambiguous),
+                  f_out, indent=4)
+
+    if ambiguous:
+        log.warning(f"Found {len(ambiguous)} ambiguous IDs (old IDs that are also new IDs); see {report}")
+
+    if leaks:
+        log.warning(f"Found {len(leaks)} leaked IDs in {len({leak['file'] for leak in leaks})} files; see {report}")
+    else:
+        log.info(f"No leaked IDs found; report written to {report}")
+
+    return leaks
+
+
+def main(bids_dir, out_dir, seed=None, n_jobs=1, skip=None, clean=False, transfer='copy'):
     """ Anonymizes a BIDS directory by shuffling subject IDs.
 
+    Finished work units (subject directories, files) are recorded in a
+    journal (anon-journal.sqlite, next to shuffle-key.tsv), so an
+    interrupted run can simply be restarted: completed units are skipped
+    and partial or outdated ones are redone.
+
     Parameters
     ----------
     bids_dir : str
@@ -179,11 +435,23 @@ def main(bids_dir, out_dir, seed=None, n_jobs=1, skip=None):
         Output directory for shuffled data. If None, 'bids_anon' is used.
     seed : int
         Random seed for shuffling.
+    n_jobs : int
+        Number of parallel jobs.
+    skip : list
+        Parts of the dataset to skip ('bids', 'fmriprep', etc.).
+    clean : bool
+        Whether to remove existing output before copying.
+    transfer : str
+        How to transfer files that need no ID substitution (one of
+        'copy', 'reflink' or 'hardlink'; see TRANSFER_MODES).
     """
     
     if skip is None:
         skip = []
 
+    if transfer not in TRANSFER_MODES:
+        raise ValueError(f"transfer should be one of {TRANSFER_MODES}, not {transfer}!")
+
     if bids_dir == out_dir:
         raise ValueError("bids_dir and out_dir are the same!")
     
@@ -191,9 +459,10 @@ def main(bids_dir, out_dir, seed=None, n_jobs=1, skip=None):
     log.info(f"Setting output-dir to {out_dir}")
     log.info(f"Using {n_jobs} jobs")
     log.info(f"Skipping: {skip}")
+    log.info(f"Transfer mode: {transfer}")
 
-    resp = input(f'\nGoing to remove contents from {op.abspath(out_dir)}, continue? (y, n) ')
-    if resp in ['y', 'Y']:
+    if clean:
+        log.info(f"Removing contents from {op.abspath(out_dir)}")
         if 'bids' not in skip:
             to_remove = [f for f in glob(op.join(out_dir, '*')) if f != 'derivatives']
             _delete(to_remove)
@@ -202,14 +471,16 @@ def main(bids_dir, out_dir, seed=None, n_jobs=1, skip=None):
             if ddir not in skip:
                 _delete(glob(op.join(out_dir, 'derivatives', ddir, '*')))
 
+    # The dataset is listed once (or only where it changed since the last run)
+    index = load_index(bids_dir)
     bids_subs = sorted(  # find BIDS subject directories
-        [d for d in glob(op.join(bids_dir, 'sub-*')) if op.isdir(d)]
+        [d for d in index_glob(index, op.join(bids_dir, 'sub-*')) if op.isdir(d)]
     )
     
     bids_unique = sorted(list(set([op.basename(d) for d in bids_subs])))
     log.info(f"Found {len(bids_unique)} unique BIDS directories.")
 
-    all_files = sorted(glob(op.join(bids_dir, '**', 'sub-*'), recursive=True))
+    all_files = sorted(index_glob(index, op.join(bids_dir, '**', 'sub-*')))
     all_unique = sorted(list(set([op.basename(f).split('_')[0].split('.')[0] for f in all_files])))
     log.info(f"Found {len(all_unique)} unique files.")
 
@@ -231,11 +502,27 @@ def main(bids_dir, out_dir, seed=None, n_jobs=1, skip=None):
         if k == v:
             raise ValueError(f"Mapping is the same for {k}!")
 
-    # Save mapping
+    # Check the mapping against an existing key and journal before writing
+    # anything; the key is never overwritten with a different one
     mapping_df = pd.DataFrame()
     mapping_df['old_id'] = bids_unique
     mapping_df['new_id'] = new_ids
-    mapping_df.to_csv(op.join(op.dirname(bids_dir), 'shuffle-key.tsv'), sep='\t', index=False)
+    key_file = op.join(op.dirname(bids_dir), 'shuffle-key.tsv')
+    key = mapping_df.to_csv(sep='\t', index=False)
+    if op.isfile(key_file):
+        with open(key_file, 'r') as f_in:
+            if f_in.read() != key:
+                raise ValueError(
+                    f"{key_file} exists and contains a different ID mapping; "
+                    "move it out of the way if you want to create a new one."
+                )
+
+    journal = op.join(op.dirname(bids_dir), 'anon-journal.sqlite')
+    _journal_check_mapping(journal, mapping, clean=clean)
+
+    # Save mapping
+    with open(key_file, 'w') as f_out:
+        f_out.write(key)
 
     if not op.isdir(out_dir):
         log.info(f"Creating {out_dir}")
@@ -243,13 +530,15 @@ def main(bids_dir, out_dir, seed=None, n_jobs=1, skip=None):
     ##### 0. Code
     #_copy_dir_and_check('code', bids_dir, out_dir, mapping, old_id=None)
 
-    ##### 1. Random stuff
-    dst = _copy_file_and_check('participants.tsv', bids_dir, out_dir, mapping, old_id=None)
+    # All work units (subject directories and single files of all derivatives)
+    # are collected first and then run in one pool, largest first, so that small
+    # units fill up idle workers while the large ones are running.
+    # Each unit is a tuple of (function, path relative to bids_dir, kwargs).
+    units = []
 
-    if dst is not None:  # shuffle participants.tsv
-        _shuffle_tsv_contents(dst, mapping_df)
-    exit()
-    md_files = [f for f in glob(op.join(bids_dir, '*')) if op.isfile(f)]
+    ##### 1. Random stuff
+    units.append((_copy_file_and_check, 'participants.tsv', dict(shuffle=mapping_df)))
+    md_files = [f for f in index_glob(index, op.join(bids_dir, '*')) if op.isfile(f)]
     for f in md_files:
         if op.basename(f) in ['participants.tsv', 'LICENSE', 'README.md']:
             continue
@@ -257,125 +546,121 @@ def main(bids_dir, out_dir, seed=None, n_jobs=1, skip=None):
         if 'sub-' in f:
             raise ValueError(f"Want to copy {f} without checking, but contains 'sub-'!")
 
-        _copy_file_and_check(op.basename(f), bids_dir, out_dir, mapping, old_id=None)
-    
+        units.append((_copy_file_and_check, op.basename(f), {}))
+
     ##### 2. BIDS data
     ### 2.1. Sub-directories
     if 'bids' not in skip:
-        Parallel(n_jobs=n_jobs)(delayed(_copy_dir_and_check)
-            (op.basename(sub_dir), bids_dir, out_dir, mapping)
-            for sub_dir in tqdm(bids_subs, desc='bids')
-        )
+        units.extend((_copy_dir_and_check, op.basename(sub_dir), {}) for sub_dir in bids_subs)
 
     ##### 2. Derivatives
     ### 2.1. Fmriprep
     if 'fmriprep' not in skip:
         fmriprep_dir = op.join('derivatives', 'fmriprep')
-        _copy_dir_and_check(op.join(fmriprep_dir, 'logs'), bids_dir, out_dir, mapping)
+        units.append((_copy_dir_and_check, op.join(fmriprep_dir, 'logs'), {}))
         for f in ['dataset_description.json', 'desc-aparcaseg_dseg.tsv', 'desc-aseg_dseg.tsv']:
-            to_check = op.join('derivatives', 'fmriprep', f)
-            _copy_file_and_check(to_check, bids_dir, out_dir, mapping)
+            units.append((_copy_file_and_check, op.join(fmriprep_dir, f), {}))
 
-        sub_dirs = [d for d in sorted(glob(op.join(bids_dir, fmriprep_dir, 'sub-*')))
+        sub_dirs = [d for d in sorted(index_glob(index, op.join(bids_dir, fmriprep_dir, 'sub-*')))
                     if op.isdir(d)]
-    
-        Parallel(n_jobs=n_jobs)(delayed(_copy_dir_and_check)
-            (op.join(fmriprep_dir, op.basename(sub_dir)), bids_dir, out_dir, mapping)
-            for sub_dir in tqdm(sub_dirs, desc='fmriprep dir')
-        )
-    
-        html_files = sorted(glob(op.join(bids_dir, fmriprep_dir, 'sub-*.html')))
-        Parallel(n_jobs=n_jobs)(delayed(_copy_file_and_check)
-            (op.join(fmriprep_dir, op.basename(f)), bids_dir, out_dir, mapping)
-            for f in tqdm(html_files, desc='fmriprep html')
-        )
+        units.extend((_copy_dir_and_check, op.join(fmriprep_dir, op.basename(d)), {}) for d in sub_dirs)
+
+        html_files = sorted(index_glob(index, op.join(bids_dir, fmriprep_dir, 'sub-*.html')))
+        units.extend((_copy_file_and_check, op.join(fmriprep_dir, op.basename(f)), {}) for f in html_files)
 
     ### 2.2. Freesurfer
     if 'freesurfer' not in skip:
         fs_dir = op.join('derivatives', 'freesurfer')
-        fsav_dirs = glob(op.join(bids_dir, fs_dir, 'fsaverage*'))
-        for fsav_dir in fsav_dirs:
-            _copy_dir_and_check(op.join(fs_dir, op.basename(fsav_dir)), bids_dir, out_dir, mapping)
-    
-        sub_dirs = sorted(glob(op.join(bids_dir, fs_dir, 'sub-*')))
-        Parallel(n_jobs=n_jobs)(delayed(_copy_dir_and_check)
-            (op.join(fs_dir, op.basename(sub_dir)), bids_dir, out_dir, mapping)
-            for sub_dir in tqdm(sub_dirs, desc='freesurfer')
-        )
+        fsav_dirs = index_glob(index, op.join(bids_dir, fs_dir, 'fsaverage*'))
+        units.extend((_copy_dir_and_check, op.join(fs_dir, op.basename(d)), {}) for d in fsav_dirs)
+
+        sub_dirs = sorted(index_glob(index, op.join(bids_dir, fs_dir, 'sub-*')))
+        units.extend((_copy_dir_and_check, op.join(fs_dir, op.basename(d)), {}) for d in sub_dirs)
 
     ### 2.3. MRIQC
     if 'mriqc' not in skip:
         mriqc_dir = op.join('derivatives', 'mriqc')
-        if not op.isdir(op.join(out_dir, 'derivatives', 'mriqc')):
-            os.makedirs(op.join(out_dir, 'derivatives', 'mriqc'))
+        sub_dirs = sorted([d for d in index_glob(index, op.join(bids_dir, mriqc_dir, 'sub-*')) if op.isdir(d)])
+        units.extend((_copy_dir_and_check, op.join(mriqc_dir, op.basename(d)), {}) for d in sub_dirs)
 
-        sub_dirs = sorted([d for d in glob(op.join(bids_dir, mriqc_dir, 'sub-*')) if op.isdir(d)])
-        Parallel(n_jobs=n_jobs)(delayed(_copy_dir_and_check)
-            (op.join(mriqc_dir, op.basename(sub_dir)), bids_dir, out_dir, mapping)
-            for sub_dir in tqdm(sub_dirs, desc='mriqc dir')
-        )
-    
-        html_files = glob(op.join(bids_dir, mriqc_dir, 'sub-*.html'))
-        Parallel(n_jobs=n_jobs)(delayed(_copy_file_and_check)
-            (op.join(mriqc_dir, op.basename(f)), bids_dir, out_dir, mapping)
-            for f in tqdm(html_files, desc='mriqc html')
-        )
+        html_files = index_glob(index, op.join(bids_dir, mriqc_dir, 'sub-*.html'))
+        units.extend((_copy_file_and_check, op.join(mriqc_dir, op.basename(f)), {}) for f in html_files)
 
     ### 2.4. physiology
     if 'physiology' not in skip:
         physio_dir = op.join('derivatives', 'physiology')
-        sub_dirs = sorted(glob(op.join(bids_dir, physio_dir, 'sub-*')))
-        Parallel(n_jobs=n_jobs)(delayed(_copy_dir_and_check)
-            (op.join(physio_dir, op.basename(sub_dir)), bids_dir, out_dir, mapping)
-            for sub_dir in tqdm(sub_dirs, desc='physio')
-        )
+        sub_dirs = sorted(index_glob(index, op.join(bids_dir, physio_dir, 'sub-*')))
+        units.extend((_copy_dir_and_check, op.join(physio_dir, op.basename(d)), {}) for d in sub_dirs)
 
     ### 2.5. dwi
     if 'dwipreproc' not in skip:
         dwi_dir = op.join('derivatives', 'dwipreproc')
-        if not op.isdir(op.join(out_dir, 'derivatives', 'dwipreproc')):
-            os.makedirs(op.join(out_dir, 'derivatives', 'dwipreproc'))
-
-        group_file = op.join(dwi_dir, f'group_dwi.tsv')
-        group_file = _copy_file_and_check(group_file, bids_dir, out_dir, mapping, old_id=None)
-        if group_file is not None:
-            _shuffle_tsv_contents(group_file, mapping_df)
-
-        sub_dirs = sorted(glob(op.join(bids_dir, dwi_dir, 'sub-*')))
-        Parallel(n_jobs=n_jobs)(delayed(_copy_dir_and_check)
-            (op.join(dwi_dir, op.basename(sub_dir)), bids_dir, out_dir, mapping)
-            for sub_dir in tqdm(sub_dirs, desc='dwi')
-        )
-    
+        group_file = op.join(dwi_dir, 'group_dwi.tsv')
+        units.append((_copy_file_and_check, group_file, dict(shuffle=mapping_df)))
+
+        sub_dirs = sorted(index_glob(index, op.join(bids_dir, dwi_dir, 'sub-*')))
+        units.extend((_copy_dir_and_check, op.join(dwi_dir, op.basename(d)), {}) for d in sub_dirs)
+
     ### 2.6. vbm
     if 'vbm' not in skip:
         vbm_dir = op.join('derivatives', 'vbm')
-        sub_dirs = sorted(glob(op.join(bids_dir, vbm_dir, 'sub-*')))
-        Parallel(n_jobs=n_jobs)(delayed(_copy_dir_and_check)
-            (op.join(vbm_dir, op.basename(sub_dir)), bids_dir, out_dir, mapping)
-            for sub_dir in tqdm(sub_dirs, desc='vbm')
-        )
+        sub_dirs = sorted(index_glob(index, op.join(bids_dir, vbm_dir, 'sub-*')))
+        units.extend((_copy_dir_and_check, op.join(vbm_dir, op.basename(d)), {}) for d in sub_dirs)
+
+    # Scanning the sources (metadata only) gives both the sizes for
+    # scheduling and the fingerprints for the journal
+    fps = Parallel(n_jobs=n_jobs, prefer='threads')(
+        delayed(_fingerprint)(op.join(bids_dir, to_copy)) for _, to_copy, _ in tqdm(units, desc='scanning')
+    )
+    todo = []
+    for (func, to_copy, kwargs), fp in zip(units, fps):
+        _, dst = _get_dst(to_copy, out_dir, mapping)
+        if not _journal_is_done(journal, to_copy, dst, fp):
+            todo.append((func, to_copy, kwargs, fp))
+
+    log.info(f"{len(units) - len(todo)} of {len(units)} units are already done.")
+    todo = sorted(todo, key=lambda unit: unit[3][0], reverse=True)
+    Parallel(n_jobs=n_jobs, batch_size=1)(delayed(func)
+        (to_copy, bids_dir, out_dir, mapping, journal=journal, transfer=transfer, fp=fp, **kwargs)
+        for func, to_copy, kwargs, fp in tqdm(todo, desc='anonymizing')
+    )
 
-    # Double check
-    _fix_permissions(out_dir)
 
 if __name__ == '__main__':
 
-    bids_dir = sys.argv[1]
+    import argparse
+    parser = argparse.ArgumentParser(description='Anonymize a BIDS dataset by shuffling subject IDs')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help='Create the anonymized dataset')
+    run_parser.add_argument('bids_dir', type=str, help='BIDS directory')
+    run_parser.add_argument('out_dir', type=str, help='Output directory')
+    run_parser.add_argument('seed_file', type=str, help='YAML file with random seeds per project')
+    run_parser.add_argument('skip', type=str, nargs='*', help='Parts of the dataset to skip')
+    run_parser.add_argument('--clean', action='store_true', help='Remove existing output first')
+    run_parser.add_argument('--n_jobs', type=int, default=1, help='Number of parallel jobs')
+    run_parser.add_argument('--transfer', type=str, default='copy', choices=TRANSFER_MODES,
+                            help='How to transfer files that do not need ID substitution')
+
+    verify_parser = subparsers.add_parser('verify', help='Check the anonymized dataset for leaked IDs')
+    verify_parser.add_argument('out_dir', type=str, help='Anonymized (output) directory')
+    verify_parser.add_argument('key_file', type=str, help='shuffle-key.tsv file')
+    verify_parser.add_argument('--n_jobs', type=int, default=1, help='Number of parallel jobs')
+    verify_parser.add_argument('--report', type=str, default=None, help='Output JSON file')
+    args = parser.parse_args()
+
+    if args.command == 'verify':
+        leaks = verify(args.out_dir, args.key_file, n_jobs=args.n_jobs, report=args.report)
+        sys.exit(1 if leaks else 0)
+
+    bids_dir = args.bids_dir
     if not op.isdir(bids_dir):
         raise ValueError(f"{bids_dir} is not a directory!")
 
-    out_dir = sys.argv[2]
-    seed_file = sys.argv[3]
-
-    if len(sys.argv) > 4:
-        to_skip = sys.argv[4:]
-    else:
-        to_skip = None
-
     project = op.basename(op.dirname(bids_dir))
-    with open(seed_file, 'r') as f_in:
+    with open(args.seed_file, 'r') as f_in:
         rnd_seeds = yaml.safe_load(f_in)
         seed = rnd_seeds[project]
 
-    main(bids_dir, out_dir, seed=seed, skip=to_skip, n_jobs=1)
+    main(bids_dir, args.out_dir, seed=seed, skip=args.skip or None, n_jobs=args.n_jobs, clean=args.clean,
+         transfer=args.transfer)
@@ -1,36 +1,144 @@
 import os
-import os.path as op
+import sys
+import numpy as np
 import pandas as pd
-from nilearn import image, masking, signal
+import os.path as op
 from glob import glob
 from joblib import Parallel, delayed
 from tqdm import tqdm
 
+sys.path.insert(0, op.join(op.dirname(op.abspath(__file__)), '..', 'misc_qc'))
+from glm import load_mask, smooth
+from masked_cache import load_masked
+from nifti_header import read_header, allocate_nifti, open_nifti, open_nifti_gz
+
+CHUNK_SIZE = 20000  # voxels per chunk for cleaning
+
+
+def _orth(A, tol=1e-10):
+    """ Returns an orthonormal basis of the column space of A. """
+    U, s, _ = np.linalg.svd(A, full_matrices=False)
+    return U[:, s > tol * s.max()]
+
+
+def clean(Y, confounds, chunk_size=CHUNK_SIZE):
+    """ Cleans signals in place (float32), like nilearn's signal.clean with
+    detrend=True and standardize=True: the mean, linear trend and confounds
+    are projected out, after which the signals are z-scored. """
+    n = Y.shape[0]
+    t = np.arange(n, dtype=np.float64)
+    Q = _orth(np.column_stack((np.ones(n), t - t.mean(), confounds))).astype(np.float32)
+    for i in range(0, Y.shape[1], chunk_size):
+        y = Y[:, i:i + chunk_size]
+        y -= Q @ (Q.T @ y)
+        std = y.std(axis=0)
+        std[std < np.finfo(np.float64).eps] = 1
+        y /= std
+
+    return Y
+
+
+def preproc(f, out_dir=None, out_mask=None, fwhm=5, n_vols=16, return_data=True, cache_dir=None,
+            compress=True):
+    """ Cleans (within the brain mask) and smooths a preprocessed BOLD file.
+
+    Parameters
+    ----------
+    f : str
+        Path to Fmriprep desc-preproc_bold file.
+    out_dir : str
+        Directory to write the result to; if None, nothing is written.
+    out_mask : str
+        Mask of the voxels to return (e.g., the group mask of dual regression);
+        if None, the brain mask of f is used.
+    fwhm : float
+        Smoothing kernel (in mm).
+    n_vols : int
+        Number of volumes to smooth at once.
+    return_data : bool
+        Whether to return the data (or only write it).
+    cache_dir : str
+        Masked-data cache to read the data through (optional).
+    compress : bool
+        Whether to write the result as .nii.gz (or as uncompressed .nii,
+        which is faster to read but several GB per run).
 
-def preproc(f, out_dir):
+    Returns
+    -------
+    out : np.ndarray
+        Cleaned and smoothed data within out_mask (time x voxels), or None
+        if return_data is False.
+    """
     mask = f.replace('preproc_bold', 'brain_mask')
     if not op.isfile(mask):
         raise ValueError(f"Mask {mask} does not exist.")
-    
+
     conf = f.split('restingstate')[0] + 'restingstate_acq-mb3_desc-confounds_regressors.tsv'
     if not op.isfile(conf):
         raise ValueError(f"Confound file {conf} does not exist.")
-    
-    masked = masking.apply_mask(f, mask)
+
     conf = pd.read_csv(conf, sep='\t')
     conf_cols = [col for col in conf.columns if 'cosine' in col] + ['rot_x', 'rot_y', 'rot_z', 'trans_x', 'trans_y', 'trans_z']
-    clean = signal.clean(masked, detrend=True, confounds=conf.loc[:, conf_cols].values)
-    smooth = image.smooth_img(masking.unmask(clean, mask), fwhm=5)
-    
-    if not op.isdir(out_dir):
-        os.makedirs(out_dir)
-    
-    f_out = op.basename(f).replace('preproc', 'preproc+masked+hp+motionreg+smooth')
-    smooth.to_filename(op.join(out_dir, f_out))
+
+    Y = clean(load_masked(f, mask, cache_dir), conf.loc[:, conf_cols].values)
+    mask, affine = load_mask(mask)
+    out_mask = mask if out_mask is None else load_mask(out_mask)[0]
+    n = Y.shape[0]
+    out = np.empty((n, out_mask.sum()), dtype=np.float32) if return_data else None
+
+    if out_dir is not None:
+        if not op.isdir(out_dir):
+            os.makedirs(out_dir, exist_ok=True)
+
+        f_out = op.basename(f).replace('preproc', 'preproc+masked+hp+motionreg+smooth')
+        if not compress:
+            f_out = f_out.replace('.nii.gz', '.nii')
+        f_out = op.join(out_dir, f_out)
+        zooms = read_header(f).get_zooms()
+        if compress:
+            data_out = open_nifti_gz(f_out, mask.shape + (n,), affine, zooms=zooms)
+        else:
+            allocate_nifti(f_out, mask.shape + (n,), affine, zooms=zooms)
+            data_out = open_nifti(f_out, mask.shape + (n,))
+
+    # Smooth a couple of volumes at a time (unmasked, like nilearn's smooth_img)
+    for i in range(0, n, n_vols):
+        vols = np.zeros(mask.shape + (Y[i:i + n_vols].shape[0],), dtype=np.float32)
+        vols[mask] = Y[i:i + n_vols].T
+        vols = smooth(vols, affine, fwhm)
+        if return_data:
+            out[i:i + n_vols] = vols[out_mask].T
+        if out_dir is not None and compress:
+            data_out.write(vols.tobytes(order='F'))  # volumes are contiguous
+        elif out_dir is not None:
+            data_out[..., i:i + n_vols] = vols
+
+    if out_dir is not None and compress:
+        data_out.close()
+    elif out_dir is not None:
+        data_out.flush()
+        del data_out
+
+    return out
 
 
 if __name__ == '__main__':
-    
-    files = sorted(glob('../derivatives/fmriprep/sub*/func/*task-rest*space-MNI*bold.nii.gz'))
-    out_dir = '../derivatives/dual_regression_rs/preproc'
-    Parallel(n_jobs=10)(delayed(preproc)(f, out_dir) for f in tqdm(files))
+
+    import argparse
+    parser = argparse.ArgumentParser(description='Preprocessing before dual regression')
+    parser.add_argument('--pattern', type=str, default='../derivatives/fmriprep/sub*/func/*task-rest*space-MNI*bold.nii.gz',
+                        help='Glob pattern of input files')
+    parser.add_argument('--out_dir', type=str, default='../derivatives/dual_regression_rs/preproc', help='Output directory')
+    parser.add_argument('--fwhm', type=float, default=5, help='Smoothing kernel (mm)')
+    parser.add_argument('--n_jobs', type=int, default=10, help='Number of processes')
+    parser.add_argument('--cache_dir', type=str, default=None, help='Masked-data cache directory (optional)')
+    parser.add_argument('--uncompressed', action='store_true', help='Write uncompressed .nii files (large)')
+    args = parser.parse_args()
+
+    cache_dir = op.abspath(args.cache_dir) if args.cache_dir else None
+    files = sorted(glob(args.pattern))
+    Parallel(n_jobs=args.n_jobs)(
+        delayed(preproc)(f, args.out_dir, fwhm=args.fwhm, return_data=False, cache_dir=cache_dir,
+                         compress=not args.uncompressed)
+        for f in tqdm(files)
+    )
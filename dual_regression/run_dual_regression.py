@@ -0,0 +1,166 @@
+""" Dual regression (like FSL's dual_regression, but in a single process per
+subject). Each preprocessed run (from preproc_before_dualreg.py) is read once
+and both stages are solved on the masked data:
+
+- stage 1: spatial regression of the group IC maps onto each volume
+  (fsl_glm --demean), giving subject-specific timecourses;
+- stage 2: temporal regression of the (des_norm-ed) timecourses onto each
+  voxel (fsl_glm --demean --des_norm), giving subject-specific maps.
+
+The stage-2 maps of all subjects are written directly into one preallocated
+(uncompressed) 4D image per IC, which is the input to group-level inference
+(see misc_qc/permutation_inference.py); separate per-subject stage-2 images
+(dr_stage2_subject*.nii.gz and *_Z.nii.gz) are only written with
+--save_subjects. With --preproc, the inputs are Fmriprep outputs, which are
+cleaned and smoothed in memory first (see preproc_before_dualreg.py), without
+writing intermediate files. """
+import os
+import sys
+import numpy as np
+import nibabel as nib
+import os.path as op
+from scipy import stats
+from tqdm import tqdm
+from joblib import Parallel, delayed
+
+sys.path.insert(0, op.join(op.dirname(op.abspath(__file__)), '..', 'misc_qc'))
+from glm import load_mask, apply_mask, unmask
+from nifti_header import allocate_nifti, open_nifti
+import permutation_inference
+from preproc_before_dualreg import preproc as preproc_run
+
+
+def _t_to_z(t, dof):
+    """ Converts t-values to z-values (symmetrically, to avoid precision loss
+    for large negative t-values). """
+    p = np.clip(stats.t.sf(np.abs(t), dof), 1e-300, 1)
+    return np.sign(t) * stats.norm.isf(p)
+
+
+def dual_regression(Y, maps, des_norm=True):
+    """ Runs both stages of dual regression on masked data.
+
+    Parameters
+    ----------
+    Y : np.ndarray
+        Data (time x voxels).
+    maps : np.ndarray
+        Group IC maps (voxels x ICs).
+    des_norm : bool
+        Whether to variance-normalize the stage-1 timecourses.
+
+    Returns
+    -------
+    tc : np.ndarray
+        Stage-1 timecourses (time x ICs).
+    betas : np.ndarray
+        Stage-2 maps (ICs x voxels).
+    z : np.ndarray
+        Stage-2 z-values (ICs x voxels).
+    """
+    # Stage 1: demean data and design over voxels
+    D = maps - maps.mean(axis=0)
+    Ys = Y - Y.mean(axis=1, keepdims=True)
+    tc = Ys @ np.linalg.pinv(D.astype(np.float64)).T.astype(Y.dtype)
+    del Ys
+
+    # Stage 2: demean data and design over time
+    X = tc - tc.mean(axis=0)
+    if des_norm:
+        X /= X.std(axis=0, ddof=1)
+
+    Y = Y - Y.mean(axis=0)
+    pinv = np.linalg.pinv(X.astype(np.float64))
+    betas = pinv.astype(Y.dtype) @ Y
+    Y -= X @ betas  # residuals
+    dof = Y.shape[0] - X.shape[1] - 1
+    sigma2 = np.einsum('ij,ij->j', Y, Y) / dof
+    varcope = np.diag(pinv @ pinv.T)[:, None] * sigma2
+    z = _t_to_z(betas / np.sqrt(np.maximum(varcope, 1e-30)), dof)
+    return tc, betas, z.astype(np.float32)
+
+
+def _run_subject(f, i, maps, mask_file, out_dir, ic_files, n_subs, des_norm, preproc=False, cache_dir=None,
+                 save_subject=False):
+    """ Runs dual regression for subject i and writes its maps into the per-IC
+    4D images (and, if save_subject, into separate stage-2 images). """
+    mask, affine = load_mask(mask_file)
+    if preproc:
+        Y = preproc_run(f, out_mask=mask_file, cache_dir=cache_dir)
+    else:
+        Y = apply_mask(f, mask)
+    tc, betas, z = dual_regression(Y, maps, des_norm=des_norm)
+
+    s = f'subject{i:05d}'
+    np.savetxt(op.join(out_dir, f'dr_stage1_{s}.txt'), tc, fmt='%.6f')
+    if save_subject:
+        unmask(betas, mask, affine).to_filename(op.join(out_dir, f'dr_stage2_{s}.nii.gz'))
+        unmask(z, mask, affine).to_filename(op.join(out_dir, f'dr_stage2_{s}_Z.nii.gz'))
+
+    for ic, f_ic in enumerate(ic_files):
+        stack = open_nifti(f_ic, mask.shape + (n_subs,))
+        stack[..., i][mask] = betas[ic]
+        stack.flush()
+        del stack
+
+
+def main(ica_maps, out_dir, mask_file, inputs, des_norm=True, design=None, contrasts=None,
+         n_perm=5000, preproc=False, cache_dir=None, save_subjects=False, n_jobs=1):
+    """ Runs dual regression for all inputs and, if n_perm > 0, group-level
+    permutation inference per IC (n_perm=1: t-statistics only). If design is
+    None, a one-sample t-test is run. If preproc, the inputs are cleaned and
+    smoothed first (reading them through the masked-data cache in cache_dir,
+    if given). If save_subjects, the stage-2 maps and z-values of each subject
+    are also written to separate images. """
+    if not op.isdir(out_dir):
+        os.makedirs(out_dir)
+
+    mask, affine = load_mask(mask_file)
+    maps_img = nib.load(ica_maps)
+    maps = np.asarray(maps_img.dataobj, dtype=np.float32)[mask]  # voxels x ICs
+    n_ics, n_subs = maps.shape[1], len(inputs)
+
+    ic_files = [op.join(out_dir, f'dr_stage2_ic{ic:04d}.nii') for ic in range(n_ics)]
+    for f_ic in ic_files:
+        allocate_nifti(f_ic, mask.shape + (n_subs,), affine)
+
+    with open(op.join(out_dir, 'inputs.txt'), 'w') as f_out:
+        f_out.write('\n'.join(inputs) + '\n')
+
+    Parallel(n_jobs=n_jobs)(
+        delayed(_run_subject)(f, i, maps, mask_file, out_dir, ic_files, n_subs, des_norm, preproc, cache_dir,
+                              save_subjects)
+        for i, f in enumerate(tqdm(inputs))
+    )
+
+    if n_perm == 0:
+        return
+
+    for ic, f_ic in enumerate(ic_files):
+        permutation_inference.main(
+            f_ic, op.join(out_dir, f'dr_stage3_ic{ic:04d}'), mask_file, design, contrasts,
+            n_perm=n_perm, do_tfce=n_perm > 1, seed=0, n_jobs=n_jobs
+        )
+
+
+if __name__ == '__main__':
+
+    import argparse
+    parser = argparse.ArgumentParser(description='Dual regression')
+    parser.add_argument('ica_maps', type=str, help='4D image with group IC maps')
+    parser.add_argument('out_dir', type=str, help='Output directory')
+    parser.add_argument('mask', type=str, help='Mask image')
+    parser.add_argument('inputs', type=str, nargs='+', help='Preprocessed 4D images')
+    parser.add_argument('--des_norm', type=int, default=1, help='Variance-normalize stage-2 regressors (0/1)')
+    parser.add_argument('--design', type=str, default=None, help='Design matrix (design.mat); default: one-sample t-test')
+    parser.add_argument('--contrasts', type=str, default=None, help='Contrasts (design.con)')
+    parser.add_argument('--n_perm', type=int, default=5000, help='Number of permutations (0: no inference)')
+    parser.add_argument('--preproc', action='store_true', help='Clean and smooth (Fmriprep) inputs first')
+    parser.add_argument('--cache_dir', type=str, default=None, help='Masked-data cache (with --preproc)')
+    parser.add_argument('--save_subjects', action='store_true', help='Also write per-subject stage-2 images')
+    parser.add_argument('--n_jobs', type=int, default=1, help='Number of processes')
+    args = parser.parse_args()
+
+    main(args.ica_maps, op.abspath(args.out_dir), args.mask, args.inputs, des_norm=bool(args.des_norm),
+         design=args.design, contrasts=args.contrasts, n_perm=args.n_perm, preproc=args.preproc,
+         cache_dir=args.cache_dir, save_subjects=args.save_subjects, n_jobs=args.n_jobs)
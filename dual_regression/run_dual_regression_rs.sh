@@ -1,7 +1,7 @@
 set -e
-./dual_regression/dual_regression_customized \
+python ./dual_regression/run_dual_regression.py \
     ../derivatives/dual_regression_rs/data/PNAS_Smith09_rsn10_PIOP1.nii.gz \
-    1 -1 5000 \
     ../derivatives/dual_regression_rs \
     ../derivatives/dual_regression_rs/data/tpl-MNI152NLin2009cAsym_res-02_desc-brain_mask_PIOP1.nii.gz \
-    `ls ../derivatives/dual_regression_rs/preproc/*.nii.gz`
+    `ls ../derivatives/dual_regression_rs/preproc/*.nii.gz` \
+    --des_norm 1 --n_perm 5000 --n_jobs 10
@@ -1,13 +1,12 @@
-import sys
 import os
 import os.path as op
 import numpy as np
-import pandas as pd
 import nibabel as nib
 import seaborn as sns
 import matplotlib.pyplot as plt
 from glob import glob
 from tqdm import tqdm
+from eddy_qc import load_eddy_qc
 
 
 plt.style.use("dark_background")
@@ -65,19 +64,19 @@ def plot_DEC(evecs, fa, f_out, coords=(35, 45, 24)):
     plt.close()
 
 
-def plot_eddy_qc(eddy_qc, f_out):
+def plot_eddy_qc(eddy_qc, f_out, cache_dir=None):
 
+    qc = load_eddy_qc(eddy_qc, cache_dir=cache_dir)
     fig = plt.figure(constrained_layout=False, figsize=(15, 10))
     gs = fig.add_gridspec(nrows=4, ncols=3, left=0.1, right=0.9, wspace=0.05, hspace=1)
     
     ts_params = [
-        ('eddy_movement_rms', (0, 1)),
-        ('eddy_restricted_movement_rms', (0, 1)),
-        ('eddy_parameters', (-.5, .5))
+        ('eddy_movement_rms', qc.movement_rms, (0, 1)),
+        ('eddy_restricted_movement_rms', qc.restricted_movement_rms, (0, 1)),
+        ('eddy_parameters', qc.parameters, (-.5, .5))
     ]
 
-    for i, (name, ylim) in enumerate(ts_params):
-        dat = np.loadtxt(op.join(eddy_qc, name))
+    for i, (name, dat, ylim) in enumerate(ts_params):
         ax = fig.add_subplot(gs[i, :])
         ax.plot(dat)
         ax.set_xlim(0, dat.shape[0])
@@ -93,9 +92,12 @@ def plot_eddy_qc(eddy_qc, f_out):
         #    sub_base = op.basename(op.dirname(eddy_qc))
         #    ax.text(0, ylim[1] + 0.3 * ylim[1], sub_base, fontsize=20)
 
-    names = ['eddy_outlier_map', 'eddy_outlier_n_sqr_stdev_map', 'eddy_outlier_n_stdev_map']
-    for i, name in enumerate(names):
-        dat = np.loadtxt(op.join(eddy_qc, name), skiprows=1)
+    maps = [
+        ('eddy_outlier_map', qc.outlier_map),
+        ('eddy_outlier_n_sqr_stdev_map', qc.outlier_n_sqr_stdev_map),
+        ('eddy_outlier_n_stdev_map', qc.outlier_n_stdev_map)
+    ]
+    for i, (name, dat) in enumerate(maps):
         ax = fig.add_subplot(gs[len(ts_params), i])
         ax.imshow(dat, aspect='auto')
         ax.set_title(name, fontsize=13)
@@ -111,7 +113,7 @@ def plot_eddy_qc(eddy_qc, f_out):
     plt.close()
 
 
-def _parallel_proc(sub_dir):
+def _parallel_proc(sub_dir, cache_dir=None):
     sub_base = op.basename(sub_dir)
     d_out = op.join(sub_dir, 'figures')
     if not op.isdir(d_out):
@@ -125,18 +127,26 @@ def _parallel_proc(sub_dir):
 
     eddy_qc = op.join(sub_dir,  'eddy_qc')
     f_out = op.join(d_out, f'{sub_base}_desc-eddy_qcparams.png')
-    plot_eddy_qc(eddy_qc, f_out)
+    plot_eddy_qc(eddy_qc, f_out, cache_dir=cache_dir)
 
 
 if __name__ == '__main__':
+    import argparse
     from joblib import Parallel, delayed
 
-    bids_dir = sys.argv[1]
+    parser = argparse.ArgumentParser(description='Creates the DTI and eddy QC figures of each subject')
+    parser.add_argument('bids_dir', type=str, help='BIDS directory')
+    parser.add_argument('n_jobs', type=int, help='Number of processes')
+    parser.add_argument('--cache_dir', type=str, default=None, help='Cache directory of the parsed eddy QC files (optional)')
+    args = parser.parse_args()
+
+    bids_dir = args.bids_dir
     if not op.isdir(bids_dir):
         raise ValueError(f"{bids_dir} is not a directory!")
 
-    n_jobs = int(sys.argv[2])
+    n_jobs = args.n_jobs
 
     dwi_dir = f'{bids_dir}/derivatives/dwipreproc'
     sub_dirs = sorted(glob(op.join(dwi_dir, 'sub-*')))
-    Parallel(n_jobs=n_jobs)(delayed(_parallel_proc)(sub_dir) for sub_dir in tqdm(sub_dirs))
+    cache_dir = op.abspath(args.cache_dir) if args.cache_dir else None
+    Parallel(n_jobs=n_jobs)(delayed(_parallel_proc)(sub_dir, cache_dir) for sub_dir in tqdm(sub_dirs))
@@ -1,4 +1,3 @@
-import os
 import sys
 import os.path as op
 import numpy as np
@@ -7,56 +6,78 @@ from tqdm import tqdm
 from glob import glob
 from joblib import Parallel, delayed
 
+sys.path.insert(0, op.join(op.dirname(op.abspath(__file__)), '..', 'misc_qc'))
+from columnar import check_parquet, write_parquet
+from eddy_qc import load_eddy_qc, dwi_rows
 
-def _parallel_proc(sub_dir):
+
+def _parallel_proc(sub_dir, cache_dir=None):
     """ Computes mean FD, linear EC std, prop outliers per slice, prop outliers per volume """    
-    eddy_params = op.join(sub_dir, 'eddy_qc', 'eddy_parameters')
-    pars = np.loadtxt(eddy_params, skiprows=1)
+    qc = load_eddy_qc(op.join(sub_dir, 'eddy_qc'), cache_dir=cache_dir)
+    pars = qc.parameters[1:]  # without the first (b0) volume
     diff = pars[:-1, :6] - pars[1:, :6]
     diff[:, 3:6] *= 50
     fd_mean = np.abs(diff).sum(axis=1).mean()
 
     lin_ecs = pars[:, 6:9].std(axis=0)
     
-    outliers_file = op.join(sub_dir, 'eddy_qc', 'eddy_outlier_map')
-    outliers = np.loadtxt(outliers_file, skiprows=2)
-    if outliers.shape[0] > 33:
-        idx = np.ones(outliers.shape[0], dtype=bool)
-        idx[32] = False
-        if outliers.shape[0] > 65:
-            idx[64] = False
-        outliers = outliers[idx, :]
-    
+    outliers = qc.outlier_map[dwi_rows(qc.outlier_map.shape[0])]
     return fd_mean, lin_ecs, outliers.sum(), outliers.mean(axis=0) , outliers.mean(axis=1)
 
 
+def _to_frame(sub_names, out):
+    """ Assembles the group table from the per-subject results (of
+    _parallel_proc) in preallocated arrays. Subjects can have different
+    numbers of volumes (or slices); missing entries are NaN and the number
+    of (outlier-checked) volumes per subject is stored in n_volumes. """
+    n_subs = len(out)
+    n_vols = np.array([o[4].size for o in out], dtype=int)
+    n_slices = np.array([o[3].size for o in out], dtype=int)
+    ol_per_vol = np.full((n_subs, n_vols.max(initial=0)), np.nan)
+    ol_per_slice = np.full((n_subs, n_slices.max(initial=0)), np.nan)
+    for i, o in enumerate(out):
+        ol_per_slice[i, :n_slices[i]] = o[3]
+        ol_per_vol[i, :n_vols[i]] = o[4]
+
+    data = dict(
+        participant_id=sub_names,
+        FD_mean=np.array([o[0] for o in out], dtype=float),
+        total_outliers=np.array([o[2] for o in out], dtype=float),
+        n_volumes=n_vols
+    )
+    data.update({f'prop_outliers_vol{ii+1}': ol_per_vol[:, ii] for ii in range(ol_per_vol.shape[1])})
+    data.update({f'prop_outliers_slice{ii+1}': ol_per_slice[:, ii] for ii in range(ol_per_slice.shape[1])})
+    ecs = np.array([o[1] for o in out], dtype=float).reshape(n_subs, 3)
+    data.update({f'std_ec_{xyz}': ecs[:, ii] for ii, xyz in enumerate(['x', 'y', 'z'])})
+    return pd.DataFrame(data)
+
+
 if __name__ == '__main__':
 
-    bids_dir = sys.argv[1]
+    import argparse
+    parser = argparse.ArgumentParser(description='Creates the group-level DWI QC metrics file')
+    parser.add_argument('bids_dir', type=str, help='BIDS directory')
+    parser.add_argument('n_jobs', type=int, help='Number of processes')
+    parser.add_argument('--parquet', action='store_true', help='Also write group_dwi.parquet (requires pyarrow)')
+    parser.add_argument('--cache_dir', type=str, default=None, help='Cache directory of the parsed eddy QC files (optional)')
+    args = parser.parse_args()
+
+    bids_dir = args.bids_dir
     if not op.isdir(bids_dir):
         raise ValueError(f"{bids_dir} is not a directory!")
 
-    n_jobs = int(sys.argv[2])
+    n_jobs = args.n_jobs
+    if args.parquet:
+        check_parquet()
 
     dwipreproc_dir = op.join(bids_dir, 'derivatives', 'dwipreproc')
     sub_dirs = sorted(glob(op.join(dwipreproc_dir, 'sub-*')))
     sub_dirs = [sd for sd in sub_dirs if op.isdir(op.join(sd, 'eddy_qc'))]
-    out = Parallel(n_jobs=n_jobs)(delayed(_parallel_proc)(sub_dir) for sub_dir in tqdm(sub_dirs))
+    cache_dir = op.abspath(args.cache_dir) if args.cache_dir else None
+    out = Parallel(n_jobs=n_jobs)(delayed(_parallel_proc)(sub_dir, cache_dir) for sub_dir in tqdm(sub_dirs))
      
-    df = pd.DataFrame()
-    for i, (fd_mean, ecs, ols, ol_per_slice, ol_per_vol) in enumerate(out):
-        sub_name = op.basename(sub_dirs[i])
-        df.loc[i, 'participant_id'] = sub_name
-        df.loc[i, 'FD_mean'] = fd_mean
-        df.loc[i, 'total_outliers'] = ols
-        for ii, ol in enumerate(ol_per_vol):
-            df.loc[i, f'prop_outliers_vol{ii+1}'] = ol
-
-        for ii, ol in enumerate(ol_per_slice):
-            df.loc[i, f'prop_outliers_slice{ii+1}'] = ol
-
-        for ii, xyz in enumerate(['x', 'y', 'z']):
-            df.loc[i, f'std_ec_{xyz}'] = ecs[ii]
-
+    df = _to_frame([op.basename(sd) for sd in sub_dirs], out)
     df.to_csv(op.join(dwipreproc_dir, 'group_dwi.tsv'), sep='\t')
+    if args.parquet:
+        write_parquet(df, op.join(dwipreproc_dir, 'group_dwi.parquet'))
     
@@ -0,0 +1,83 @@
+""" Reader of the (text) eddy QC outputs of a subject, shared by the QC metrics
+and figures scripts. The files are parsed once and cached as a compressed
+.npz file per subject (invalidated when any of the files' mtimes change). """
+import os
+import numpy as np
+import pandas as pd
+import os.path as op
+from collections import namedtuple
+
+# Field -> (file name, number of header lines, dtype)
+FILES = dict(
+    parameters=('eddy_parameters', 0, np.float64),
+    movement_rms=('eddy_movement_rms', 0, np.float64),
+    restricted_movement_rms=('eddy_restricted_movement_rms', 0, np.float64),
+    outlier_map=('eddy_outlier_map', 1, np.uint8),
+    outlier_n_sqr_stdev_map=('eddy_outlier_n_sqr_stdev_map', 1, np.float32),
+    outlier_n_stdev_map=('eddy_outlier_n_stdev_map', 1, np.float32)
+)
+
+EddyQC = namedtuple('EddyQC', list(FILES))
+
+
+def _read_matrix(f, skiprows, dtype):
+    """ Reads a whitespace-delimited matrix. """
+    df = pd.read_csv(f, sep=r'\s+', header=None, skiprows=skiprows)
+    return df.to_numpy().astype(dtype)
+
+
+def dwi_rows(n_vols):
+    """ Returns a boolean array of the volumes (rows of the outlier map) of a
+    run with n_vols volumes that are used for the QC metrics. This is the
+    original selection of create_QC_metrics_file.py: without the first volume
+    and, in longer runs, volumes 33 and 65 (note: not 66). It is kept as is,
+    so that the values in group_dwi.tsv do not change. """
+    keep = np.ones(n_vols, dtype=bool)
+    keep[:1] = False
+    if n_vols > 34:
+        keep[33] = False
+    if n_vols > 66:
+        keep[65] = False
+    return keep
+
+
+def load_eddy_qc(eddy_qc_dir, cache_dir=None):
+    """ Loads the eddy QC outputs of a subject.
+
+    Parameters
+    ----------
+    eddy_qc_dir : str
+        Path to the eddy_qc directory of a subject.
+    cache_dir : str
+        Directory with cached .npz files (one per subject); if None, the
+        files are always parsed.
+
+    Returns
+    -------
+    qc : EddyQC
+        Record with one array per file (None if the file does not exist).
+    """
+    paths = {field: op.join(eddy_qc_dir, fname) for field, (fname, _, _) in FILES.items()}
+    mtimes = np.array([os.stat(p).st_mtime_ns if op.isfile(p) else -1 for p in paths.values()])
+
+    f_cache = None
+    if cache_dir is not None:
+        sub_base = op.basename(op.dirname(op.abspath(eddy_qc_dir)))
+        f_cache = op.join(cache_dir, f'{sub_base}.npz')
+        if op.isfile(f_cache):
+            with np.load(f_cache) as cached:
+                if np.array_equal(cached['mtimes'], mtimes):
+                    return EddyQC(**{field: cached[field] if field in cached else None for field in FILES})
+
+    data = {}
+    for field, (_, skiprows, dtype) in FILES.items():
+        if op.isfile(paths[field]):
+            data[field] = _read_matrix(paths[field], skiprows, dtype)
+
+    if f_cache is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp = f'{f_cache}.{os.getpid()}.tmp.npz'
+        np.savez_compressed(tmp, mtimes=mtimes, **data)
+        os.replace(tmp, f_cache)
+
+    return EddyQC(**{field: data.get(field) for field in FILES})
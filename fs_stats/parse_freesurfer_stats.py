@@ -0,0 +1,144 @@
+""" Parses the Freesurfer stats files (aseg.stats, wmparc.stats and
+?h.aparc(.a2009s).stats) of all subjects, as a replacement for asegstats2table
+and aparcstats2table (which need Python 2). Each stats file is read once (and
+subjects are parsed in parallel), after which both the group tables (same
+format and file names as create_freesurfer_tables.sh used to produce) and the
+per-subject tables (see postprocess_freesurfer_tables.py) are written. """
+import os
+import sys
+import os.path as op
+import pandas as pd
+from glob import glob
+from tqdm import tqdm
+from joblib import Parallel, delayed
+from postprocess_freesurfer_tables import write_subject_tables
+
+sys.path.insert(0, op.join(op.dirname(op.abspath(__file__)), '..', 'misc_qc'))
+from columnar import check_parquet
+
+# Measure -> column of the stats file
+SUBCORTICAL_COLS = {'volume': 'Volume_mm3', 'mean': 'normMean'}
+CORTICAL_COLS = {'volume': 'GrayVol', 'thickness': 'ThickAvg', 'area': 'SurfArea', 'meancurv': 'MeanCurv'}
+
+# Global measures added to the cortical tables (like aparcstats2table)
+CORTICAL_EXTRA = {
+    'volume': [('BrainSegVolNotVent', 'BrainSegVolNotVent'), ('eTIV', 'eTIV')],
+    'thickness': [('MeanThickness', '{hemi}_MeanThickness_thickness')],
+    'area': [('WhiteSurfArea', '{hemi}_WhiteSurfArea_area')]
+}
+
+
+def read_stats(f):
+    """ Reads a Freesurfer stats file.
+
+    Parameters
+    ----------
+    f : str
+        Path to stats file.
+
+    Returns
+    -------
+    measures : dict
+        Global measures (from the '# Measure' lines), by short name.
+    df : pd.DataFrame
+        Table of structures (from the '# ColHeaders' line and data lines).
+    """
+    measures, header, rows = {}, None, []
+    with open(f, 'r') as f_in:
+        for line in f_in:
+            if line.startswith('# Measure'):
+                parts = [p.strip() for p in line[len('# Measure'):].split(',')]
+                measures[parts[1]] = float(parts[3])
+            elif line.startswith('# ColHeaders'):
+                header = line.split()[2:]
+            elif line.strip() and not line.startswith('#'):
+                rows.append(line.split())
+
+    df = pd.DataFrame(rows, columns=header)
+    for col in df.columns:
+        if col != 'StructName':
+            df[col] = pd.to_numeric(df[col])
+
+    return measures, df
+
+
+def _parse_sub(fs_dir, sub):
+    """ Parses all stats files of a subject and returns its row (pd.Series,
+    region -> value) of each group table (by file name). """
+    rows = {}
+    stats_dir = op.join(fs_dir, sub, 'stats')
+    for atlas in ('aseg', 'wmparc'):
+        f = op.join(stats_dir, f'{atlas}.stats')
+        if not op.isfile(f):
+            print(f"WARNING: {f} does not exist!")
+            continue
+
+        measures, df = read_stats(f)
+        for measure, col in SUBCORTICAL_COLS.items():
+            row = pd.Series(df[col].to_numpy(), index=df['StructName'])
+            if measure == 'volume':
+                row = pd.concat((row, pd.Series(measures)))
+            rows[f'data-subcortical_type-{atlas}_measure-{measure}_hemi-both.tsv'] = row
+
+    for parc in ('aparc', 'aparc.a2009s'):
+        for hemi in ('lh', 'rh'):
+            f = op.join(stats_dir, f'{hemi}.{parc}.stats')
+            if not op.isfile(f):
+                print(f"WARNING: {f} does not exist!")
+                continue
+
+            measures, df = read_stats(f)
+            for measure, col in CORTICAL_COLS.items():
+                index = hemi + '_' + df['StructName'] + f'_{measure}'
+                row = pd.Series(df[col].to_numpy(), index=index)
+                extra = {name.format(hemi=hemi): measures[key] for key, name in CORTICAL_EXTRA.get(measure, [])
+                         if key in measures}
+                rows[f'data-cortical_type-{parc}_measure-{measure}_hemi-{hemi}.tsv'] = pd.concat((row, pd.Series(extra, dtype=float)))
+
+    return rows
+
+
+def _index_name(fname):
+    """ Returns the name of the first column of a group table, like
+    asegstats2table/aparcstats2table. """
+    ents = dict(part.split('-', 1) for part in fname.split('.tsv')[0].split('_'))
+    if ents['data'] == 'subcortical':
+        return f"Measure:{ents['measure']}"
+
+    return f"{ents['hemi']}.{ents['type']}.{ents['measure']}"
+
+
+def main(fs_dir, n_jobs=1, parquet=False):
+    """ Writes the group tables and per-subject tables of all subjects in fs_dir
+    (and, if parquet, a Parquet dataset with all measures). """
+    if parquet:
+        check_parquet()
+
+    subs = [op.basename(d) for d in sorted(glob(f'{fs_dir}/sub-*'))]
+    fss_dir = op.join(op.dirname(fs_dir), 'fs_stats')
+    if not op.isdir(fss_dir):
+        os.makedirs(fss_dir)
+
+    results = Parallel(n_jobs=n_jobs)(delayed(_parse_sub)(fs_dir, sub) for sub in tqdm(subs, desc='parsing'))
+
+    tables = {}
+    for fname in sorted(set(fname for rows in results for fname in rows)):
+        df = pd.DataFrame.from_dict(
+            {sub: rows[fname] for sub, rows in zip(subs, results) if fname in rows}, orient='index'
+        )
+        df.index.name = _index_name(fname)
+        df.to_csv(op.join(fss_dir, fname), sep='\t')
+        tables[fname] = df
+
+    write_subject_tables(fss_dir, subs, tables, n_jobs=n_jobs, parquet=parquet)
+
+
+if __name__ == '__main__':
+
+    import argparse
+    parser = argparse.ArgumentParser(description='Parses Freesurfer stats files into group and per-subject tables')
+    parser.add_argument('fs_dir', type=str, help='Freesurfer directory')
+    parser.add_argument('--n_jobs', type=int, default=8, help='Number of processes')
+    parser.add_argument('--parquet', action='store_true', help='Also write a Parquet dataset (requires pyarrow)')
+    args = parser.parse_args()
+    main(args.fs_dir, n_jobs=args.n_jobs, parquet=args.parquet)
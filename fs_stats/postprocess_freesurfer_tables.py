@@ -1,13 +1,18 @@
-""" Disclaimer: this is possibly the ugliest code I've ever written.
-It works, that's it. Please don't use it for your own analyses. 
-"""
-import sys
+""" Reshapes the group-level Freesurfer tables (from create_freesurfer_tables.sh;
+one table per atlas, measure and hemisphere) into one table per subject and
+atlas (with one row per region and one column per measure). Each group table
+is read and reshaped once; the per-subject files are written in parallel. """
 import os
+import sys
 import json
 import os.path as op
 import pandas as pd
 from glob import glob
 from tqdm import tqdm
+from joblib import Parallel, delayed
+
+sys.path.insert(0, op.join(op.dirname(op.abspath(__file__)), '..', 'misc_qc'))
+from columnar import check_parquet, write_parquet
 
 pd.set_option('display.float_format', lambda x: '%.3f' % x)
 
@@ -27,9 +32,6 @@ hemi2word = {
     'lh': 'Left'
 }
 
-fs_dir = sys.argv[1]
-subs = [op.basename(d) for d in sorted(glob(f'{fs_dir}/sub-*'))]
-
 json_file = {
     "cortical": {
         "name": {
@@ -66,75 +68,123 @@ json_file = {
         }
     }
 }
-fss_dir = op.join(op.dirname(fs_dir), 'fs_stats')
-for atlas in fsname2atlas['cortical'].keys():
+CORTICAL_MEASURES = ('volume', 'thickness', 'area', 'meancurv')
+SUBCORTICAL_MEASURES = ('mean', 'volume')
 
-    for sub in tqdm(subs, desc=atlas):
-        dfs = []
-        for hemi in ('lh', 'rh'):
-            i = 0
-            for measure in ['volume', 'thickness', 'area', 'meancurv']:
-                f = f'{fss_dir}/data-cortical_type-{atlas}_measure-{measure}_hemi-{hemi}.tsv'
-                df = pd.read_csv(f, sep='\t', index_col=0)
-                df.index = df.index.rename('participant_id')
-                df = df.reset_index()
-                df = df.loc[:, [col for col in df.columns if 'Mean' not in col]]
-                df = pd.melt(df, id_vars=['participant_id'], value_name=measure, var_name='name')
-                df['name'] = [n.replace(f'_{measure}', '') for n in df['name']]
-                df['name'] = [hemi2word[n.split('_')[0]] + '-' + '_'.join(n.split('_')[1:]) if 'rh' in n or 'lh' in n else n
-                            for n in df['name']]
-                df = df.query("participant_id == @sub")
-                dfs.append(df)
-                
-        df = pd.concat(dfs, axis=1)
-        df = df.loc[:, ~df.columns.duplicated()].dropna()        
-        d_out = f'{fss_dir}/{sub}'
-        if not op.isdir(d_out):
-            os.makedirs(d_out)
-
-        f_out = op.join(d_out, f"{sub}_desc-{fsname2atlas['cortical'][atlas]}_stats.tsv")
-        df.drop('participant_id', axis=1).to_csv(f_out, sep='\t', index=False)
-        f_out = f_out.replace('tsv', 'json')
-        with open(f_out, 'w') as json_out:
-            json.dump(json_file['cortical'], json_out, indent=4)
-
-
-for atlas in fsname2atlas['subcortical'].keys():
-
-    for sub in tqdm(subs, desc=atlas):
+
+def _read_table(f, measure, tables=None):
+    """ Reads a group table (subjects x regions) in long format, with columns
+    participant_id, name and the measure. If tables (dict with file name ->
+    wide table) contains the table, it is not read from disk. """
+    if tables is not None and op.basename(f) in tables:
+        df = tables[op.basename(f)].copy()
+    else:
+        df = pd.read_csv(f, sep='\t', index_col=0)
+
+    df.index = df.index.rename('participant_id')
+    df = df.loc[:, [col for col in df.columns if 'Mean' not in col]]
+    return df.reset_index().melt(id_vars=['participant_id'], value_name=measure, var_name='name')
+
+
+def _merge(dfs):
+    """ Merges long-format tables of different measures (keeping only the
+    regions with all measures). """
+    df = dfs[0]
+    for other in dfs[1:]:
+        df = df.merge(other, on=['participant_id', 'name'], how='inner')
+
+    return df.dropna()
+
+
+def reshape_cortical(fss_dir, atlas, tables=None):
+    """ Returns the cortical measures of all subjects in long format (left
+    hemisphere regions, then right hemisphere regions). """
+    hemis = []
+    for hemi in ('lh', 'rh'):
         dfs = []
-        for hemi in ('lh', 'rh'):
-            i = 0
-            for measure in ['mean', 'volume']:
-                f = f'{fss_dir}/data-subcortical_type-{atlas}_measure-{measure}_hemi-both.tsv'
-                df = pd.read_csv(f, sep='\t', index_col=0)
-                df.index = df.index.rename('participant_id')
-                df = df.reset_index()
-                df = df.loc[:, [col for col in df.columns if 'Mean' not in col]]
-                df = pd.melt(df, id_vars=['participant_id'], value_name=measure, var_name='name')
-                new_names = []
-                for n in df['name']:
-                    if '-lh-' in n:
-                        new_names.append('Left-' + n.replace('lh-', ''))
-                    elif '-rh-' in n:
-                        new_names.append('Right-' + n.replace('rh-', ''))
-                    else:
-                        new_names.append(n)
-                df['name'] = new_names
-                if measure == 'mean':
-                    df = df.rename({measure: 'intensity-avg'}, axis=1)
-
-                df = df.query("participant_id == @sub")
-                dfs.append(df)
-                
-        df = pd.concat(dfs, axis=1)
-        df = df.loc[:, ~df.columns.duplicated()].dropna()        
-        d_out = f'{fss_dir}/{sub}'
-        if not op.isdir(d_out):
-            os.makedirs(d_out)
-
-        f_out = op.join(d_out, f"{sub}_desc-{fsname2atlas['subcortical'][atlas]}_stats.tsv")
-        df.drop('participant_id', axis=1).to_csv(f_out, sep='\t', index=False)
-        f_out = f_out.replace('tsv', 'json')
-        with open(f_out, 'w') as json_out:
-            json.dump(json_file['subcortical'], json_out, indent=4)
+        for measure in CORTICAL_MEASURES:
+            df = _read_table(f'{fss_dir}/data-cortical_type-{atlas}_measure-{measure}_hemi-{hemi}.tsv', measure, tables)
+            name = df['name'].str.replace(f'_{measure}', '', regex=False)
+            parts = name.str.split('_', n=1)
+            is_hemi = name.str.contains('rh', regex=False) | name.str.contains('lh', regex=False)
+            df['name'] = name.where(~is_hemi, parts.str[0].map(hemi2word) + '-' + parts.str[1].fillna(''))
+            dfs.append(df)
+
+        hemis.append(_merge(dfs))
+
+    return pd.concat(hemis, axis=0, ignore_index=True)
+
+
+def reshape_subcortical(fss_dir, atlas, tables=None):
+    """ Returns the subcortical measures of all subjects in long format. """
+    dfs = []
+    for measure in SUBCORTICAL_MEASURES:
+        df = _read_table(f'{fss_dir}/data-subcortical_type-{atlas}_measure-{measure}_hemi-both.tsv', measure, tables)
+        name = df['name']
+        name = name.where(~name.str.contains('-lh-', regex=False), 'Left-' + name.str.replace('lh-', '', regex=False))
+        name = name.where(~name.str.contains('-rh-', regex=False), 'Right-' + name.str.replace('rh-', '', regex=False))
+        df['name'] = name
+        if measure == 'mean':
+            df = df.rename({measure: 'intensity-avg'}, axis=1)
+
+        dfs.append(df)
+
+    return _merge(dfs)
+
+
+def _write_sub(df, f_out, json_info):
+    """ Writes the table (and json sidecar) of a single subject. """
+    d_out = op.dirname(f_out)
+    if not op.isdir(d_out):
+        os.makedirs(d_out, exist_ok=True)
+
+    df.drop('participant_id', axis=1).to_csv(f_out, sep='\t', index=False)
+    with open(f_out.replace('tsv', 'json'), 'w') as json_out:
+        json.dump(json_info, json_out, indent=4)
+
+
+def write_subject_tables(fss_dir, subs, tables=None, n_jobs=1, parquet=False):
+    """ Writes the per-subject tables of all atlases from the group tables
+    (in fss_dir or, if given, in tables). If parquet, all measures are also
+    written to a single long-format Parquet dataset (group_stats.parquet),
+    partitioned by atlas and measure. """
+    if parquet:
+        check_parquet()
+
+    longs = []
+    for kind, reshape in (('cortical', reshape_cortical), ('subcortical', reshape_subcortical)):
+        for atlas, name in fsname2atlas[kind].items():
+            df = reshape(fss_dir, atlas, tables)
+            groups = dict(tuple(df.groupby('participant_id', sort=False)))
+            Parallel(n_jobs=n_jobs, prefer='threads')(
+                delayed(_write_sub)(
+                    groups.get(sub, df.iloc[:0]), f'{fss_dir}/{sub}/{sub}_desc-{name}_stats.tsv', json_file[kind]
+                ) for sub in tqdm(subs, desc=atlas)
+            )
+            if parquet:
+                df = df.melt(id_vars=['participant_id', 'name'], var_name='measure', value_name='value')
+                df.insert(1, 'atlas', name)
+                longs.append(df)
+
+    if parquet:
+        df = pd.concat(longs, axis=0, ignore_index=True)
+        df['value'] = df['value'].astype(float)
+        write_parquet(df, op.join(fss_dir, 'group_stats.parquet'), partition_cols=['atlas', 'measure'])
+
+
+def main(fs_dir, n_jobs=1, parquet=False):
+    """ Writes the per-subject tables of all atlases. """
+    subs = [op.basename(d) for d in sorted(glob(f'{fs_dir}/sub-*'))]
+    fss_dir = op.join(op.dirname(fs_dir), 'fs_stats')
+    write_subject_tables(fss_dir, subs, n_jobs=n_jobs, parquet=parquet)
+
+
+if __name__ == '__main__':
+
+    import argparse
+    parser = argparse.ArgumentParser(description='Reshapes Freesurfer group tables into per-subject tables')
+    parser.add_argument('fs_dir', type=str, help='Freesurfer directory')
+    parser.add_argument('--n_jobs', type=int, default=8, help='Number of threads for writing')
+    parser.add_argument('--parquet', action='store_true', help='Also write a Parquet dataset (requires pyarrow)')
+    args = parser.parse_args()
+    main(args.fs_dir, n_jobs=args.n_jobs, parquet=args.parquet)
@@ -0,0 +1,218 @@
+""" Indexed layout of a BIDS dataset (including derivatives), shared by the
+QC and modeling scripts, so that the dataset only has to be listed once.
+
+The index is built with os.scandir and persisted to disk (by default in the
+user's cache directory, so nothing is written into the dataset itself; see
+default_cache_file). On subsequent loads, only directories whose
+mtime changed are listed again. Each file (and directory) is a row in a
+table with its (relative) path, pipeline, datatype and BIDS entities.
+"""
+import os
+import re
+import pickle
+import hashlib
+import numpy as np
+import pandas as pd
+import os.path as op
+
+
+ENTITIES = (
+    'sub', 'ses', 'task', 'acq', 'ce', 'rec', 'dir', 'run', 'mod', 'echo', 'recording',
+    'space', 'res', 'model', 'label', 'desc', 'hemi'
+)
+COLUMNS = ('path', 'dirname', 'filename', 'is_dir', 'pipeline', 'datatype') + ENTITIES + ('suffix', 'extension')
+CACHE_VERSION = 1
+
+
+def parse_filename(fname):
+    """ Parses the BIDS entities, suffix and extension from a file name. """
+    stem, dot, ext = fname.partition('.')
+    ents = {}
+    suffix = None
+    for part in stem.split('_'):
+        key, dash, value = part.partition('-')
+        if dash:
+            ents[key] = value
+        else:
+            suffix = part
+
+    return ents, suffix, dot + ext if dot else None
+
+
+def _parse_dir(rel, files, subdirs):
+    """ Returns the index rows (tuples) of all entries of a directory. """
+    parts = rel.split('/') if rel else []
+    pipeline = parts[1] if len(parts) > 1 and parts[0] == 'derivatives' else 'bids'
+    datatype = None
+    if parts and not parts[-1].startswith(('sub-', 'ses-')) and any(p.startswith('sub-') for p in parts):
+        datatype = parts[-1]
+
+    rows = []
+    for is_dir, names in ((False, files), (True, subdirs)):
+        for name in names:
+            ents, suffix, ext = parse_filename(name)
+            rows.append(
+                (op.join(rel, name) if rel else name, rel, name, is_dir, pipeline, datatype)
+                + tuple(ents.get(ent) for ent in ENTITIES) + (suffix, ext)
+            )
+
+    return rows
+
+
+def _scan(bids_dir, cached):
+    """ Walks bids_dir (skipping hidden files) and returns a dict with, per directory,
+    its mtime, files, subdirectories and parsed rows. Directories with an unchanged
+    mtime (i.e., unchanged entries) are taken from the cache. """
+    dirs = {}
+    stack = ['']
+    while stack:
+        rel = stack.pop()
+        full = op.join(bids_dir, rel)
+        mtime = os.stat(full).st_mtime_ns
+        entry = cached.get(rel)
+        if entry is None or entry[0] != mtime:
+            files, subdirs = [], []
+            with os.scandir(full) as it:
+                for e in it:
+                    if e.name.startswith('.'):
+                        continue
+                    (subdirs if e.is_dir() else files).append(e.name)
+
+            files, subdirs = sorted(files), sorted(subdirs)
+            entry = (mtime, files, subdirs, _parse_dir(rel, files, subdirs))
+
+        dirs[rel] = entry
+        stack.extend(op.join(rel, d) if rel else d for d in entry[2])
+
+    return dirs
+
+
+def default_cache_file(bids_dir):
+    """ Returns the default file to persist the index of bids_dir in:
+    $XDG_CACHE_HOME/aomic/bidsindex/<hash of bids_dir>.pkl (with
+    $XDG_CACHE_HOME defaulting to ~/.cache). """
+    cache_dir = os.environ.get('XDG_CACHE_HOME') or op.join(op.expanduser('~'), '.cache')
+    key = hashlib.sha1(op.abspath(bids_dir).encode()).hexdigest()[:16]
+    return op.join(cache_dir, 'aomic', 'bidsindex', f'{key}.pkl')
+
+
+def load_index(bids_dir, cache_file='default'):
+    """ Loads the index of bids_dir, refreshing it where the dataset changed.
+
+    Parameters
+    ----------
+    bids_dir : str
+        Path to BIDS directory.
+    cache_file : str
+        File to persist the index in. If 'default', default_cache_file(bids_dir)
+        is used; if None, the index is not persisted.
+
+    Returns
+    -------
+    index : DataFrame
+        Table with one row per file/directory (see COLUMNS); bids_dir is stored
+        in index.attrs['root'].
+    """
+    bids_dir = op.abspath(bids_dir)
+    if cache_file == 'default':
+        cache_file = default_cache_file(bids_dir)
+
+    cached = {}
+    if cache_file is not None and op.isfile(cache_file):
+        with open(cache_file, 'rb') as f_in:
+            cache = pickle.load(f_in)
+
+        if cache.get('version') == CACHE_VERSION:
+            cached = cache['dirs']
+
+    dirs = _scan(bids_dir, cached)
+    if cache_file is not None and dirs != cached:
+        tmp = f'{cache_file}.{os.getpid()}.tmp'
+        try:
+            os.makedirs(op.dirname(cache_file), exist_ok=True)
+            with open(tmp, 'wb') as f_out:
+                pickle.dump(dict(version=CACHE_VERSION, dirs=dirs), f_out, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, cache_file)
+        except OSError:  # e.g., read-only dataset
+            print(f"WARNING: could not write index to {cache_file}")
+
+    rows = [row for rel in sorted(dirs) for row in dirs[rel][3]]
+    # Sorted by path, so that index_glob can look up prefixes with a binary search
+    index = pd.DataFrame.from_records(rows, columns=COLUMNS).sort_values('path', ignore_index=True)
+    index.attrs['root'] = bids_dir
+    return index
+
+
+def _glob_to_regex(pattern):
+    """ Translates a glob pattern (with recursive '**') into a regex. """
+    out, i = [], 0
+    while i < len(pattern):
+        if pattern.startswith('**/', i):
+            out.append('(?:[^/.][^/]*/)*')
+            i += 3
+        elif pattern.startswith('**', i):
+            out.append('(?:[^/.][^/]*(?:/[^/.][^/]*)*)?')
+            i += 2
+        elif pattern[i] == '*':
+            out.append('[^/]*')
+            i += 1
+        elif pattern[i] == '?':
+            out.append('[^/]')
+            i += 1
+        elif pattern[i] == '[' and ']' in pattern[i + 1:]:
+            end = pattern.index(']', i + 1)
+            chars = pattern[i + 1:end]
+            if chars.startswith('!'):
+                chars = '^' + chars[1:]
+            out.append(f'[{chars}]')
+            i = end + 1
+        else:
+            out.append(re.escape(pattern[i]))
+            i += 1
+
+    return ''.join(out) + r'\Z'
+
+
+def index_glob(index, pattern):
+    """ Drop-in replacement of glob.glob(pattern, recursive=True) that
+    queries the index instead of the filesystem. As with glob, relative
+    patterns are relative to the working directory.
+
+    Returns
+    -------
+    files : list
+        Sorted list of absolute paths.
+    """
+    root = index.attrs['root']
+    pattern = op.relpath(op.abspath(pattern), root).replace(os.sep, '/')
+
+    # Only match rows starting with the literal part of the pattern
+    prefix = re.split(r'[*?\[]', pattern, maxsplit=1)[0]
+    paths = index['path']
+    start = paths.searchsorted(prefix, side='left')
+    stop = paths.searchsorted(prefix + '\U0010ffff', side='left')
+    paths = paths.iloc[start:stop]
+
+    idx = paths.str.match(_glob_to_regex(pattern)).to_numpy(dtype=bool)
+    return sorted(op.join(root, p) for p in paths.to_numpy()[idx])
+
+
+def query(index, **filters):
+    """ Selects rows of the index. Each filter (a column name) can be a single
+    value, a list/tuple of values, or True/False to select rows for which the
+    column is (not) defined.
+
+    Examples
+    --------
+    >>> query(index, pipeline='fmriprep', task='rest', suffix='bold', extension='.nii.gz')
+    """
+    idx = np.ones(index.shape[0], dtype=bool)
+    for col, value in filters.items():
+        if value is True or value is False:
+            idx &= index[col].notna().to_numpy() == value
+        elif isinstance(value, (list, tuple)):
+            idx &= index[col].isin(value).to_numpy()
+        else:
+            idx &= (index[col] == value).to_numpy()
+
+    return index.loc[idx, :]
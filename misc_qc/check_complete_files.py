@@ -1,256 +1,313 @@
 import os.path as op
+import itertools
 import pandas as pd
-from glob import glob
+from joblib import Parallel, delayed
+from bids_index import load_index, index_glob
+from nifti_header import get_shape
 
-def main(bids_dir, spaces=None):
+DERIVS = ('freesurfer', 'fmriprep', 'physiology', 'vbm', 'dti_fa', 'mriqc', 'dwipreproc')
+FS_SURFS = ('inflated', 'midthickness', 'pial', 'smoothwm')
+ANAT_EXTS = (
+    'desc-brain_mask.json', 'desc-brain_mask.nii.gz',
+    'desc-preproc_T1w.json', 'desc-preproc_T1w.nii.gz',
+    'dseg.nii.gz', 'label-CSF_probseg.nii.gz', 'label-GM_probseg.nii.gz',
+    'label-WM_probseg.nii.gz'
+)
+FUNC_EXTS = (
+    'boldref.nii.gz',
+    'desc-aparcaseg_dseg.nii.gz',
+    'desc-aseg_dseg.nii.gz',
+    'desc-brain_mask.json',
+    'desc-brain_mask.nii.gz',
+    'desc-preproc_bold.json',
+    'desc-preproc_bold.nii.gz'
+)
+RICOR_COLS = ('cardiac_cos_00', 'resp_cos_00', 'interaction_add_cos_00', 'hrv', 'rvt')
+CHUNK_SIZE = 1024 ** 2
 
+
+def _get_rules(spaces):
+    """ Returns the rules that define which files should exist. Each rule
+    has a trigger (glob relative to the BIDS dir) and one or more expected
+    files/directories (templates), which are filled in with the subject
+    label ({sub}), the trigger's name without the `strip` suffix ({base}),
+    and every combination of the other fields. Optional keys are `requires`
+    (the rule only applies if this path exists), `dirs_only` (only trigger on
+    directories) and `unless` (skip triggers containing any of these strings). """
+    vol_spaces = tuple(s for s in spaces if 'fsaverage' not in s)
+    anat_spaces = ('',) + tuple(f'space-{s}_' for s in vol_spaces if 'T1w' not in s)
+    surf_spaces = tuple(s for s in spaces if 'fsaverage' in s)
+    fprep = 'derivatives/fmriprep/{sub}'
+    rules = [
+        # Anatomical data and derivatives
+        dict(pipeline='bids', trigger='sub-*', dirs_only=True, expect='{sub}/anat'),
+        dict(pipeline='fmriprep', trigger='sub-*/anat/*.nii.gz', expect=fprep + '/anat'),
+        dict(pipeline='fmriprep', trigger='sub-*/anat/*.nii.gz', requires=fprep + '/anat',
+             expect=fprep + '/anat/{sub}_hemi-{hemi}_{surf}.surf.gii', hemi=('R', 'L'), surf=FS_SURFS),
+        dict(pipeline='fmriprep', trigger='sub-*/anat/*.nii.gz', requires=fprep + '/anat',
+             expect=fprep + '/anat/{sub}_{seg}.nii.gz', seg=('desc-aparcaseg_dseg', 'desc-aseg_dseg')),
+        dict(pipeline='fmriprep', trigger='sub-*/anat/*.nii.gz', requires=fprep + '/anat',
+             expect=fprep + '/anat/{sub}_{space}{ext}', space=anat_spaces, ext=ANAT_EXTS),
+        dict(pipeline='freesurfer', trigger='sub-*/anat/*.nii.gz',
+             expect='derivatives/freesurfer/{sub}/scripts/recon-all.done'),
+        dict(pipeline='vbm', trigger='sub-*/anat/*.nii.gz', requires='derivatives/vbm',
+             expect=('derivatives/vbm/{sub}', 'derivatives/vbm/{sub}/{sub}_desc-VBM_GMvolume.nii.gz')),
+        dict(pipeline='mriqc', trigger='sub-*/anat/*.nii.gz', strip='.nii.gz', requires='derivatives/mriqc',
+             expect=('derivatives/mriqc/{base}.html', 'derivatives/mriqc/{sub}/anat/{base}.json')),
+        # Diffusion data and derivatives
+        dict(pipeline='bids', trigger='sub-*/dwi/*.nii.gz', strip='.nii.gz',
+             expect='{sub}/dwi/{base}.{ext}', ext=('bval', 'bvec')),
+        dict(pipeline='dwipreproc', trigger='sub-*/dwi/*.nii.gz', requires='derivatives/dwipreproc/{sub}',
+             expect='derivatives/dwipreproc/{sub}/dwi/{sub}_{mod}.nii.gz',
+             mod=('desc-brain_mask', 'model-DTI_desc-WLS_FA', 'model-DTI_desc-WLS_EVECS')),
+        # Functional data and derivatives
+        dict(pipeline='bids', trigger='sub-*/func/*_bold.nii.gz', strip='_bold.nii.gz',
+             unless=('resting', 'movie'), expect='{sub}/func/{base}_events.tsv'),
+        dict(pipeline='mriqc', trigger='sub-*/func/*_bold.nii.gz', strip='_bold.nii.gz', requires='derivatives/mriqc',
+             expect=('derivatives/mriqc/{base}_bold.html', 'derivatives/mriqc/{sub}/func/{base}_bold.json')),
+        dict(pipeline='fmriprep', trigger='sub-*/func/*_bold.nii.gz', strip='_bold.nii.gz',
+             requires='derivatives/fmriprep', expect='derivatives/fmriprep/{sub}.html'),
+        dict(pipeline='fmriprep', trigger='sub-*/func/*_bold.nii.gz', strip='_bold.nii.gz',
+             requires='derivatives/fmriprep', expect=fprep + '/func/{base}_desc-confounds_regressors.{ext}',
+             ext=('json', 'tsv')),
+        dict(pipeline='fmriprep', trigger='sub-*/func/*_bold.nii.gz', strip='_bold.nii.gz',
+             requires='derivatives/fmriprep', expect=fprep + '/func/{base}_space-{space}_hemi-{hemi}.func.gii',
+             space=surf_spaces, hemi=('L', 'R')),
+        dict(pipeline='fmriprep', trigger='sub-*/func/*_bold.nii.gz', strip='_bold.nii.gz',
+             requires='derivatives/fmriprep', expect=fprep + '/func/{base}_space-{space}_{ext}',
+             space=vol_spaces, ext=FUNC_EXTS),
+        # Physiology data and derivatives
+        dict(pipeline='bids', trigger='sub-*/func/*_recording-respcardiac_physio.tsv.gz',
+             strip='_recording-respcardiac_physio.tsv.gz',
+             expect=('{sub}/func/{base}_bold.nii.gz', '{sub}/func/{base}_recording-respcardiac_physio.json')),
+        # Not every recording is expected to have RETROICOR regressors, so
+        # missing ones are not reported (as before)
+        # dict(pipeline='physiology', trigger='sub-*/func/*_physio.tsv.gz', strip='_physio.tsv.gz',
+        #      requires='derivatives/physiology',
+        #      expect='derivatives/physiology/{sub}/physio/{base}_desc-retroicor_regressors.tsv'),
+        # Derivatives that do not exist in BIDS
+        dict(pipeline='bids', trigger='derivatives/fmriprep/sub-*/func/*_desc-confounds_regressors.tsv',
+             strip='_desc-confounds_regressors.tsv', requires='{sub}', expect='{sub}/func/{base}_bold.nii.gz'),
+        dict(pipeline='bids', trigger='derivatives/physiology/sub-*/physio/*_desc-retroicor_regressors.tsv',
+             strip='_desc-retroicor_regressors.tsv', requires='{sub}', expect='{sub}/func/{base}_physio.tsv.gz'),
+        dict(pipeline='bids', trigger='derivatives/dwipreproc/sub-*/dwi/*_FA.nii.gz',
+             requires='{sub}', expect='{sub}/dwi'),
+        dict(pipeline='bids', trigger='derivatives/mriqc/sub-*_bold.html', strip='_bold.html',
+             requires='{sub}', expect='{sub}/func/{base}_bold.nii.gz'),
+    ]
+    rules.extend(
+        dict(pipeline='bids', trigger=f'derivatives/{deriv}/sub-*', dirs_only=True, expect='{sub}')
+        for deriv in DERIVS
+    )
+    return rules
+
+
+def _get_sub(path):
+    """ Returns the subject label of a path relative to the BIDS dir. """
+    part = next(p for p in path.split('/') if p.startswith('sub-'))
+    return part.split('_')[0].split('.')[0]
+
+
+def _expand_rule(rule, triggers):
+    """ Expands the templates of a rule for all trigger files; returns a list of
+    (sub, expected path, trigger path) and a list of the `requires` paths. """
+    expect = rule['expect']
+    if isinstance(expect, str):
+        expect = (expect,)
+
+    skip = ('pipeline', 'trigger', 'expect', 'strip', 'requires', 'dirs_only', 'unless')
+    fields = {k: v for k, v in rule.items() if k not in skip}
+    combs = [dict(zip(fields, values)) for values in itertools.product(*fields.values())]
+
+    expected, required = [], []
+    for trig in triggers:
+        name = op.basename(trig)
+        if any(s in name for s in rule.get('unless', ())):
+            continue
+
+        sub = _get_sub(trig)
+        base = name[:-len(rule['strip'])] if 'strip' in rule and name.endswith(rule['strip']) else name
+        required.append(rule['requires'].format(sub=sub, base=base) if 'requires' in rule else None)
+        expected.append([
+            (sub, template.format(sub=sub, base=base, **comb), trig)
+            for template in expect for comb in combs
+        ])
+
+    return expected, required
+
+
+def find_missing(index, spaces):
+    """ Checks all rules against the index and returns a table of missing files.
+
+    Parameters
+    ----------
+    index : DataFrame
+        Index of the dataset (see bids_index.load_index).
+    spaces : tuple
+        Output spaces of Fmriprep.
+
+    Returns
+    -------
+    missing : DataFrame
+        Table with the participant_id, pipeline, missing path (relative to
+        the BIDS dir) and the file that implies it ("source").
+    """
+    root = index.attrs['root']
+    existing = set(index['path'])
+    dirs = set(index.loc[index['is_dir'], 'path'])
+
+    expected = {}
+    for rule in _get_rules(spaces):
+        triggers = [op.relpath(f, root) for f in index_glob(index, op.join(root, rule['trigger']))]
+        if rule.get('dirs_only', False):
+            triggers = [t for t in triggers if t in dirs]
+
+        per_trigger, required = _expand_rule(rule, triggers)
+        exp = expected.setdefault(rule['pipeline'], {})
+        for entries, req in zip(per_trigger, required):
+            if req is not None and req not in existing:
+                continue
+            for sub, path, trig in entries:
+                exp.setdefault(path, (sub, trig))
+
+    rows = []
+    for pipeline, exp in expected.items():
+        for path in sorted(exp.keys() - existing):
+            sub, trig = exp[path]
+            rows.append((sub, pipeline, path, trig))
+
+    missing = pd.DataFrame(rows, columns=['participant_id', 'pipeline', 'path', 'source'])
+    return missing.sort_values(['participant_id', 'pipeline', 'path'], ignore_index=True)
+
+
+def _count_rows(f_in):
+    """ Counts the number of lines of a file without parsing it. """
+    n, last = 0, b'\n'
+    for chunk in iter(lambda: f_in.read(CHUNK_SIZE), b''):
+        n += chunk.count(b'\n')
+        last = chunk[-1:]
+
+    return n + (last != b'\n')  # last line without newline
+
+
+def _check_ricor(ricor, bids_dir):
+    """ Checks the columns (using the header line only) and the number of rows
+    (against the number of volumes of the BOLD file) of a RETROICOR file. """
+    rel = op.relpath(ricor, bids_dir)
+    sub = _get_sub(rel)
+    with open(ricor, 'rb') as f_in:
+        cols = f_in.readline().decode().rstrip('\r\n').split('\t')
+        n_rows = _count_rows(f_in)
+
+    problems = []
+    if not all(col in cols for col in RICOR_COLS):
+        problems.append((sub, 'physiology', rel, None, 'wrong columns'))
+
+    base = op.basename(ricor).split('_recording-')[0]
+    bold = op.join(bids_dir, sub, 'func', f'{base}_bold.nii.gz')
+    if op.isfile(bold):  # missing BOLD files are reported already
+        shape = get_shape(bold)
+        n_vols = shape[3] if len(shape) > 3 else 1
+        if n_rows != n_vols:
+            problems.append((sub, 'physiology', rel, op.relpath(bold, bids_dir), 'wrong number of rows'))
+
+    return problems
+
+
+def main(bids_dir, spaces=None, out_file=None, n_jobs=1):
+    """ Checks the completeness of a BIDS dataset and its derivatives.
+
+    Parameters
+    ----------
+    bids_dir : str
+        Path to BIDS directory.
+    spaces : tuple
+        Output spaces of Fmriprep.
+    out_file : str
+        Path to the output table (.tsv or .json); if None, it is written to
+        missing-files.tsv next to the BIDS dir.
+    n_jobs : int
+        Number of threads to check files with.
+
+    Returns
+    -------
+    problems : DataFrame
+        Table with one row per problem, grouped by subject and pipeline.
+    """
     if spaces is None:
         spaces = ('fsaverage5', 'MNI152NLin2009cAsym', 'T1w')
 
-    for mod in ('bold', 'T1w'):
-        for ext in ('html', 'tsv'):
-            mriqc_f = op.join(bids_dir, 'derivatives', 'mriqc', f'group_{mod}.{ext}')
-            if not op.isfile(mriqc_f):
-                print(f"WARNING: {mriqc_f} does not exist.")
+    if out_file is None:
+        out_file = op.join(op.dirname(bids_dir), 'missing-files.tsv')
 
-    sub_dirs_bids = [d for d in sorted(glob(op.join(bids_dir, 'sub-*'))) if op.isdir(d)]
-    subs = [op.basename(d) for d in sub_dirs_bids]
     partic_file = op.join(bids_dir, 'participants.tsv')
     if not op.isfile(partic_file):
         raise ValueError("There is no participants.tsv file!")
 
-    df = pd.read_csv(op.join(bids_dir, 'participants.tsv'), sep='\t')
+    index = load_index(bids_dir)
+    problems = find_missing(index, spaces)
+    problems['problem'] = 'missing'
+
+    # Other problems, which are not (only) about missing files
+    existing = set(index['path'])
+    dirs = set(index.loc[index['is_dir'], 'path'])
+    other = []
+    for mod in ('bold', 'T1w'):
+        for ext in ('html', 'tsv'):
+            f = f'derivatives/mriqc/group_{mod}.{ext}'
+            if f not in existing:
+                other.append((None, 'mriqc', f, None, 'missing'))
+
+    subs = sorted(d for d in dirs if d.startswith('sub-') and '/' not in d)
+    df = pd.read_csv(partic_file, sep='\t')
+    for sub in sorted(set(subs) - set(df['participant_id'])):
+        other.append((sub, 'bids', 'participants.tsv', sub, 'not in participants.tsv'))
+
+    for sub in sorted(set(df['participant_id']) - set(subs)):
+        other.append((sub, 'bids', sub, 'participants.tsv', 'missing'))
+
     for sub in subs:
-        if sub not in df['participant_id'].tolist():
-            print(f"WARNING: {sub} not present in participants.tsv file!")
-
-    for sub in df['participant_id']:
-        if sub not in subs:
-            print(f"WARNING: {sub} is in participants.tsv, but does not have BIDS dir")
-
-    for sdir in sub_dirs_bids:
-        sub_base = op.basename(sdir)
-
-        ##### CHECK ANAT #####
-        anat = op.join(sdir, 'anat')
-        if not op.isdir(anat):
-            print(f"WARNING: {sub_base} doesn't have a T1 file.")
-
-        anat_contents = glob(op.join(anat, '*.nii.gz'))
-        if not anat_contents:
-            print(f"WARNING: {sub_base} anat directory is empty.")
-        else:
-            fprep_anat_dir = op.join(bids_dir, 'derivatives', 'fmriprep', sub_base, 'anat')
-            if not op.isdir(fprep_anat_dir):
-                print(f"WARNING: {sub_base} doesn't have an Fmriprep anat folder.")
-            else:
-                fs_exts = ('inflated', 'midthickness', 'pial', 'smoothwm')
-                for ext in fs_exts:
-                    for hemi in ('R', 'L'):
-                        f = op.join(fprep_anat_dir, f'{sub_base}_hemi-{hemi}_{ext}.surf.gii')
-                        if not op.isfile(f):
-                            print(f"WARNING: {op.basename(f)} does not exist.")
-                
-                for ext in ('desc-aparcaseg_dseg', 'desc-aseg_dseg'):
-                    f = op.join(fprep_anat_dir, f'{sub_base}_{ext}.nii.gz')
-                    if not op.isfile(f):
-                        print(f"WARNING: {op.basename(f)} seems to be missing.")
-
-                for space in [''] + ['space-' + s + '_' for s in spaces]:
-                    if 'fsaverage' in space or 'T1w' in space:
-                        continue                      
-                    
-                    exts = [
-                        'desc-brain_mask.json', 'desc-brain_mask.nii.gz',
-                        'desc-preproc_T1w.json', 'desc-preproc_T1w.nii.gz',
-                        'dseg.nii.gz', 'label-CSF_probseg.nii.gz', 'label-GM_probseg.nii.gz',
-                        'label-WM_probseg.nii.gz'
-                    ]
-                    for ext in exts:
-                        f = op.join(fprep_anat_dir, f'{sub_base}_{space}{ext}')
-                        if not op.isfile(f):
-                            print(f"WARNING: {op.basename(f)} does not exist.")
-
-            recon_all_done = op.join(bids_dir, 'derivatives', 'freesurfer', sub_base, 'scripts', 'recon-all.done')
-            if not op.isfile(recon_all_done):
-                print(f"WARNING: recon-all did not finish for {sub_base}.")
-            else:
-                pass
-                with open(recon_all_done.replace('done', 'log'), 'r') as f_in:
-                    ra_log = f_in.read().splitlines()[-1]
-                    if not 'without error' in ra_log:
-                        print(f"WARNING: something went wrong with Freesurfer for {sub_base}.")
-
-            vbm_dir = op.join(bids_dir, 'derivatives', 'vbm')
-            if op.isdir(vbm_dir):
-                vbm_dir_sub = op.join(vbm_dir, sub_base)
-                if not op.isdir(vbm_dir_sub):
-                    print(f"WARNING: {vbm_dir_sub} does not exist.")
-                else:
-                    f = op.join(vbm_dir_sub, f'{sub_base}_desc-VBM_GMvolume.nii.gz')
-                    if not op.isfile(f):
-                        print(f"WARNING: {op.basename(f)} does not exist.")
-
-            mriqc_dir = op.join(bids_dir, 'derivatives', 'mriqc')
-            if op.isdir(mriqc_dir):
-                for t1 in anat_contents:
-                    f = op.join(mriqc_dir, op.basename(t1).replace('nii.gz', 'html'))
-                    if not op.isfile(f):
-                        print(f"WARNING: missing MRIQC file {op.basename(f)}.")
-
-                    f = op.join(mriqc_dir, sub_base, 'anat', op.basename(t1).replace('nii.gz', 'json'))
-                    if not op.isfile(f):
-                        print(f"WARNING: missing MRIQC file {op.basename(f)}.")
-
-        ##### CHECK DWI #####
-        if op.isdir(op.join(sdir, 'dwi')):
-            dwi_contents = glob(op.join(sdir, 'dwi'))
-            if not dwi_contents:
-                print(f"WARNING: {op.join(sdir, 'dwi')} exists, but is empty.")
-            else:
-                dwis = glob(op.join(sdir, 'dwi', '*.nii.gz'))
-                for dwi in dwis:
-                    bval = dwi.replace('nii.gz', 'bval')
-                    bvec = dwi.replace('nii.gz', 'bvec')
-                    for f in (bval, bvec):
-                        if not op.isfile(f):
-                            print(f"WARNING: {op.basename(dwi)} exists, but {op.basename(f)} doesn't.")
-
-                dti_fa = op.join(bids_dir, 'derivatives', 'dwipreproc', sub_base)    
-                if op.isdir(dti_fa):
-                    for mod in ('desc-brain_mask', 'model-DTI_desc-WLS_FA', 'model-DTI_desc-WLS_EVECS'):
-                        f = op.join(dti_fa, 'dwi', f'{sub_base}_{mod}.nii.gz')
-                        if not op.isfile(f):
-                            print(f"WARNING: {f} seems to be missing.")
-
-        error_dir = op.join(bids_dir, 'derivatives', 'fmriprep', sub_base, 'log')
-        if op.isdir(error_dir):
-            print(f"WARNING: {sub_base} has a Fmriprep 'log' dir; something went wrong.")
-
-        ##### CHECK FUNC #####
-        func_files = glob(op.join(sdir, 'func', '*.nii.gz'))
-        for func in func_files:
-            func_base = op.basename(func).split('.nii.gz')[0]
-            events = func.replace('bold.nii.gz', 'events.tsv')
-            if not op.isfile(events):
-                if not 'resting' in func and 'movie' not in func:
-                    print(f"WARNING: {op.basename(func)} exists, but {op.basename(events)} doesn't.")
-
-            mriqc_dir = op.join(bids_dir, 'derivatives', 'mriqc')
-            if op.isdir(mriqc_dir):
-                f = op.join(mriqc_dir, func_base + '.html')
-                if not op.isfile(f):
-                    print(f"WARNING: missing MRIQC file {op.basename(f)}.")
-
-                f = op.join(mriqc_dir, sub_base, 'func', func_base + '.json')
-                if not op.isfile(f):
-                    print(f"WARNING: missing MRIQC file {op.basename(f)}.")
-
-            fprep_dir = op.join(bids_dir, 'derivatives', 'fmriprep')
-            if op.isdir(fprep_dir):
-                func_base = op.basename(func).split('_bold')[0]
-                fprep_html = op.join(fprep_dir, sub_base + '.html')
-                if not op.isfile(fprep_html):
-                    print(f"WARNING: {sub_base} doesn't have a Fmriprep html file.")
-        
-                exts = ['desc-confounds_regressors.json', 'desc-confounds_regressors.tsv']
-                for ext in exts:
-                    f = op.join(fprep_dir, sub_base, 'func', f'{func_base}_{ext}')
-                    if not op.isfile(f):
-                        print(f"WARNING: {op.basename(f)} does not exist.")
-
-                for space in [s for s in spaces if 'fsaverage' in s]:
-                    for ext in ('hemi-L.func.gii', 'hemi-R.func.gii'):
-                        f = op.join(fprep_dir, sub_base, 'func', f'{func_base}_space-{space}_{ext}')
-                        if not op.isfile(f):
-                            print(f"WARNING: {op.basename(f)} does not exist.")
-
-                for space in [s for s in spaces if 'fsaverage' not in s]:
-                    exts = (
-                        'boldref.nii.gz',
-                        'desc-aparcaseg_dseg.nii.gz',
-                        'desc-aseg_dseg.nii.gz',
-                        'desc-brain_mask.json',
-                        'desc-brain_mask.nii.gz',
-                        'desc-preproc_bold.json',
-                        'desc-preproc_bold.nii.gz'
-                    )
-                    for ext in exts:
-                        f = op.join(fprep_dir, sub_base, 'func', f'{func_base}_space-{space}_{ext}')
-                        if not op.isfile(f):
-                            print(f"WARNING: {op.basename(f)} does not exist.")
-
-        ##### CHECK PHYSIO #####
-        physio_files = glob(op.join(sdir, 'func', '*.tsv.gz'))
-        for phys in physio_files:
-            func = phys.replace('recording-respcardiac_physio.tsv.gz', 'bold.nii.gz')
-            if not op.isfile(func):
-                print(f"WARNING: {op.basename(phys)} exists, but {op.basename(func)} doesn't.")
-
-            phys_json = phys.replace('tsv.gz', 'json')
-            if not op.isfile(phys_json):
-                print(f"WARNING: {op.basename(phys)} exists, but {op.basename(phys_json)} doesn't.")
-
-            phys_deriv_dir = op.join(bids_dir, 'derivatives', 'physiology')
-            if op.isdir(phys_deriv_dir):
-                ricor = op.join(
-                    phys_deriv_dir, sub_base, 'physio',
-                    op.basename(phys).replace('physio.tsv.gz', 'desc-retroicor_regressors.tsv')
-                )
-                if not op.isfile(ricor):
-                    pass
-                    #print(f"WARNING: {op.basename(phys)} exists, but {op.basename(ricor)} doesn't.")
-                else:
-                    df = pd.read_csv(ricor, sep='\t')
-                    if not (
-                        'cardiac_cos_00' in df.columns and 
-                        'resp_cos_00' in df.columns and 
-                        'interaction_add_cos_00' in df.columns and
-                        'hrv' in df.columns and 'rvt' in df.columns
-                        ):
-                        print(f"WARNING: somthing wrong with columns of {op.basename(ricor)}.")
-
-    #### CHECK WHETHER DATA EXISTS IN DERIVATIVES THAT DOES NOT EXIST IN BIDS ####
-    for deriv in ('freesurfer', 'fmriprep', 'physiology', 'vbm', 'dti_fa', 'mriqc', 'dwipreproc'):
-        deriv_dirs = sorted(glob(op.join(bids_dir, 'derivatives', deriv, 'sub-*')))
-        deriv_subs = [d for d in deriv_dirs if op.isdir(d)]
-        for sub in deriv_subs:
-            sub_base = op.basename(sub)
-            if not op.isdir(op.join(bids_dir, op.basename(sub))):
-                print(f"WARNING: {deriv} dir {sub_base} exists, but BIDS dir {sub_base} does not exist.")
-            else:
-                if deriv == 'fmriprep':
-                    files = [op.basename(s).split('_desc')[0] for s in glob(op.join(sub, 'func', '*_desc-confounds_regressors.tsv'))]
-                    for f in files:
-                        bids_f = op.join(bids_dir, sub_base, 'func', f + '_bold.nii.gz')
-                        if not op.isfile(bids_f):
-                            print(f"WARNING: {f} exists in Fmriprep, but not in BIDS, {bids_f}.")
-                elif deriv == 'physiology':
-                    files = [op.basename(s).split('_desc')[0] for s in glob(op.join(sub, 'physio', '*_desc-retroicor_regressors.tsv'))]
-                    for f in files:
-                        bids_f = op.join(bids_dir, sub_base, 'func', f + '_physio.tsv.gz')
-                        if not op.isfile(bids_f):
-                            print(f"WARNING: {f} exists in Physio deriv, but not in BIDS, {bids_f}.")
-                elif deriv == 'dwipreproc':
-                    files = [op.basename(s).split('_')[0] for s in glob(op.join(sub, 'dwi', '*_FA.nii.gz'))]
-                    for f in files:
-                        bids_f = op.join(bids_dir, sub_base, 'dwi')
-                        if not op.isdir(bids_f):
-                            print(f"WARNING: {f} exists in dwipreproc, but not in BIDS, {bids_f}.")
-
-                elif deriv == 'mriqc':
-                    files = [op.basename(s).split('_bold.html')[0] for s in glob(sub + '*_bold.html')]
-                    for f in files:
-                        bids_f = op.join(bids_dir, sub_base, 'func', f + '_bold.nii.gz')
-                        if not op.isfile(bids_f):
-                            print(f"WARNING: {f} exists in MRIQC, but not in BIDS, {bids_f}.")
-                
-                                   
+        if f'{sub}/anat' in dirs and not index_glob(index, op.join(bids_dir, sub, 'anat', '*.nii.gz')):
+            other.append((sub, 'bids', f'{sub}/anat', None, 'empty directory'))
+
+        if f'{sub}/dwi' in dirs and not index_glob(index, op.join(bids_dir, sub, 'dwi', '*')):
+            other.append((sub, 'bids', f'{sub}/dwi', None, 'empty directory'))
+
+        if f'derivatives/fmriprep/{sub}/log' in dirs:
+            other.append((sub, 'fmriprep', f'derivatives/fmriprep/{sub}/log', None, 'error log'))
+
+    for done in index_glob(index, op.join(bids_dir, 'derivatives', 'freesurfer', 'sub-*', 'scripts', 'recon-all.done')):
+        with open(done.replace('done', 'log'), 'r') as f_in:
+            ra_log = f_in.read().splitlines()[-1]
+        if not 'without error' in ra_log:
+            rel = op.relpath(done.replace('done', 'log'), bids_dir)
+            other.append((_get_sub(rel), 'freesurfer', rel, None, 'recon-all error'))
+
+    ricors = index_glob(index, op.join(bids_dir, 'derivatives', 'physiology', 'sub-*', 'physio', '*_desc-retroicor_regressors.tsv'))
+    results = Parallel(n_jobs=n_jobs, prefer='threads')(delayed(_check_ricor)(ricor, bids_dir) for ricor in ricors)
+    other.extend(p for res in results for p in res)
+
+    other = pd.DataFrame(other, columns=['participant_id', 'pipeline', 'path', 'source', 'problem'])
+    problems = pd.concat((problems, other), axis=0, ignore_index=True)
+    problems = problems.sort_values(['participant_id', 'pipeline', 'path'], na_position='first', ignore_index=True)
+
+    if out_file.endswith('.json'):
+        problems.to_json(out_file, orient='records', indent=4)
+    else:
+        problems.to_csv(out_file, sep='\t', index=False)
+
+    if problems.shape[0]:
+        print(problems.groupby(['pipeline', 'problem']).size().to_string())
+    print(f"Found {problems.shape[0]} problems; see {out_file}.")
+    return problems
+
 
 if __name__ == '__main__':
 
     import argparse
     parser = argparse.ArgumentParser(description='Check completeness')
     parser.add_argument('dir', type=str, help='Input')
+    parser.add_argument('--out', type=str, default=None, help='Output table (.tsv or .json)')
+    parser.add_argument('--n_jobs', type=int, default=1, help='Number of threads')
     args = parser.parse_args()
-    main(op.abspath(args.dir))
+    main(op.abspath(args.dir), out_file=args.out, n_jobs=args.n_jobs)
@@ -0,0 +1,41 @@
+""" Optional columnar (Parquet) output of group-level tables, next to the
+(BIDS) TSVs, for consumers that query slices of large tables (typed and
+compressed, so no re-parsing of text). Requires pyarrow. """
+import os
+import shutil
+import os.path as op
+
+
+def check_parquet():
+    """ Raises an error if Parquet output is not available. """
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        raise ImportError("Parquet output requires pyarrow (pip install pyarrow).")
+
+
+def write_parquet(df, path, partition_cols=None, index=False):
+    """ Writes a table as Parquet (snappy-compressed).
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        Table to write.
+    path : str
+        Output file or, with partition_cols, output directory (which is
+        replaced if it exists, so no stale partitions are left).
+    partition_cols : list
+        Columns to partition the dataset by (one subdirectory per value).
+    index : bool
+        Whether to write the index of df.
+    """
+    check_parquet()
+    if partition_cols is None:
+        df.to_parquet(path, compression='snappy', index=index)
+        return
+
+    tmp = f'{path}.{os.getpid()}.tmp'
+    df.to_parquet(tmp, compression='snappy', index=index, partition_cols=partition_cols)
+    if op.isdir(path):
+        shutil.rmtree(path)
+    os.replace(tmp, path)
@@ -4,34 +4,80 @@ import numpy as np
 import nibabel as nib
 import os.path as op
 from glob import glob
+from bids_index import load_index, index_glob
+from masked_cache import load_masked
 from tqdm import tqdm
-from nilearn import masking, image
+from nilearn import masking
 from joblib import Parallel, delayed
 
-# I know, I know, bad practice
-import warnings
-warnings.filterwarnings("ignore")
 
+def _iter_chunks(f, space, n_vols=32, cache_dir=None):
+    """ Yields the data of a surface (gifti) or volume (nifti, within its brain
+    mask) file in chunks of n_vols timepoints (time x vertices/voxels). Volume
+    data is read through the masked-data cache, if cache_dir is given.
 
-def _parallel_tsnr(f, out_dir, space='MNI152NLin2009cAsym_desc-preproc_bold.nii.gz'):
+    Note that only volume data is read lazily: nibabel parses a gifti file as
+    a whole, so for surface data all darrays are in memory (only the stacked
+    copy of the full run is avoided). Surface runs are small, though. """
+    if 'fsaverage' in space:
+        darrays = nib.load(f).darrays
+        for i in range(0, len(darrays), n_vols):
+            yield np.vstack([arr.data for arr in darrays[i:i + n_vols]])
+    elif cache_dir is not None:
+        Y = load_masked(f, f.replace('preproc_bold', 'brain_mask'), cache_dir)
+        for i in range(0, Y.shape[0], n_vols):
+            yield np.asarray(Y[i:i + n_vols])
+    else:
+        mask = np.asanyarray(nib.load(f.replace('preproc_bold', 'brain_mask')).dataobj) != 0
+        img = nib.load(f, keep_file_open=True)
+        for i in range(0, img.shape[3], n_vols):
+            yield np.asarray(img.dataobj[..., i:i + n_vols], dtype=np.float32)[mask].T
+
+
+def running_mean_std(chunks):
+    """ Computes the mean and (population) standard deviation across time from
+    chunks of data, by merging the chunks' statistics into running float64
+    accumulators (Welford/Chan et al.), so only one chunk is in memory. """
+    n, mean_, m2 = 0, None, None
+    for chunk in chunks:
+        n_c = chunk.shape[0]
+        mean_c = chunk.mean(axis=0, dtype=np.float64)
+        m2_c = ((chunk - mean_c) ** 2).sum(axis=0)
+        if mean_ is None:
+            n, mean_, m2 = n_c, mean_c, m2_c
+        else:
+            delta = mean_c - mean_
+            mean_ += delta * (n_c / (n + n_c))
+            m2 += m2_c + delta ** 2 * (n * n_c / (n + n_c))
+            n += n_c
+
+    return mean_, np.sqrt(m2 / n)
+
+
+def compute_tsnr(f, out_dir, space='MNI152NLin2009cAsym_desc-preproc_bold.nii.gz', cache_dir=None):
     """ Computes TSNR for a surface (gifti) or volume (nifti) file with a 
-    time dimension. """
+    time dimension. The data are processed in chunks of timepoints (see
+    _iter_chunks; volume data is also read per chunk). """
+    mean_, sd_ = running_mean_std(_iter_chunks(f, space, cache_dir=cache_dir))
+    save_tsnr(f, out_dir, space, mean_, sd_)
+
+
+def save_tsnr(f, out_dir, space, mean_, sd_):
+    """ Computes TSNR from the mean and standard deviation across time of f
+    and writes the mean, std and tsnr maps. """
     base_name = op.basename(f).split(space.split('_')[1])[0]
     sub_out = op.join(out_dir, base_name.split('_')[0], 'tsnr')
 
     if not op.isdir(sub_out):
         os.makedirs(sub_out, exist_ok=True)
 
-    if 'fsaverage' in space:
-        gii = nib.load(f)
-        dat = np.vstack([arr.data for arr in gii.darrays])
-    else:
+    if 'fsaverage' not in space:
         mask = f.replace('preproc_bold', 'brain_mask')
-        dat = masking.apply_mask(f, mask)
-        
-    mean_ = dat.mean(axis=0)
-    sd_ = dat.std(axis=0)
-    tsnr_ = mean_ / sd_
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        tsnr_ = mean_ / sd_
+
+    mean_, sd_, tsnr_ = (tmp.astype(np.float32) for tmp in (mean_, sd_, tsnr_))
     for tmp in (mean_, sd_, tsnr_):
         tmp[np.isnan(tmp)] = 0
 
@@ -46,23 +92,75 @@ def _parallel_tsnr(f, out_dir, space='MNI152NLin2009cAsym_desc-preproc_bold.nii.
             f_out = op.join(sub_out, base_name + f'{mod}.nii.gz')
             img_.to_filename(f_out)
 
+def _load_map(f):
+    """ Loads a subject-level map (npy or nifti) as float64. """
+    if f.endswith('.npy'):
+        return np.load(f).astype(np.float64), None
+
+    img = nib.load(f)
+    return img.get_fdata(dtype=np.float64), img.affine
+
+
+def _update_accumulator(files, acc_file):
+    """ Updates the running sum, sum of squares and count of the maps in files,
+    stored in acc_file (with the mtimes of the files included so far). Only
+    files that were not included yet are loaded; if an included file changed
+    (or was removed), the accumulator is rebuilt from scratch. """
+    mtimes = {f: os.stat(f).st_mtime_ns for f in files}
+    acc = None
+    if op.isfile(acc_file):
+        acc = dict(np.load(acc_file, allow_pickle=False))
+        included = dict(zip(acc['files'].tolist(), acc['mtimes'].tolist()))
+        if any(mtimes.get(f) != mtime for f, mtime in included.items()):
+            print(f"INFO: files changed, rebuilding {op.basename(acc_file)}")
+            acc = None
+
+    if acc is None:
+        acc = dict(files=np.array([], dtype=str), mtimes=np.array([], dtype=np.int64), count=np.array(0))
+
+    included = set(acc['files'].tolist())
+    new = [f for f in files if f not in included]
+    for f in new:
+        data, affine = _load_map(f)
+        if 'sum' not in acc:
+            acc['sum'], acc['sumsq'] = np.zeros_like(data), np.zeros_like(data)
+            acc['affine'] = affine if affine is not None else np.eye(4)
+        acc['sum'] += data
+        acc['sumsq'] += data ** 2
+
+    if new:
+        acc['count'] = np.array(acc['count'] + len(new))
+        acc['files'] = np.concatenate((acc['files'], new))
+        acc['mtimes'] = np.concatenate((acc['mtimes'], [mtimes[f] for f in new]))
+        # Written atomically, so an interrupted run never leaves a corrupt accumulator
+        tmp = f'{acc_file}.{os.getpid()}.tmp.npz'
+        np.savez(tmp, **acc)
+        os.replace(tmp, acc_file)
+
+    return acc
+
+
 def _mean_tsnr(files, out_dir, mod, task, space):
-    """ Averages TSNR across subject-level TSNR fles. """
-    if 'fsaverage' in space:
-        for i, f in enumerate(files):
-            if i == 0:
-                sum_ = np.load(f)
-            else:
-                sum_ += np.load(f)
-
-        mean_ = sum_ / len(files)
-        mean_[np.isnan(mean_)] = 0 
-        f_out = op.join(out_dir, f'task-{task}_space-{space}_desc-mean_{mod}.npy')
-        np.save(f_out, mean_)
-    else:
-        mean_ = image.mean_img(files)
-        f_out = op.join(out_dir, f'task-{task}_space-{space}_desc-mean_{mod}.nii.gz')
-        mean_.to_filename(f_out)
+    """ Averages TSNR across subject-level TSNR files (and computes the
+    variance across subjects), using a persistent accumulator so that only
+    new files have to be loaded. """
+    acc_file = op.join(out_dir, f'.task-{task}_space-{space}_desc-{mod}_accumulator.npz')
+    acc = _update_accumulator(files, acc_file)
+    n = int(acc['count'])
+    mean_ = acc['sum'] / n
+    var_ = (acc['sumsq'] - n * mean_ ** 2) / max(n - 1, 1)
+    var_[var_ < 0] = 0  # numerical imprecision
+    for tmp in (mean_, var_):
+        tmp[np.isnan(tmp)] = 0
+
+    for desc, metric in [('mean', mean_), ('var', var_)]:
+        metric = metric.astype(np.float32)
+        if 'fsaverage' in space:
+            f_out = op.join(out_dir, f'task-{task}_space-{space}_desc-{desc}_{mod}.npy')
+            np.save(f_out, metric)
+        else:
+            f_out = op.join(out_dir, f'task-{task}_space-{space}_desc-{desc}_{mod}.nii.gz')
+            nib.Nifti1Image(metric, acc['affine']).to_filename(f_out)
 
 
 @click.command()
@@ -70,7 +168,8 @@ def _mean_tsnr(files, out_dir, mod, task, space):
 @click.argument('out_dir', required=False, type=click.Path())
 @click.argument('level', default='participant')
 @click.option('--n_jobs', default=1, type=int)
-def main(bids_dir, out_dir, level, n_jobs):
+@click.option('--cache_dir', default=None, help="Masked-data cache directory (optional)")
+def main(bids_dir, out_dir, level, n_jobs, cache_dir):
     """ BIDS-app format. """
     
     if out_dir is None:
@@ -83,10 +182,11 @@ def main(bids_dir, out_dir, level, n_jobs):
     print(f"INFO: using data from {fmriprep_dir}")
     print(f"INFO: storing tsnr data in {out_dir}")
     if level == 'participant':
+        index = load_index(bids_dir)
         for space in ('fsaverage5_hemi-L.func.gii', 'fsaverage5_hemi-R.func.gii', 'MNI152NLin2009cAsym_desc-preproc_bold.nii.gz'):
             print(f"INFO: computing TSNR for space {space.split('_')[0]}")
-            funcs = sorted(glob(op.join(fmriprep_dir, 'sub-*', 'func', f'*space-{space}')))
-            Parallel(n_jobs=n_jobs)(delayed(_parallel_tsnr)(f, out_dir, space) for f in tqdm(funcs))
+            funcs = index_glob(index, op.join(fmriprep_dir, 'sub-*', 'func', f'*space-{space}'))
+            Parallel(n_jobs=n_jobs)(delayed(compute_tsnr)(f, out_dir, space, cache_dir) for f in tqdm(funcs))
     elif level == 'group':
         for space in ('fsaverage5_hemi-L', 'fsaverage5_hemi-R', 'MNI152NLin2009cAsym'):
             for mod in ['mean', 'std', 'tsnr']:
@@ -100,6 +200,10 @@ def main(bids_dir, out_dir, level, n_jobs):
         raise ValueError("Level should be 'participant' or 'group'.")
 if __name__ == '__main__':
 
+    # I know, I know, bad practice (only when run as a script, though, so
+    # importers such as run_all_fmri.py still see their warnings)
+    import warnings
+    warnings.filterwarnings("ignore")
     main()
 
     
@@ -0,0 +1,261 @@
+""" Batched GLM engines. The first-level engine is equivalent to nistats'
+run_glm (with an OLS or AR(1) noise model) followed by compute_contrast, but
+works on a single float32 data matrix. Voxels are fitted in chunks with one
+precomputed pseudo-inverse per AR(1) bin and all contrasts are computed at
+once. The group-level engine fits OLS models to memory-mapped data in voxel
+chunks across processes. """
+import numpy as np
+import nibabel as nib
+from functools import lru_cache
+from joblib import Parallel, delayed
+from scipy import ndimage, stats
+
+CHUNK_SIZE = 20000  # number of voxels per BLAS call
+
+
+@lru_cache(maxsize=16)
+def load_mask(path):
+    """ Loads a mask as a boolean array (and its affine); cached, so runs
+    (or analyses) that share a mask only load it once. """
+    img = nib.load(path)
+    mask = np.asanyarray(img.dataobj) != 0
+    mask.flags.writeable = False
+    return mask, img.affine
+
+
+def apply_mask(path, mask, n_vols=16, out=None):
+    """ Loads the data of a 4D image within mask as a float32 (time x voxels)
+    matrix, reading n_vols volumes at a time, so that the full 4D image
+    never has to be in memory. If given, the data is written into out
+    (e.g., a memory-mapped array). """
+    img = nib.load(path, keep_file_open=True)
+    n = img.shape[3]
+    Y = np.empty((n, mask.sum()), dtype=np.float32) if out is None else out
+    for i in range(0, n, n_vols):
+        data = np.asarray(img.dataobj[..., i:i + n_vols], dtype=np.float32)
+        Y[i:i + n_vols] = data[mask].T
+
+    return Y
+
+
+def unmask(values, mask, affine):
+    """ Puts (n x voxels) values back into a 4D image, or (voxels,) values
+    into a 3D image (like nilearn's unmask). """
+    values = np.asarray(values)
+    data = np.zeros(mask.shape + values.shape[:-1], dtype=values.dtype)
+    data[mask] = values.T
+    return nib.Nifti1Image(data, affine)
+
+
+def _ar1_coef(Y, X, pinv, chunk_size):
+    """ Computes the lag-1 autocorrelation of the OLS residuals per voxel. """
+    ar1 = np.zeros(Y.shape[1], dtype=np.float32)
+    for i in range(0, Y.shape[1], chunk_size):
+        resid = Y[:, i:i + chunk_size] - X @ (pinv @ Y[:, i:i + chunk_size])
+        num = np.einsum('ij,ij->j', resid[1:], resid[:-1])
+        denom = np.einsum('ij,ij->j', resid, resid)
+        ar1[i:i + chunk_size] = np.divide(num, denom, out=np.zeros_like(num), where=denom > 0)
+
+    return ar1
+
+
+def fit_glm(Y, X, contrasts, noise_model='ar1', bins=100, chunk_size=CHUNK_SIZE):
+    """ Fits a GLM and computes contrasts.
+
+    Parameters
+    ----------
+    Y : np.ndarray
+        Data (time x voxels); converted to float32 if necessary.
+    X : np.ndarray
+        Design matrix (time x regressors).
+    contrasts : np.ndarray
+        Contrast vectors (contrasts x regressors).
+    noise_model : str
+        Either 'ar1' or 'ols'.
+    bins : int
+        Number of bins to quantize the AR(1) coefficients into (as nistats).
+    chunk_size : int
+        Number of voxels to fit at once.
+
+    Returns
+    -------
+    effects : np.ndarray
+        Contrast estimates (contrasts x voxels).
+    variances : np.ndarray
+        Variances of the contrast estimates (contrasts x voxels).
+    """
+    Y = np.asarray(Y, dtype=np.float32)
+    X = np.asarray(X, dtype=np.float64)
+    C = np.atleast_2d(np.asarray(contrasts, dtype=np.float64))
+    n_vox = Y.shape[1]
+
+    if noise_model == 'ar1':
+        pinv = np.linalg.pinv(X).astype(np.float32)
+        ar1 = _ar1_coef(Y, X.astype(np.float32), pinv, chunk_size)
+        labels = (ar1 * bins).astype(int) / bins  # truncated, like nistats
+    elif noise_model == 'ols':
+        labels = np.zeros(n_vox)
+    else:
+        raise ValueError(f"Unknown noise model {noise_model}.")
+
+    effects = np.zeros((C.shape[0], n_vox), dtype=np.float32)
+    variances = np.zeros((C.shape[0], n_vox), dtype=np.float32)
+    for rho in np.unique(labels):
+        # Prewhiten design (first row is left as is, like nistats' ARModel)
+        wX = X.copy()
+        wX[1:] -= rho * X[:-1]
+        pinv = np.linalg.pinv(wX)
+        df = X.shape[0] - np.linalg.matrix_rank(wX)
+        con_var = np.einsum('ij,jk,ik->i', C, pinv @ pinv.T, C)[:, None].astype(np.float32)
+        pinv, wX, C32 = pinv.astype(np.float32), wX.astype(np.float32), C.astype(np.float32)
+
+        vox = np.flatnonzero(labels == rho)
+        for i in range(0, vox.size, chunk_size):
+            idx = vox[i:i + chunk_size]
+            wY = Y[:, idx]  # copy
+            if rho != 0:
+                wY[1:] -= np.float32(rho) * Y[:-1, idx]
+
+            beta = pinv @ wY
+            wY -= wX @ beta  # residuals
+            effects[:, idx] = C32 @ beta
+            variances[:, idx] = con_var * (np.einsum('ij,ij->j', wY, wY) / df)
+
+    return effects, variances
+
+
+def smooth(data, affine, fwhm):
+    """ Smooths (3D/4D) data with a Gaussian kernel of fwhm mm, like nilearn's
+    smooth_img (separable 1D filters over the spatial axes). """
+    data = np.nan_to_num(np.asarray(data, dtype=np.float32), posinf=0, neginf=0)
+    vox_size = np.sqrt(np.sum(affine[:3, :3] ** 2, axis=0))
+    sigmas = fwhm / (np.sqrt(8 * np.log(2)) * vox_size)
+    for axis, sigma in enumerate(sigmas):
+        ndimage.gaussian_filter1d(data, sigma, output=data, axis=axis)
+
+    return data
+
+
+def stream_betas(betas, filename, smoothing=None):
+    """ Writes the data of a list of (first-level) images into a (subjects x
+    voxels) float32 array on disk (a .npy file, which can be memory-mapped),
+    reading each image once, and computes the mask of voxels that are nonzero
+    on average in the same pass.
+
+    Parameters
+    ----------
+    betas : list
+        List of paths to NIfTI images or .npy files (e.g., surface data).
+    filename : str
+        Path to the output .npy file.
+    smoothing : float
+        FWHM (in mm) to smooth NIfTI images with (optional).
+
+    Returns
+    -------
+    mask : np.ndarray
+        Boolean (voxels,) array.
+    shape : tuple
+        Shape of a single image (to unmask the results).
+    affine : np.ndarray
+        Affine of the images (None for .npy files).
+    """
+    Y, total, affine = None, None, None
+    for i, beta in enumerate(betas):
+        if beta.endswith('.npy'):
+            data = np.load(beta).astype(np.float32)
+        else:
+            img = nib.load(beta)
+            affine = img.affine
+            data = np.asarray(img.dataobj, dtype=np.float32)
+            if data.ndim == 4:
+                data = data[..., 0]
+            if smoothing is not None:
+                data = smooth(data, affine, smoothing)
+
+        if Y is None:
+            shape = data.shape
+            Y = np.lib.format.open_memmap(filename, mode='w+', dtype=np.float32, shape=(len(betas), data.size))
+            total = np.zeros(data.size, dtype=np.float64)
+
+        Y[i] = data.ravel()
+        total += Y[i]
+
+    Y.flush()
+    del Y
+    return total != 0, shape, affine
+
+
+def _z_score(p):
+    """ Converts p-values to z-scores (clipped like nistats). """
+    return stats.norm.isf(np.clip(p, 1e-300, 1 - 1e-16))
+
+
+def _fit_group_chunk(filename, start, stop, mask, X, C, con_type):
+    """ Fits an OLS model to a chunk of voxels of the memory-mapped data and
+    returns the z-scores of the contrast. """
+    Y = np.load(filename, mmap_mode='r')[:, start:stop]
+    Y = np.asarray(Y[:, mask], dtype=np.float32)
+
+    pinv = np.linalg.pinv(X)
+    dof = X.shape[0] - np.linalg.matrix_rank(X)
+    beta = pinv.astype(np.float32) @ Y
+    Y -= X.astype(np.float32) @ beta  # residuals
+    dispersion = np.einsum('ij,ij->j', Y, Y).astype(np.float64) / dof
+    effect = C @ beta.astype(np.float64)
+    cov = C @ pinv @ pinv.T @ C.T
+
+    if con_type == 't':
+        sd = np.maximum(np.sqrt(cov[0, 0] * dispersion), 1e-50)
+        p = stats.t.sf(effect[0] / sd, dof)
+    else:
+        q = C.shape[0]
+        stat = np.einsum('ij,ij->j', effect, np.linalg.solve(cov, effect))
+        stat /= q * np.maximum(dispersion, 1e-50)
+        p = stats.f.sf(stat, q, dof)
+
+    return _z_score(p)
+
+
+def fit_group(filename, mask, X, contrast, con_type='t', n_jobs=1, chunk_size=CHUNK_SIZE * 5):
+    """ Fits a group-level OLS model to memory-mapped (subjects x voxels) data
+    (see stream_betas) and computes the z-scores of a t or F contrast. Voxel
+    chunks are fitted in parallel processes, which memory-map the data
+    themselves, so the data never has to be in memory at once.
+
+    Parameters
+    ----------
+    filename : str
+        Path to .npy file with data.
+    mask : np.ndarray
+        Boolean (voxels,) array with voxels to fit.
+    X : np.ndarray
+        Design matrix (subjects x regressors).
+    contrast : np.ndarray
+        Contrast vector (t) or matrix (F).
+    con_type : str
+        Either 't' or 'F'.
+    n_jobs : int
+        Number of processes.
+    chunk_size : int
+        Number of voxels per chunk.
+
+    Returns
+    -------
+    z : np.ndarray
+        Z-scores (voxels,), zero outside the mask.
+    """
+    X = np.asarray(X, dtype=np.float64)
+    C = np.atleast_2d(np.asarray(contrast, dtype=np.float64))
+    chunks = [(i, min(i + chunk_size, mask.size)) for i in range(0, mask.size, chunk_size)]
+    chunks = [(start, stop) for start, stop in chunks if mask[start:stop].any()]
+    results = Parallel(n_jobs=n_jobs)(
+        delayed(_fit_group_chunk)(filename, start, stop, mask[start:stop], X, C, con_type)
+        for start, stop in chunks
+    )
+
+    z = np.zeros(mask.size)
+    for (start, stop), res in zip(chunks, results):
+        z[start:stop][mask[start:stop]] = res
+
+    return z
@@ -0,0 +1,168 @@
+""" Streaming substitution of subject IDs in files, used by
+copy_and_shuffle_ids.py. Lives in its own module so that the substitutors
+(cached per process) can be used from worker processes. """
+import re
+import os
+import fcntl
+import shutil
+from functools import lru_cache
+
+CHUNK_SIZE = 1024 ** 2  # number of bytes read at once when streaming files
+
+# How files that do not need ID substitution are transferred: 'copy' copies
+# them in the kernel (copy_file_range), 'reflink' clones them (copy-on-write,
+# e.g. on btrfs/XFS) and 'hardlink' links them. Reflinks and hardlinks fall
+# back to copying when they are not supported (e.g. across filesystems).
+TRANSFER_MODES = ('copy', 'reflink', 'hardlink')
+FICLONE = 0x40049409  # ioctl request to reflink a file on Linux
+
+
+def _id_replacements(old_id, new_id):
+    """ Returns a dict with all variants of old_id (as bytes) that
+    should be replaced, mapped to their new_id counterparts. """
+    old_nr, new_nr = old_id.split('-')[1], new_id.split('-')[1]
+    pairs = [
+        (old_id, new_id),
+        ('subject_' + old_nr, 'subject_' + new_nr),  # for fmriprep work-dir paths
+        ('Subject ID: ' + old_nr, 'Subject ID: ' + new_nr),  # for fmriprep HTML reports
+        ('participant-label ' + old_nr, 'participant-label ' + new_nr),  # for fmriprep HTML reports
+        (f'"subject_id": "{old_nr}"', f'"subject_id": "{new_nr}"')  # for MRIQC jsons
+    ]
+    return {old.encode(): new.encode() for old, new in pairs}
+
+
+class IDSubstitutor:
+    """ Replaces all variants of a subject ID in raw bytes with a single
+    precompiled regex. Every variant contains the bare ID number, so
+    data without it is passed through after a fast byte-level pre-scan. """
+
+    def __init__(self, old_id, new_id):
+        self.replacements = _id_replacements(old_id, new_id)
+        self.pattern = re.compile(b'|'.join(re.escape(old) for old in self.replacements))
+        self.overlap = max(len(old) for old in self.replacements) - 1
+        self.prescan = old_id.split('-')[1].encode()
+
+    def _replace_match(self, match):
+        return self.replacements[match.group()]
+
+    def sub(self, data):
+        """ Returns data with IDs replaced (the same object if there
+        was nothing to replace). """
+        if self.prescan not in data:
+            return data
+
+        return self.pattern.sub(self._replace_match, data)
+
+    def stream(self, f_in, f_out):
+        """ Streams f_in to f_out in chunks while replacing IDs. To catch IDs
+        spanning two chunks, the tail of each chunk (max. ID length - 1 bytes)
+        is carried over to the next one. Binary files are copied as is. """
+        chunk = f_in.read(CHUNK_SIZE)
+        if b'\0' in chunk:  # not a text file
+            f_out.write(chunk)
+            shutil.copyfileobj(f_in, f_out, CHUNK_SIZE)
+            return
+
+        carry = b''
+        while True:
+            buf = carry + chunk
+            # Matches that start before `safe` are guaranteed to be complete
+            safe = len(buf) - self.overlap if chunk else len(buf)
+            pos = 0
+            if self.prescan in buf:
+                for match in self.pattern.finditer(buf):
+                    if match.start() >= safe:
+                        break
+                    f_out.write(buf[pos:match.start()])
+                    f_out.write(self.replacements[match.group()])
+                    pos = match.end()
+
+            cut = max(pos, safe)
+            f_out.write(buf[pos:cut])
+            carry = buf[cut:]
+            if not chunk:
+                break
+
+            chunk = f_in.read(CHUNK_SIZE)
+
+
+@lru_cache(maxsize=None)
+def get_substitutor(old_id, new_id):
+    """ Builds the substitutor for a subject only once (per process). """
+    return IDSubstitutor(old_id, new_id)
+
+
+def _create_file(dst):
+    """ Creates dst (which should not exist yet) with permissions 0644
+    and returns its file descriptor. """
+    fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+    os.fchmod(fd, 0o644)  # creation mode is subject to the umask
+    return fd
+
+
+def _copy_range(fd_in, fd_out):
+    """ Copies all data from fd_in to fd_out within the kernel
+    and falls back to a regular copy if that is not possible. """
+    try:
+        while os.copy_file_range(fd_in, fd_out, 64 * CHUNK_SIZE):
+            pass
+        return
+    except (AttributeError, OSError):  # not available for this (pair of) filesystem(s)
+        os.lseek(fd_in, 0, os.SEEK_SET)
+        os.lseek(fd_out, 0, os.SEEK_SET)
+        os.ftruncate(fd_out, 0)
+
+    while True:
+        data = os.read(fd_in, CHUNK_SIZE)
+        if not data:
+            break
+        os.write(fd_out, data)
+
+
+def transfer_file(src, dst, transfer='copy'):
+    """ Puts an unchanged version of src at dst, using the given transfer mode.
+    Note that hardlinks share permissions with (and thus keep those of) src. """
+    if transfer == 'hardlink':
+        try:
+            os.link(src, dst)
+            return
+        except OSError:  # e.g., different filesystems
+            pass
+
+    fd_out = _create_file(dst)
+    try:
+        with open(src, 'rb') as f_in:
+            if transfer == 'reflink':
+                try:
+                    fcntl.ioctl(fd_out, FICLONE, f_in.fileno())
+                    return
+                except OSError:  # e.g., filesystem without copy-on-write support
+                    pass
+
+            _copy_range(f_in.fileno(), fd_out)
+    finally:
+        os.close(fd_out)
+
+
+def stream_file(src, dst, substitutor=None, transfer='copy'):
+    """ Copies src to dst, replacing IDs on the fly if a `substitutor`
+    is given. Permissions (0644) are set when dst is created. Files
+    without IDs are transferred according to `transfer`. """
+    if substitutor is None:
+        transfer_file(src, dst, transfer)
+        return
+
+    with open(src, 'rb') as f_in:
+        if transfer != 'copy' and os.fstat(f_in.fileno()).st_size <= CHUNK_SIZE:
+            # Small files are checked first, so they can be linked if they
+            # do not contain any IDs (the majority of them)
+            data = f_in.read()
+            if substitutor.prescan not in data:
+                f_in.close()
+                transfer_file(src, dst, transfer)
+                return
+
+            f_in.seek(0)
+
+        with os.fdopen(_create_file(dst), 'wb') as f_out:
+            substitutor.stream(f_in, f_out)
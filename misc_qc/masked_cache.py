@@ -0,0 +1,146 @@
+""" Disk cache of the in-mask time series of (Fmriprep) BOLD runs, shared by
+the analysis scripts, so that each (gzipped) run has to be decompressed only
+once. Each run is stored as an uncompressed float32 .npy file (time x voxels,
+which can be memory-mapped) plus the flat indices of the mask voxels and
+some header info, keyed by the path, size and mtime of both the run and
+its mask. The least recently used entries are evicted when the cache
+exceeds its quota. The cache is opt-in (--cache_dir of the scripts), as it
+can get large; put it outside the dataset (or exclude it from backups). """
+import os
+import json
+import hashlib
+import numpy as np
+import nibabel as nib
+import os.path as op
+from glm import load_mask, apply_mask
+
+QUOTA = 200 * 1024 ** 3  # bytes
+
+
+def _key(f, mask_file):
+    """ Returns the cache key of a run and its mask. """
+    parts = []
+    for path in (f, mask_file):
+        st = os.stat(path)
+        parts.append(f'{op.abspath(path)}:{st.st_size}:{st.st_mtime_ns}')
+
+    return hashlib.sha1('|'.join(parts).encode()).hexdigest()
+
+
+def _save(arr, path):
+    """ Saves an array atomically (so concurrent readers never see a partial file). """
+    tmp = f'{path}.{os.getpid()}.tmp.npy'
+    np.save(tmp, arr)
+    os.replace(tmp, path)
+
+
+def _evict(cache_dir, quota):
+    """ Removes the least recently used entries until the cache fits in quota. """
+    entries = []
+    for fname in os.listdir(cache_dir):
+        if not fname.endswith('.json'):
+            continue
+
+        key = fname[:-5]
+        files = [op.join(cache_dir, key + ext) for ext in ('.json', '.npy', '_idx.npy')]
+        try:
+            size = sum(op.getsize(p) for p in files if op.isfile(p))
+            entries.append((os.stat(files[0]).st_mtime, size, files))
+        except OSError:  # removed by another process
+            continue
+
+    total = sum(e[1] for e in entries)
+    for _, size, files in sorted(entries):
+        if total <= quota:
+            break
+
+        for p in files:
+            try:
+                os.remove(p)
+            except OSError:
+                pass
+        total -= size
+
+
+def _read_entry(key, cache_dir, run_mask):
+    """ Returns the cached data of an entry (memory-mapped copy-on-write), or
+    None if it is missing (e.g., evicted by another process in the meantime)
+    or does not match the voxels of run_mask. """
+    f_meta = op.join(cache_dir, key + '.json')
+    try:
+        with open(f_meta) as f_in:
+            meta = json.load(f_in)
+        idx = np.load(op.join(cache_dir, key + '_idx.npy'))
+        Y = np.load(op.join(cache_dir, key + '.npy'), mmap_mode='c')
+        os.utime(f_meta)  # mark as recently used
+    except (OSError, ValueError):  # incl. truncated/corrupt files
+        return None
+
+    if Y.shape != (meta['shape'][3], idx.size) or not np.array_equal(idx, np.flatnonzero(run_mask)):
+        return None
+
+    return Y
+
+
+def load_masked(f, mask_file, cache_dir=None, mask=None, quota=QUOTA):
+    """ Loads the time series of a 4D image within its mask, through the cache.
+
+    Parameters
+    ----------
+    f : str
+        Path to 4D (BOLD) image.
+    mask_file : str
+        Path to the mask of f (e.g., its desc-brain_mask file).
+    cache_dir : str
+        Cache directory; if None, the data is read without caching.
+    mask : np.ndarray
+        Boolean 3D array with a subset of the voxels of mask_file (e.g., the
+        intersection of several runs' masks) to return; if None, all voxels
+        of mask_file are returned.
+    quota : int
+        Maximum size (in bytes) of the cache.
+
+    Returns
+    -------
+    Y : np.ndarray
+        Float32 data (time x voxels). Cached data is memory-mapped
+        copy-on-write, so it can be modified in place without changing
+        the cache.
+    """
+    run_mask, _ = load_mask(mask_file)
+    if cache_dir is None:
+        return apply_mask(f, run_mask if mask is None else mask)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    key = _key(f, mask_file)
+    f_data = op.join(cache_dir, key + '.npy')
+    f_meta = op.join(cache_dir, key + '.json')
+    Y = _read_entry(key, cache_dir, run_mask) if op.isfile(f_meta) else None
+    if Y is None:  # (re)build the entry
+        # Decompress straight into the (memory-mapped) cache file
+        tmp = f'{f_data}.{os.getpid()}.tmp.npy'
+        img = nib.load(f)
+        shape = (img.shape[3], int(run_mask.sum()))
+        Y = np.lib.format.open_memmap(tmp, mode='w+', dtype=np.float32, shape=shape)
+        apply_mask(f, run_mask, out=Y)
+        Y.flush()
+        del Y
+        os.replace(tmp, f_data)
+        Y = np.load(f_data, mmap_mode='c')
+        _save(np.flatnonzero(run_mask), op.join(cache_dir, key + '_idx.npy'))
+        meta = dict(
+            source=op.abspath(f), mask=op.abspath(mask_file), shape=list(img.shape),
+            zooms=[float(z) for z in img.header.get_zooms()], affine=img.affine.tolist()
+        )
+        tmp = f'{f_meta}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as f_out:
+            json.dump(meta, f_out, indent=4)
+        os.replace(tmp, f_meta)  # entry is complete once its json exists
+        _evict(cache_dir, quota)
+
+    if mask is not None:
+        if (mask & ~run_mask).any():
+            raise ValueError(f"Mask contains voxels outside {mask_file}.")
+        Y = Y[:, mask[run_mask]]
+
+    return Y
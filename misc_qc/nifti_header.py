@@ -0,0 +1,136 @@
+""" Reads NIfTI headers without loading (or decompressing) the image data.
+For gzipped files, only the first few hundred bytes are decompressed. Also
+creates NIfTI files whose data can be written in parts (through a memory
+map if uncompressed, or sequentially if gzipped). """
+import os
+import gzip
+import pickle
+import struct
+import numpy as np
+import os.path as op
+import nibabel as nib
+from joblib import Parallel, delayed
+
+
+def read_header(path):
+    """ Reads the NIfTI-1/2 header of path.
+
+    Parameters
+    ----------
+    path : str
+        Path to .nii or .nii.gz file.
+
+    Returns
+    -------
+    hdr : Nifti1Header or Nifti2Header
+        Header (e.g., hdr.get_data_shape(), hdr.get_zooms()).
+    """
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rb') as f_in:
+        block = f_in.read(540)
+
+    for endian in '<>':
+        sizeof_hdr = struct.unpack(endian + 'i', block[:4])[0]
+        if sizeof_hdr == 348:
+            return nib.Nifti1Header(block[:348])
+        elif sizeof_hdr == 540:
+            return nib.Nifti2Header(block)
+
+    raise ValueError(f"{path} is not a NIfTI file.")
+
+
+def get_shape(path):
+    """ Returns the data shape of path, e.g., to get the number of volumes. """
+    return read_header(path).get_data_shape()
+
+
+def _summarize(path):
+    """ Returns the (file size, mtime) of path and the specs from its header. """
+    st = os.stat(path)
+    hdr = read_header(path)
+    specs = dict(
+        dim=tuple(int(d) for d in hdr['dim']),
+        pixdim=tuple(float(p) for p in hdr['pixdim']),
+        datatype=str(hdr.get_data_dtype()),
+        qform_code=int(hdr['qform_code']),
+        sform_code=int(hdr['sform_code']),
+        file_size=st.st_size
+    )
+    return (st.st_size, st.st_mtime_ns), specs
+
+
+def scan_headers(files, n_jobs=1, cache_file=None):
+    """ Reads the header specs of many files in parallel threads. If cache_file
+    is given, results are cached, keyed on path, size and mtime, so that
+    only new (or changed) files are read on subsequent calls.
+
+    Parameters
+    ----------
+    files : list
+        List of paths to .nii(.gz) files.
+    n_jobs : int
+        Number of threads.
+    cache_file : str
+        Path to (pickle) cache file; if None, nothing is cached.
+
+    Returns
+    -------
+    specs : list
+        List of dicts with dim, pixdim, datatype, qform_code, sform_code and
+        file_size, in the order of files.
+    """
+    cached = {}
+    if cache_file is not None and op.isfile(cache_file):
+        with open(cache_file, 'rb') as f_in:
+            cached = pickle.load(f_in)
+
+    stats = Parallel(n_jobs=n_jobs, prefer='threads')(delayed(os.stat)(f) for f in files)
+    keys = [(st.st_size, st.st_mtime_ns) for st in stats]
+    todo = [f for f, key in zip(files, keys) if cached.get(f, (None,))[0] != key]
+    results = Parallel(n_jobs=n_jobs, prefer='threads')(delayed(_summarize)(f) for f in todo)
+    new = dict(zip(todo, results))
+
+    if cache_file is not None and new:
+        cache = {f: new.get(f, cached.get(f)) for f in files}
+        tmp = f'{cache_file}.{os.getpid()}.tmp'
+        with open(tmp, 'wb') as f_out:
+            pickle.dump(cache, f_out, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, cache_file)
+
+    return [new[f][1] if f in new else cached[f][1] for f in files]
+
+
+def _float32_header(shape, affine, zooms=None):
+    """ Returns the header of a float32 NIfTI file (data at offset 352). """
+    hdr = nib.Nifti1Header()
+    hdr.set_data_shape(shape)
+    hdr.set_data_dtype(np.float32)
+    hdr.set_qform(affine, code=1)
+    hdr.set_sform(affine, code=1)
+    if zooms is not None:
+        hdr.set_zooms(zooms)
+    hdr['vox_offset'] = 352
+    return hdr
+
+
+def allocate_nifti(f_out, shape, affine, zooms=None):
+    """ Creates an uncompressed float32 NIfTI file of the given shape, without
+    writing its data (which can be filled in later through open_nifti). """
+    with open(f_out, 'wb') as f:
+        _float32_header(shape, affine, zooms).write_to(f)
+        f.write(b'\x00' * 4)  # no extensions
+        f.truncate(352 + int(np.prod(shape)) * 4)
+
+
+def open_nifti_gz(f_out, shape, affine, zooms=None, compresslevel=1):
+    """ Creates a gzipped float32 NIfTI file and returns it (opened for writing,
+    after the header), so that its data can be written sequentially, e.g.,
+    a few volumes at a time as f.write(vols.tobytes(order='F')). """
+    f = gzip.open(f_out, 'wb', compresslevel=compresslevel)
+    _float32_header(shape, affine, zooms).write_to(f)  # incl. (empty) extensions
+    return f
+
+
+def open_nifti(f_out, shape):
+    """ Memory-maps the data of a file created by allocate_nifti. """
+    return np.memmap(f_out, dtype=np.float32, mode='r+', offset=352, shape=shape, order='F')
@@ -0,0 +1,278 @@
+""" Nonparametric (permutation-based) group inference for t-contrasts, as a
+replacement for FSL's randomise. Uses sign-flipping for one-sample designs
+and Freedman-Lane permutation of the residuals of the nuisance model
+otherwise. Many permutations are evaluated with a single matrix multiply and
+blocks of permutations are distributed across processes (each with its own,
+reproducible, random seed). Outputs (1 - p)-maps like randomise, both
+uncorrected and corrected (max-stat) for voxelwise statistics and TFCE. """
+import numpy as np
+import nibabel as nib
+import os.path as op
+from scipy import ndimage
+from joblib import Parallel, delayed
+
+BLOCK_SIZE = 250  # permutations per process/seed
+MAX_BATCH_BYTES = 2 ** 28  # memory for the permuted projections per batch
+TOL = 1e-5  # relative tolerance (float32) to count the unpermuted statistic itself
+
+
+def read_vest(path):
+    """ Reads the matrix of an FSL VEST file (e.g., design.mat or design.con). """
+    with open(path, 'r') as f_in:
+        lines = f_in.read().splitlines()
+
+    start = [i for i, line in enumerate(lines) if line.startswith('/Matrix')][0] + 1
+    return np.array([[float(v) for v in line.split()] for line in lines[start:] if line.strip()])
+
+
+def _partition(X, c):
+    """ Partitions the design into the effect of interest and nuisance regressors
+    (Guttman, 1982) and returns the residual-forming matrix of the nuisance model,
+    and an orthonormal basis of the full model of which the first column is the
+    effect of interest (orthogonalized w.r.t. the nuisance). """
+    c = np.atleast_2d(c)
+    Xi = X @ np.linalg.pinv(c)
+    Qz = _orth(X @ _null_space(c))
+    Rz = np.eye(X.shape[0]) - Qz @ Qz.T
+    x = Rz @ Xi
+    Q = np.hstack((x / np.linalg.norm(x), Qz))
+    return Rz, Q
+
+
+def _orth(A, tol=1e-10):
+    """ Returns an orthonormal basis of the column space of A. """
+    if A.shape[1] == 0:
+        return A
+
+    U, s, _ = np.linalg.svd(A, full_matrices=False)
+    return U[:, s > tol * s.max()]
+
+
+def _null_space(c, tol=1e-10):
+    """ Returns an orthonormal basis of the null space of c. """
+    _, s, Vt = np.linalg.svd(c)
+    rank = np.sum(s > tol * max(s.max(), 1))
+    return Vt[rank:].T
+
+
+def _tstat(proj, ss, dof):
+    """ Computes t-values from the projections of (permuted) data on the
+    orthonormal basis of the model (first row: effect of interest). """
+    sigma2 = (ss - np.einsum('...ij,...ij->...j', proj, proj)) / dof
+    return proj[..., 0, :] / np.sqrt(np.maximum(sigma2, 1e-30))
+
+
+def tfce(stat, mask, E=0.5, H=2, n_steps=100):
+    """ Threshold-free cluster enhancement (Smith & Nichols, 2009) of the
+    positive values of stat (voxels within the 3D mask), with 26-connectivity. """
+    out = np.zeros(stat.shape)
+    vol = np.zeros(mask.shape)
+    vol[mask] = stat
+    dh = stat.max() / n_steps
+    if dh <= 0:
+        return out
+
+    structure = np.ones((3, 3, 3))
+    for h in np.arange(dh, stat.max() + dh / 2, dh):
+        labels, n = ndimage.label(vol >= h, structure=structure)
+        if n == 0:
+            break
+        sizes = np.bincount(labels.ravel())
+        sizes[0] = 0
+        out += (sizes[labels[mask]] ** E) * (h ** H) * dh
+
+    return out
+
+
+def _permutations(rng, n, n_perm, sign_flip, include_identity):
+    """ Generates sign-flips (+1/-1, n_perm x n) or permutations (indices). """
+    if sign_flip:
+        perms = rng.choice([-1., 1.], size=(n_perm, n))
+        if include_identity:
+            perms[0] = 1
+    else:
+        perms = np.array([rng.permutation(n) for _ in range(n_perm)]).reshape(n_perm, n)
+        if include_identity:
+            perms[0] = np.arange(n)
+
+    return perms
+
+
+def _run_block(Ry, Q, ss, dof, t_obs, tfce_obs, mask, sign_flip, seed, n_perm, include_identity, do_tfce):
+    """ Runs a block of permutations and returns the exceedance counts
+    (per voxel) and the max-statistics (per permutation). """
+    rng = np.random.default_rng(seed)
+    perms = _permutations(rng, Ry.shape[0], n_perm, sign_flip, include_identity)
+
+    r = Q.shape[1]
+    batch = max(1, int(MAX_BATCH_BYTES // (r * Ry.shape[1] * Ry.itemsize)))
+    counts = np.zeros(Ry.shape[1], dtype=np.int64)
+    max_t = np.zeros(n_perm)
+    counts_tfce = np.zeros(Ry.shape[1], dtype=np.int64) if do_tfce else None
+    max_tfce = np.zeros(n_perm) if do_tfce else None
+
+    for i in range(0, n_perm, batch):
+        these = perms[i:i + batch]
+        if sign_flip:  # W_b = (S_b Q)'
+            W = (these[:, :, None] * Q[None, :, :]).transpose(0, 2, 1)
+        else:  # W_b = (P_b Q)'
+            W = Q[these].transpose(0, 2, 1)
+
+        W = W.reshape(-1, Ry.shape[0]).astype(Ry.dtype)
+        proj = (W @ Ry).reshape(these.shape[0], r, Ry.shape[1])
+        t = _tstat(proj, ss, dof)
+        counts += (t >= t_obs - TOL * np.abs(t_obs)).sum(axis=0)
+        max_t[i:i + batch] = t.max(axis=1)
+        if do_tfce:
+            for j in range(t.shape[0]):
+                t_tfce = tfce(t[j], mask)
+                counts_tfce += t_tfce >= tfce_obs - TOL * tfce_obs
+                max_tfce[i + j] = t_tfce.max()
+
+    return counts, max_t, counts_tfce, max_tfce
+
+
+def _exceedance(null, stat):
+    """ Returns the proportion of the null distribution (e.g., of max-stats)
+    that is at least as large as stat. """
+    null = np.sort(null)
+    idx = np.searchsorted(null, stat - TOL * np.abs(stat), side='left')
+    return (null.size - idx) / null.size
+
+
+def randomise(Y, X, contrasts, mask=None, n_perm=5000, do_tfce=False, seed=None, n_jobs=1):
+    """ Permutation-based inference of t-contrasts.
+
+    Parameters
+    ----------
+    Y : np.ndarray
+        Data (subjects x voxels).
+    X : np.ndarray
+        Design matrix (subjects x regressors).
+    contrasts : np.ndarray
+        Contrast vectors (contrasts x regressors).
+    mask : np.ndarray
+        Boolean 3D mask (voxels == mask.sum()); needed for TFCE.
+    n_perm : int
+        Number of permutations (including the unpermuted data).
+    do_tfce : bool
+        Whether to compute TFCE statistics.
+    seed : int
+        Seed of the random number generator.
+    n_jobs : int
+        Number of processes.
+
+    Returns
+    -------
+    results : list
+        Per contrast, a dict with tstat, vox_p, vox_corrp (and tfce, tfce_p,
+        tfce_corrp) maps (voxels,), where p-maps are 1 - p (like randomise).
+    """
+    Y = np.asarray(Y, dtype=np.float32)
+    X = np.asarray(X, dtype=np.float64)
+    contrasts = np.atleast_2d(contrasts)
+    n = X.shape[0]
+
+    # Sign-flipping for intercept-only designs (one-sample t-test)
+    sign_flip = X.shape[1] == 1 and np.allclose(X, X[0])
+
+    # Fixed block size, so results do not depend on n_jobs
+    blocks = [(i, min(BLOCK_SIZE, n_perm - i)) for i in range(0, n_perm, BLOCK_SIZE)]
+    seeds = np.random.SeedSequence(seed).spawn(len(blocks))
+
+    results = []
+    for c in contrasts:
+        Rz, Q = _partition(X, c)
+        dof = n - Q.shape[1]
+        Ry = (Rz @ Y).astype(np.float32)
+        ss = np.einsum('ij,ij->j', Ry, Ry)
+        t_obs = _tstat(Q.T.astype(np.float32) @ Ry, ss, dof)
+        tfce_obs = tfce(t_obs, mask) if do_tfce else None
+
+        out = Parallel(n_jobs=n_jobs)(
+            delayed(_run_block)(
+                Ry, Q, ss, dof, t_obs, tfce_obs, mask, sign_flip, s, size, i == 0, do_tfce
+            ) for (i, size), s in zip(blocks, seeds)
+        )
+
+        counts = sum(o[0] for o in out)
+        max_t = np.concatenate([o[1] for o in out])
+        res = dict(
+            tstat=t_obs,
+            vox_p=1 - counts / n_perm,
+            vox_corrp=1 - _exceedance(max_t, t_obs)
+        )
+        if do_tfce:
+            counts_tfce = sum(o[2] for o in out)
+            max_tfce = np.concatenate([o[3] for o in out])
+            res.update(
+                tfce=tfce_obs,
+                tfce_p=1 - counts_tfce / n_perm,
+                tfce_corrp=1 - _exceedance(max_tfce, tfce_obs)
+            )
+        results.append(res)
+
+    return results
+
+
+def main(in_file, out_base, mask_file, design=None, contrasts=None, n_perm=5000,
+         do_tfce=False, voxelwise=False, seed=None, n_jobs=1):
+    """ Runs randomise-like inference on a 4D image (one volume per subject) and
+    writes {out_base}_tstat{i}, {out_base}_tfce_(corr)p_tstat{i} (with TFCE)
+    and {out_base}_vox_(corr)p_tstat{i} (voxelwise) images. If design is None,
+    a one-sample t-test (randomise -1) is run. """
+    mask_img = nib.load(mask_file)
+    mask = np.asanyarray(mask_img.dataobj) != 0
+    img = nib.load(in_file)
+    data = np.asarray(img.dataobj, dtype=np.float32)
+    if data.ndim == 3:
+        data = data[..., None]
+    Y = data[mask].T
+    del data
+
+    if design is None:  # one-sample t-test
+        X, C = np.ones((Y.shape[0], 1)), np.ones((1, 1))
+    else:
+        X, C = read_vest(design), read_vest(contrasts)
+
+    if X.shape[0] != Y.shape[0]:
+        raise ValueError(f"Design has {X.shape[0]} rows, but data has {Y.shape[0]} volumes.")
+
+    results = randomise(Y, X, C, mask, n_perm=n_perm, do_tfce=do_tfce, seed=seed, n_jobs=n_jobs)
+    for i, res in enumerate(results):
+        to_save = {'tstat': res['tstat']}
+        if voxelwise:
+            to_save.update(vox_p_tstat=res['vox_p'], vox_corrp_tstat=res['vox_corrp'])
+        if do_tfce:
+            to_save.update(tfce_p_tstat=res['tfce_p'], tfce_corrp_tstat=res['tfce_corrp'])
+
+        for name, values in to_save.items():
+            vol = np.zeros(mask.shape, dtype=np.float32)
+            vol[mask] = values
+            nib.Nifti1Image(vol, mask_img.affine).to_filename(f'{out_base}_{name}{i + 1}.nii.gz')
+
+
+if __name__ == '__main__':
+
+    import argparse
+    parser = argparse.ArgumentParser(description='Permutation-based inference (like randomise)')
+    parser.add_argument('-i', dest='in_file', type=str, required=True, help='4D input image')
+    parser.add_argument('-o', dest='out_base', type=str, required=True, help='Output basename')
+    parser.add_argument('-m', dest='mask', type=str, required=True, help='Mask image')
+    parser.add_argument('-d', dest='design', type=str, default=None, help='Design matrix (design.mat)')
+    parser.add_argument('-t', dest='contrasts', type=str, default=None, help='Contrasts (design.con)')
+    parser.add_argument('-1', dest='one_sample', action='store_true', help='One-sample t-test')
+    parser.add_argument('-n', dest='n_perm', type=int, default=5000, help='Number of permutations')
+    parser.add_argument('-T', dest='tfce', action='store_true', help='TFCE')
+    parser.add_argument('-x', dest='voxelwise', action='store_true', help='Voxelwise (corrected) p-values')
+    parser.add_argument('--seed', type=int, default=None, help='Random seed')
+    parser.add_argument('--n_jobs', type=int, default=1, help='Number of processes')
+    args = parser.parse_args()
+
+    if not args.one_sample and (args.design is None or args.contrasts is None):
+        parser.error("Specify either -1 or both -d and -t.")
+
+    design = None if args.one_sample else args.design
+    main(args.in_file, op.abspath(args.out_base), args.mask, design, args.contrasts,
+         n_perm=args.n_perm, do_tfce=args.tfce, voxelwise=args.voxelwise,
+         seed=args.seed, n_jobs=args.n_jobs)
@@ -0,0 +1,131 @@
+""" Runs all participant-level fMRI analyses in a single pass over the dataset:
+TSNR (compute_tsnr_fmri.py), the task GLMs of all tasks in TASK_INFO
+(run_task_fmri_models.py), in MNI space and on the fsaverage5 surfaces, and
+the RETROICOR GLM of every (volumetric) run with physiology regressors
+(run_physio_fmri_models.py). Each run is loaded once (volumetric runs through
+the masked-data cache, with --cache_dir) and passed to every analysis that applies to
+it; subjects are distributed across processes. Outputs are written to the
+same derivatives directories as the separate scripts. """
+import os
+import click
+import warnings
+import numpy as np
+import nibabel as nib
+import os.path as op
+from tqdm import tqdm
+from joblib import Parallel, delayed
+from bids_index import load_index, index_glob
+from nifti_header import read_header
+from glm import load_mask
+from masked_cache import load_masked
+
+# nistats (imported by the task models) warns about its deprecation
+for category in (DeprecationWarning, FutureWarning):
+    warnings.filterwarnings('ignore', message='.*[Nn]istats', category=category)
+
+import compute_tsnr_fmri as tsnr
+import run_task_fmri_models as task_models
+import run_physio_fmri_models as physio_models
+
+SPACE = 'MNI152NLin2009cAsym'
+VOL_EXT = 'desc-preproc_bold.nii.gz'
+SURF_SPACES = ('fsaverage5_hemi-L.func.gii', 'fsaverage5_hemi-R.func.gii')
+N_VOLS = 32  # timepoints per chunk for TSNR
+
+
+def _run_subject(bids_dir, sub_base, funcs, surfs, out_dirs, cache_dir=None):
+    """ Runs all analyses on the runs of a single subject. """
+    tasks = {}
+    for func in funcs:
+        task = func.split('task-')[1].split('_')[0]
+        if task in task_models.TASK_INFO:
+            tasks.setdefault(task, []).append(func)
+
+    # Task runs are analyzed within the intersection of their masks and the
+    # physiology effects are averaged within the union of their masks
+    task_masks = {task: task_models.get_mask(these) for task, these in tasks.items()}
+    physio_funcs = [func for func in funcs if op.isfile(physio_models.ricor_file(bids_dir, func))]
+    if physio_funcs:
+        physio_mask, physio_affine = physio_models.get_mask(physio_funcs)
+
+    acc = {}
+    for func in funcs:
+        mask_file = func.replace('preproc_bold', 'brain_mask')
+        run_mask, _ = load_mask(mask_file)
+        Y = load_masked(func, mask_file, cache_dir)
+
+        mean_, sd_ = tsnr.running_mean_std(Y[i:i + N_VOLS] for i in range(0, Y.shape[0], N_VOLS))
+        tsnr.save_tsnr(func, out_dirs['tsnr'], f'{SPACE}_{VOL_EXT}', mean_, sd_)
+
+        task = func.split('task-')[1].split('_')[0]
+        if task in task_masks:
+            mask, affine = task_masks[task]
+            res = task_models.fit_run(bids_dir, func, task, Y[:, mask[run_mask]], read_header(func))
+            if res is not None:
+                task_models.save_run(func, out_dirs['task'], SPACE, *res, mask=mask, affine=affine)
+
+        # Last analysis, as it demeans Y in place (copy-on-write if cached)
+        if func in physio_funcs:
+            names, effects = physio_models.fit_run(bids_dir, func, Y)
+            physio_models.accumulate(acc, names, effects, idx=run_mask[physio_mask])
+
+        del Y
+
+    if acc:
+        physio_models.save_firstlevel(
+            acc, sub_base, '', SPACE, out_dirs['physio'], mask=physio_mask, affine=physio_affine
+        )
+
+    for f, space in surfs:
+        Y = np.vstack([arr.data for arr in nib.load(f).darrays]).astype(np.float32)
+        mean_, sd_ = tsnr.running_mean_std(Y[i:i + N_VOLS] for i in range(0, Y.shape[0], N_VOLS))
+        tsnr.save_tsnr(f, out_dirs['tsnr'], space, mean_, sd_)
+
+        task = f.split('task-')[1].split('_')[0]
+        if task in task_models.TASK_INFO:
+            func_vol = f.split('space')[0] + f'space-{SPACE}_{VOL_EXT}'
+            res = task_models.fit_run(bids_dir, f, task, Y, read_header(func_vol))
+            if res is not None:
+                task_models.save_run(f, out_dirs['task'], space, *res)
+
+        del Y
+
+
+@click.command()
+@click.argument('bids_dir', type=click.Path())
+@click.option('--n_jobs', default=1, type=int)
+@click.option('--cache_dir', default=None, help="Masked-data cache directory (optional)")
+def main(bids_dir, n_jobs, cache_dir):
+    """ Runs all participant-level fMRI analyses. """
+
+    out_dirs = dict(
+        tsnr=op.join(bids_dir, 'derivatives', 'tsnr'),
+        task=op.join(bids_dir, 'derivatives', 'task_fmri'),
+        physio=op.join(bids_dir, 'derivatives', 'physio_fmri')
+    )
+    for out_dir in out_dirs.values():
+        if not op.isdir(out_dir):
+            os.makedirs(out_dir)
+
+    fmriprep_dir = op.join(bids_dir, 'derivatives', 'fmriprep')
+    print(f"INFO: using data from {fmriprep_dir}")
+    index = load_index(bids_dir)
+    sub_funcs, sub_surfs = {}, {}
+    for f in index_glob(index, op.join(fmriprep_dir, 'sub-*', 'func', f'*space-{SPACE}_{VOL_EXT}')):
+        sub_funcs.setdefault(op.basename(f).split('_')[0], []).append(f)
+
+    for space in SURF_SPACES:
+        for f in index_glob(index, op.join(fmriprep_dir, 'sub-*', 'func', f'*space-{space}')):
+            sub_surfs.setdefault(op.basename(f).split('_')[0], []).append((f, space))
+
+    subs = sorted(set(sub_funcs) | set(sub_surfs))
+    print(f"INFO: running all analyses for {len(subs)} subjects")
+    Parallel(n_jobs=n_jobs)(
+        delayed(_run_subject)(
+            bids_dir, sub, sub_funcs.get(sub, []), sub_surfs.get(sub, []), out_dirs, cache_dir
+        ) for sub in tqdm(subs)
+    )
+
+
+if __name__ == '__main__':
+    main()
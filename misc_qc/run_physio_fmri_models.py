@@ -6,82 +6,123 @@ import os.path as op
 import nibabel as nib
 from tqdm import tqdm
 from glob import glob
+from bids_index import load_index, index_glob
+from glm import load_mask, fit_glm, stream_betas, fit_group, unmask
+from masked_cache import load_masked
 from joblib import Parallel, delayed
-from nilearn import masking, image
-from nistats.design_matrix import make_first_level_design_matrix
-from nistats.first_level_model import run_glm
-from nistats.contrasts import compute_contrast, expression_to_contrast_vector
-from nistats.second_level_model import SecondLevelModel
 
+TO_SAVE = ('resp', 'cardiac', 'interaction', 'hrv', 'rvt')
 
-def fit_firstlevel(bids_dir, sub, acq, space, out_dir):
 
-    sub_base = op.basename(sub)
+def _find_funcs(sub, acq, space, index=None):
+    """ Finds the preprocessed functional files of a subject (using the
+    dataset index, if given). """
     ext = 'func.gii' if 'fs' in space else 'desc-preproc_bold.nii.gz'
-        
-    funcs = sorted(glob(op.join(
-        sub, 'func', f'*{acq}*_space-{space}*{ext}'
-    )))
-    
-    to_save = ['resp', 'cardiac', 'interaction', 'hrv', 'rvt']
-    cons = {}
-    for func in funcs:
-        f_base = op.basename(func).split('space')[0]
-        ricor = op.join(bids_dir, 'derivatives', 'physiology', sub_base, 'physio', f_base + 'recording-respcardiac_desc-retroicor_regressors.tsv')
-        if not op.isfile(ricor):
-            continue
-
-        ricor = pd.read_csv(ricor, sep='\t')
-        conf = op.join(bids_dir, 'derivatives', 'fmriprep', sub_base, 'func', f_base + 'desc-confounds_regressors.tsv')
-        conf = pd.read_csv(conf, sep='\t')
-        cols = [col for col in conf.columns if 'cosine' in col]
-        cols += ['trans_x', 'trans_y', 'trans_z', 'rot_x', 'rot_y', 'rot_z']    
-        conf = conf.loc[:, cols]
-        dm = pd.concat((conf, ricor), axis=1)
-
-        if 'fs' in space:
-            Y = np.vstack([arr.data for arr in nib.load(func).darrays])
+    pattern = op.join(sub, 'func', f'*{acq}*_space-{space}*{ext}')
+    return sorted(glob(pattern)) if index is None else index_glob(index, pattern)
+
+
+def ricor_file(bids_dir, func):
+    """ Returns the path to the RETROICOR regressors of a run. """
+    f_base = op.basename(func).split('space')[0]
+    sub_base = f_base.split('_')[0]
+    return op.join(bids_dir, 'derivatives', 'physiology', sub_base, 'physio', f_base + 'recording-respcardiac_desc-retroicor_regressors.tsv')
+
+
+def fit_run(bids_dir, func, Y):
+    """ Fits the RETROICOR model of a single run to its data (time x voxels,
+    which is demeaned in place) and returns the names and effects (regressors
+    x voxels) of the physiology regressors, which are read directly from the
+    parameter estimates. """
+    f_base = op.basename(func).split('space')[0]
+    sub_base = f_base.split('_')[0]
+    ricor = pd.read_csv(ricor_file(bids_dir, func), sep='\t')
+    conf = op.join(bids_dir, 'derivatives', 'fmriprep', sub_base, 'func', f_base + 'desc-confounds_regressors.tsv')
+    conf = pd.read_csv(conf, sep='\t')
+    cols = [col for col in conf.columns if 'cosine' in col]
+    cols += ['trans_x', 'trans_y', 'trans_z', 'rot_x', 'rot_y', 'rot_z']    
+    conf = conf.loc[:, cols]
+    dm = pd.concat((conf, ricor), axis=1)
+
+    names = [col for col in dm.columns if any(ts in col for ts in TO_SAVE)]
+    C = np.eye(dm.shape[1])[[dm.columns.get_loc(name) for name in names]]
+    Y -= Y.mean(axis=0)
+    effects, _ = fit_glm(Y, dm.to_numpy(), C, noise_model='ar1')
+    return names, effects
+
+
+def accumulate(acc, names, effects, idx=None):
+    """ Adds the effects of a run to the running sums (and counts) per
+    regressor in acc (dict with name -> [sum, count]). For volumetric data,
+    idx selects the run's voxels within the voxels of the accumulator (i.e.,
+    the union of the masks of all runs); runs contribute zeros outside their
+    mask (like averaging the unmasked images). """
+    for name, effect in zip(names, effects):
+        if name not in acc:
+            n_vox = effect.size if idx is None else idx.size
+            acc[name] = [np.zeros(n_vox), 0]
+
+        if idx is None:
+            acc[name][0] += effect
         else:
-            mask = func.replace('preproc_bold', 'brain_mask')
-            Y = masking.apply_mask(func, mask)
-
-        Y -= Y.mean(axis=0)
-        X = dm.to_numpy()
-        labels, results = run_glm(Y=Y, X=X, noise_model='ar1')
-
-        for contrast in dm.columns.tolist():
-            if not any(ts in contrast for ts in to_save):
-                continue
-
-            con_val = expression_to_contrast_vector(contrast, dm.columns)
-            this_beta = compute_contrast(labels, results, con_val).effect_size()
-            if not contrast in cons.keys():
-                cons[contrast] = []
-            
-            if 'fs' not in space:
-                this_beta = masking.unmask(this_beta, mask)
-
-            cons[contrast].append(this_beta)
-    
+            acc[name][0][idx] += effect
+        acc[name][1] += 1
+
+
+def save_firstlevel(acc, sub_base, acq, space, out_dir, mask=None, affine=None):
+    """ Writes the average effect of each regressor across runs (from the
+    running sums in acc), within mask for volumetric data. """
     sub_out = op.join(out_dir, sub_base, 'firstlevel')
     if not op.isdir(sub_out):
-        os.makedirs(sub_out)
+        os.makedirs(sub_out, exist_ok=True)
 
     f_base = sub_base + acq
-    for contrast, values in cons.items():
-
-        if 'fs' in space:
-            mean_con = np.r_[values].mean(axis=0)
-        else:
-            mean_con = image.mean_img(values)
-
+    for contrast, (total, n) in acc.items():
+        mean_con = (total / n).astype(np.float32)
         f_base_con = f_base + f"_contrast-{contrast}"
         if 'fs' in space:
             f_out = op.join(sub_out, f_base_con + '_beta.npy')
             np.save(f_out, mean_con)
         else:         
             f_out = op.join(sub_out, f_base_con + '_beta.nii.gz')
-            mean_con.to_filename(f_out)
+            unmask(mean_con, mask, affine).to_filename(f_out)
+
+
+def get_mask(funcs):
+    """ Returns the union of the brain masks of (volumetric) runs. """
+    masks = [load_mask(func.replace('preproc_bold', 'brain_mask')) for func in funcs]
+    mask, affine = masks[0][0], masks[0][1]
+    for m, _ in masks[1:]:
+        mask = mask | m
+
+    return mask, affine
+
+
+def fit_firstlevel(bids_dir, sub, acq, space, out_dir, funcs=None, cache_dir=None):
+
+    sub_base = op.basename(sub)
+    if funcs is None:
+        funcs = _find_funcs(sub, acq, space)
+
+    funcs = [func for func in funcs if op.isfile(ricor_file(bids_dir, func))]
+    if not funcs:
+        return
+
+    mask, affine = (None, None) if 'fs' in space else get_mask(funcs)
+    acc = {}
+    for func in funcs:
+        if 'fs' in space:
+            Y = np.vstack([arr.data for arr in nib.load(func).darrays])
+            idx = None
+        else:
+            mask_file = func.replace('preproc_bold', 'brain_mask')
+            Y = load_masked(func, mask_file, cache_dir)
+            idx = load_mask(mask_file)[0][mask]
+
+        accumulate(acc, *fit_run(bids_dir, func, Y), idx=idx)
+        del Y
+
+    save_firstlevel(acc, sub_base, acq, space, out_dir, mask=mask, affine=affine)
     
 
 @click.command()
@@ -92,7 +133,8 @@ def fit_firstlevel(bids_dir, sub, acq, space, out_dir):
 @click.option('--space', default='MNI152NLin2009cAsym')
 @click.option('--smoothing', default=None, type=click.FLOAT)
 @click.option('--n_jobs', default=1, type=int)
-def main(bids_dir, out_dir, level, acq, space, smoothing, n_jobs):
+@click.option('--cache_dir', default=None, help="Masked-data cache directory (optional)")
+def main(bids_dir, out_dir, level, acq, space, smoothing, n_jobs, cache_dir):
     """ BIDS-app format. """
 
     if acq is None:
@@ -105,8 +147,12 @@ def main(bids_dir, out_dir, level, acq, space, smoothing, n_jobs):
     
     if level == 'participant':
         fprep_dir = op.join(bids_dir, 'derivatives', 'fmriprep')
-        subs = sorted(glob(op.join(fprep_dir, 'sub-????')))
-        _ = Parallel(n_jobs=n_jobs)(delayed(fit_firstlevel)(bids_dir, sub, acq, space, out_dir) for sub in tqdm(subs))
+        index = load_index(bids_dir)
+        subs = index_glob(index, op.join(fprep_dir, 'sub-????'))
+        _ = Parallel(n_jobs=n_jobs)(delayed(fit_firstlevel)
+            (bids_dir, sub, acq, space, out_dir, funcs=_find_funcs(sub, acq, space, index), cache_dir=cache_dir)
+            for sub in tqdm(subs)
+        )
     else:
         ext = 'npy' if 'fs' in space else 'nii.gz'
         to_iter = ['_hemi-L', '_hemi-R'] if 'fs' in space else ['']
@@ -126,18 +172,6 @@ def main(bids_dir, out_dir, level, acq, space, smoothing, n_jobs):
                 else:
                     dm = pd.DataFrame(np.ones(len(betas)), columns=['intercept'])
 
-                if 'fs' not in space:
-                    if smoothing is not None:
-                        betas = [image.smooth_img(b, smoothing) for b in betas]
-                    
-                    mean_img = image.mean_img(betas)
-                    mask = (mean_img.get_fdata() != 0).astype(int)
-                    mask = nib.Nifti1Image(mask, affine=mean_img.affine)
-                    Y = masking.apply_mask(betas, mask)
-                else:
-                    Y = np.vstack([np.load(b) for b in betas])
-
-                labels, results = run_glm(Y, dm.values, noise_model='ols', n_jobs=n_jobs)
                 if '*' in cname:
                     cname = cname.replace('*', '')
                     these_cols = [col for col in dm.columns if cname in col]
@@ -147,16 +181,21 @@ def main(bids_dir, out_dir, level, acq, space, smoothing, n_jobs):
                     con_def = [1]
                     con_type = 't'
 
-                cname = cname.replace('*', '')
-                group_result = compute_contrast(labels, results, con_def, contrast_type=con_type)
-                out = group_result.z_score()
+                f_tmp = op.join(out_dir, f'.contrast-{cname}{s}{acq}_betas.npy')
+                try:
+                    mask, shape, affine = stream_betas(betas, f_tmp, smoothing=None if 'fs' in space else smoothing)
+                    out = fit_group(f_tmp, mask, dm.values.astype(float), con_def, con_type=con_type, n_jobs=n_jobs)
+                finally:  # the stacked betas can be large
+                    if op.isfile(f_tmp):
+                        os.remove(f_tmp)
 
                 if 'fs' in space:
                     f_out = op.join(out_dir, f'contrast-{cname}{s}{acq}_desc-grouplevel_zscore.npy')
                     np.save(f_out, out)
                 else:
                     f_out = op.join(out_dir, f'contrast-{cname}{acq}_desc-grouplevel_zscore.nii.gz')
-                    to_save = masking.unmask(out, mask)
+                    mask = mask.reshape(shape)
+                    to_save = unmask(out.reshape(shape)[mask], mask, affine)
                     to_save.to_filename(f_out)
 
 if __name__ == '__main__':
@@ -1,3 +1,12 @@
+""" Fits the first-level (participant) and group-level models of the task fMRI
+data (see TASK_INFO for the contrasts). Surface data are saved as .npy files
+(one value per vertex) and volumetric data as NIfTI images.
+
+Note that the volumetric runs of a subject (for a given task) are analyzed
+within the intersection of their brain masks (so that all runs share the
+same voxels), whereas each run used to be analyzed within its own mask.
+Voxels outside the intersection are therefore zero in the first-level maps.
+"""
 import os
 import click
 import numpy as np
@@ -6,12 +15,13 @@ import os.path as op
 import nibabel as nib
 from tqdm import tqdm
 from glob import glob
+from bids_index import load_index, index_glob
+from nifti_header import read_header
+from glm import load_mask, unmask, fit_glm, stream_betas, fit_group
+from masked_cache import load_masked
 from joblib import Parallel, delayed
-from nilearn import masking, image
 from nistats.design_matrix import make_first_level_design_matrix
-from nistats.first_level_model import run_glm
-from nistats.contrasts import compute_contrast, expression_to_contrast_vector
-from nistats.second_level_model import SecondLevelModel
+from nistats.contrasts import expression_to_contrast_vector
 
 
 TASK_INFO = dict(
@@ -43,16 +53,9 @@ TASK_INFO = dict(
 )
 
 
-def fit_firstlevel(bids_dir, func, task, space, out_dir):
-
+def _load_events(bids_dir, func, task):
+    """ Loads the events of a run (recoding accuracy-based trial types). """
     sub_base = op.basename(func).split('_')[0]
-
-    conf = func.split('space')[0] + 'desc-confounds_regressors.tsv'
-    conf = pd.read_csv(conf, sep='\t')
-    cols = [col for col in conf.columns if 'cosine' in col]
-    cols += ['trans_x', 'trans_y', 'trans_z', 'rot_x', 'rot_y', 'rot_z']    
-    conf = conf.loc[:, cols]
-
     events = op.join(bids_dir, sub_base, 'func', op.basename(func).split('space')[0] + 'events.tsv')
     events = pd.read_csv(events, sep='\t')
 
@@ -65,20 +68,41 @@ def fit_firstlevel(bids_dir, func, task, space, out_dir):
             print(f"{func}: {prop_correct}")
             events['trial_type'] = events['trial_type'].replace({'correct': 'incorrect', 'miss': 'miss', 'incorrect': 'correct'})
 
-    if 'fs' in space:
-        func_vol = func.split('space')[0] + 'space-MNI152NLin2009cAsym_desc-preproc_bold.nii.gz'
-        hdr = nib.load(func_vol).header
-        Y = np.vstack([arr.data for arr in nib.load(func).darrays])
-    else:
-        mask = func.replace('preproc_bold', 'brain_mask')
-        Y = masking.apply_mask(func, mask)
-        hdr = nib.load(func).header
-    
+    return events
+
+
+def _get_contrasts(task, events, dm):
+    """ Returns the names and vectors of the contrasts of which all conditions
+    are present in the event file. """
+    names, con_vals = [], []
+    trial_types = events['trial_type'].unique().tolist()
+    for contrast, name in zip(TASK_INFO[task]['contrast'], TASK_INFO[task]['name']):
+        items = contrast.replace('-', '').replace('+', '').replace('*', '').split(' ')
+        items = [''.join([i for i in item if not i.isdigit()]) for item in items if item]
+        if all(item in trial_types for item in items):
+            names.append(name)
+            con_vals.append(expression_to_contrast_vector(contrast, dm.columns))
+
+    return names, con_vals
+
+
+def fit_run(bids_dir, func, task, Y, hdr):
+    """ Fits the first-level model of a single run to its data (time x voxels,
+    which is demeaned in place), where hdr is the header of the (volumetric)
+    run. Returns the names, effects and variances of the contrasts, or None
+    if none of the contrasts can be computed. """
+    conf = func.split('space')[0] + 'desc-confounds_regressors.tsv'
+    conf = pd.read_csv(conf, sep='\t')
+    cols = [col for col in conf.columns if 'cosine' in col]
+    cols += ['trans_x', 'trans_y', 'trans_z', 'rot_x', 'rot_y', 'rot_z']
+    conf = conf.loc[:, cols]
+    events = _load_events(bids_dir, func, task)
+
     tr, nvol = hdr['pixdim'][4], hdr['dim'][4]
     frame_times = np.linspace(0.5 * tr, tr * nvol, num=nvol, endpoint=False)
-    
+
     dm = make_first_level_design_matrix(
-        frame_times=frame_times, 
+        frame_times=frame_times,
         events=events,
         hrf_model='glover',
         drift_model=None,
@@ -86,36 +110,63 @@ def fit_firstlevel(bids_dir, func, task, space, out_dir):
         add_reg_names=conf.columns.tolist()
     )
 
+    names, con_vals = _get_contrasts(task, events, dm)
+    if not names:
+        return None
+
     Y -= Y.mean(axis=0)
-    X = dm.to_numpy()
-    labels, results = run_glm(Y=Y, X=X, noise_model='ar1')
+    effects, variances = fit_glm(Y, dm.to_numpy(), con_vals, noise_model='ar1')
+    return names, effects, variances
 
-    sub_out = op.join(out_dir, sub_base, 'firstlevel')
-    if not op.isdir(sub_out):
-        os.makedirs(sub_out)
 
-    for contrast, name in zip(TASK_INFO[task]['contrast'], TASK_INFO[task]['name']):
-        items = contrast.replace('-', '').replace('+', '').replace('*', '').split(' ')
-        items = [i for i in items if i]
-        trial_types = events['trial_type'].unique().tolist()
-        for item in items:
-            item = ''.join([i for i in item if not i.isdigit()])
-            if item not in trial_types:
-                break  # condition not present in event file
-        else:  # first time I've used a for-else clause I think
-            con_val = expression_to_contrast_vector(contrast, dm.columns)
-            con = compute_contrast(labels, results, con_val)
-            #stats = flm.compute_contrast(contrast, output_type='all')            
-            f_base = op.basename(func).split('.')[0]
-            f_base += f"_contrast-{name}"
-            if 'fs' in space:
-                f_out = op.join(sub_out, f_base + '_beta.npy')
-                np.save(f_out, con.effect_size())
-                np.save(f_out.replace('beta', 'varbeta'), con.effect_variance())
-            else:         
-                f_out = op.join(sub_out, f_base + '_beta.nii.gz')
-                masking.unmask(con.effect_size(), mask).to_filename(f_out)
-                masking.unmask(con.effect_variance(), mask).to_filename(f_out.replace('beta', 'varbeta'))
+def save_run(func, out_dir, space, names, effects, variances, mask=None, affine=None):
+    """ Writes the first-level effects and variances of a run. """
+    sub_out = op.join(out_dir, op.basename(func).split('_')[0], 'firstlevel')
+    if not op.isdir(sub_out):
+        os.makedirs(sub_out, exist_ok=True)
+
+    for i, name in enumerate(names):
+        f_base = op.basename(func).split('.')[0]
+        f_base += f"_contrast-{name}"
+        if 'fs' in space:
+            f_out = op.join(sub_out, f_base + '_beta.npy')
+            np.save(f_out, effects[i])
+            np.save(f_out.replace('beta', 'varbeta'), variances[i])
+        else:
+            f_out = op.join(sub_out, f_base + '_beta.nii.gz')
+            unmask(effects[i], mask, affine).to_filename(f_out)
+            unmask(variances[i], mask, affine).to_filename(f_out.replace('beta', 'varbeta'))
+
+
+def get_mask(funcs):
+    """ Returns the intersection of the brain masks of (volumetric) runs. """
+    masks = [load_mask(func.replace('preproc_bold', 'brain_mask')) for func in funcs]
+    mask, affine = masks[0][0], masks[0][1]
+    for m, _ in masks[1:]:
+        mask = mask & m
+
+    return mask, affine
+
+
+def fit_firstlevel(bids_dir, funcs, task, space, out_dir, cache_dir=None):
+    """ Fits the first-level model of all runs (funcs) of a single subject.
+    For volumetric data, the runs are analyzed within the intersection of
+    their brain masks (and read through the masked-data cache, if cache_dir
+    is given). """
+    mask, affine = (None, None) if 'fs' in space else get_mask(funcs)
+    for func in funcs:
+        if 'fs' in space:
+            func_vol = func.split('space')[0] + 'space-MNI152NLin2009cAsym_desc-preproc_bold.nii.gz'
+            hdr = read_header(func_vol)
+            Y = np.vstack([arr.data for arr in nib.load(func).darrays]).astype(np.float32)
+        else:
+            hdr = read_header(func)
+            Y = load_masked(func, func.replace('preproc_bold', 'brain_mask'), cache_dir, mask=mask)
+
+        res = fit_run(bids_dir, func, task, Y, hdr)
+        del Y
+        if res is not None:
+            save_run(func, out_dir, space, *res, mask=mask, affine=affine)
 
 
 @click.command()
@@ -126,7 +177,8 @@ def fit_firstlevel(bids_dir, func, task, space, out_dir):
 @click.option('--space', default='MNI152NLin2009cAsym')
 @click.option('--smoothing', default=None, type=click.FLOAT)
 @click.option('--n_jobs', default=1, type=int)
-def main(bids_dir, out_dir, level, task, space, smoothing, n_jobs):
+@click.option('--cache_dir', default=None, help="Masked-data cache directory (optional)")
+def main(bids_dir, out_dir, level, task, space, smoothing, n_jobs, cache_dir):
     """ BIDS-app format. """
 
     if out_dir is None:
@@ -135,13 +187,19 @@ def main(bids_dir, out_dir, level, task, space, smoothing, n_jobs):
     if level == 'participant':
         ext = 'func.gii' if 'fs' in space else 'desc-preproc_bold.nii.gz'
         fprep_dir = op.join(bids_dir, 'derivatives', 'fmriprep')
-        funcs = sorted(glob(op.join(
+        funcs = index_glob(load_index(bids_dir), op.join(
             fprep_dir, 'sub-*', 'func', f'*task-{task}_*_space-{space}*{ext}'
-        )))
+        ))
         print(op.join(
             fprep_dir, 'sub-*', 'func', f'*task-{task}_*_space-{space}*{ext}'
         ))
-        _ = Parallel(n_jobs=n_jobs)(delayed(fit_firstlevel)(bids_dir, f, task, space, out_dir) for f in tqdm(funcs))
+        sub_funcs = {}
+        for f in funcs:
+            sub_funcs.setdefault(op.basename(f).split('_')[0], []).append(f)
+
+        _ = Parallel(n_jobs=n_jobs)(
+            delayed(fit_firstlevel)(bids_dir, f, task, space, out_dir, cache_dir) for f in tqdm(sub_funcs.values())
+        )
     else:
         for cname in TASK_INFO[task]['name']:
             ext = 'npy' if 'fs' in space else 'nii.gz'
@@ -153,25 +211,22 @@ def main(bids_dir, out_dir, level, task, space, smoothing, n_jobs):
                     continue
 
                 dm = pd.DataFrame(np.ones(len(betas)), columns=['intercept'])
-                if 'fs' not in space:
-                    if smoothing is not None:
-                        betas = [image.smooth_img(b, smoothing) for b in betas]
-                    mean_img = image.mean_img(betas)
-                    mask = (mean_img.get_fdata() != 0).astype(int)
-                    mask = nib.Nifti1Image(mask, affine=mean_img.affine)
-                    Y = masking.apply_mask(betas, mask)
-                else:
-                    Y = np.vstack([np.load(b) for b in betas])
+                f_tmp = op.join(out_dir, f'.task-{task}_contrast-{cname}{s}_betas.npy')
+                try:
+                    mask, shape, affine = stream_betas(betas, f_tmp, smoothing=None if 'fs' in space else smoothing)
+                    z = fit_group(f_tmp, mask, dm.values, [1], con_type='t', n_jobs=n_jobs)
+                finally:  # the stacked betas can be large
+                    if op.isfile(f_tmp):
+                        os.remove(f_tmp)
 
-                labels, results = run_glm(Y, dm.values, noise_model='ols', n_jobs=n_jobs)
-                group_result = compute_contrast(labels, results, [1], contrast_type='t')
                 if 'fs' in space:
                     f_out = op.join(out_dir, f'task-{task}_contrast-{cname}{s}_desc-grouplevel_zscore.npy')
-                    np.save(f_out, group_result.z_score())
+                    np.save(f_out, z)
                 else:
                     f_out = op.join(out_dir, f'task-{task}_contrast-{cname}_desc-grouplevel_zscore.nii.gz')
-                    to_save = masking.unmask(group_result.z_score(), mask)
-                    to_save.to_filename(f_out)
+                    mask = mask.reshape(shape)
+                    unmask(z.reshape(shape)[mask], mask, affine).to_filename(f_out)
+
 
 if __name__ == '__main__':
     main()
@@ -1,53 +1,47 @@
 import os.path as op
 import pandas as pd
 import numpy as np
-import nibabel as nib
-from glob import glob
-from tqdm import tqdm
+from bids_index import load_index, index_glob
+from nifti_header import scan_headers
+from columnar import check_parquet, write_parquet
 
 
-def summarize_data_specs(data_dir, out_dir=None):
+def summarize_data_specs(data_dir, out_dir=None, n_jobs=1, parquet=False, cache_file=None):
 
     if out_dir is None:
         out_dir = data_dir
 
-    files = sorted(glob(op.join(data_dir, 'sub-*', '*', '*.nii.gz')))
+    if parquet:
+        check_parquet()
+
+    index = load_index(data_dir)
+    files = index_glob(index, op.join(data_dir, 'sub-*', '*', '*.nii.gz'))
 
     if not files:
-        files = sorted(glob(op.join(data_dir, 'sub-*', '*', 'ses-*', '*.nii.gz')))
+        files = index_glob(index, op.join(data_dir, 'sub-*', '*', 'ses-*', '*.nii.gz'))
    
     files = [f for f in files if 'bold.' in f or 'T1w.' in f or 'dwi.' in f or 'phasediff' in f]
 
-    n = len(files)
+    specs = scan_headers(files, n_jobs=n_jobs, cache_file=cache_file)
+
+    dim = np.array([s['dim'] for s in specs], dtype=float).reshape(-1, 8)
+    pixdim = np.array([s['pixdim'] for s in specs], dtype=float).reshape(-1, 8)
+    is_4d = dim[:, 0] == 4
     df = dict(
-        x_dim=np.zeros(n),
-        y_dim=np.zeros(n),
-        z_dim=np.zeros(n),
-        dyns=np.zeros(n),
-        x_pixdim=np.zeros(n),
-        y_pixdim=np.zeros(n),
-        z_pixdim=np.zeros(n),
-        TR=np.zeros(n)
+        x_dim=dim[:, 1],
+        y_dim=dim[:, 2],
+        z_dim=dim[:, 3],
+        dyns=np.where(is_4d, dim[:, 4], np.nan),
+        x_pixdim=pixdim[:, 1],
+        y_pixdim=pixdim[:, 2],
+        z_pixdim=pixdim[:, 3],
+        TR=np.where(is_4d, pixdim[:, 4], np.nan),
+        voxel_dtype=[s['datatype'] for s in specs],
+        qform_code=[s['qform_code'] for s in specs],
+        sform_code=[s['sform_code'] for s in specs],
+        file_size=[s['file_size'] for s in specs]
     )
 
-    for i, f in enumerate(tqdm(files)):
-        img = nib.load(f)
-        hdr = img.header
-        df['x_dim'][i] = hdr['dim'][1]
-        df['y_dim'][i] = hdr['dim'][2]
-        df['z_dim'][i] = hdr['dim'][3]
-        
-        if len(img.shape) == 4:
-            df['dyns'][i] = hdr['dim'][4]
-            df['TR'][i] = hdr['pixdim'][4]
-        else:
-            df['dyns'][i] = np.nan
-            df['TR'][i] = np.nan
-
-        df['x_pixdim'][i] = hdr['pixdim'][1]
-        df['y_pixdim'][i] = hdr['pixdim'][2]
-        df['z_pixdim'][i] = hdr['pixdim'][3]
-    
     df['files'] = [op.basename(f) for f in files]
     df['participant_label'] = [op.basename(f).split('_')[0] for f in files]
     df['data_type'] = [op.basename(op.dirname(f)) for f in files]
@@ -60,11 +54,16 @@ def summarize_data_specs(data_dir, out_dir=None):
     df = df.sort_values(by=['data_type', 'file_type', 'taskname', 'space', 'participant_label']).set_index('files')
     
     df.to_csv(op.join(out_dir, 'scans.tsv'), sep='\t', index=True)
+    if parquet:
+        write_parquet(df, op.join(out_dir, 'scans.parquet'), index=True)
 
 
 if __name__ == '__main__':
     import argparse
     parser = argparse.ArgumentParser(description='Summarize data specs')
     parser.add_argument('dir', type=str, help='Input')
+    parser.add_argument('--n_jobs', type=int, default=1, help='Number of threads')
+    parser.add_argument('--parquet', action='store_true', help='Also write scans.parquet (requires pyarrow)')
+    parser.add_argument('--cache_file', type=str, default=None, help='File to cache the headers in (optional)')
     args = parser.parse_args()
-    summarize_data_specs(args.dir)
+    summarize_data_specs(args.dir, n_jobs=args.n_jobs, parquet=args.parquet, cache_file=args.cache_file)
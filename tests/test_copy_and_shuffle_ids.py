@@ -0,0 +1,179 @@
+""" Tests for copy_and_shuffle_ids.py, which is run as a script (like in
+practice) on a small fake dataset. """
+import os
+import json
+import sys
+import sqlite3
+import subprocess
+import os.path as op
+import pandas as pd
+import pytest
+
+SCRIPT = op.join(op.dirname(op.abspath(__file__)), '..', 'copy_and_shuffle_ids.py')
+SUBS = ['sub-0101', 'sub-0202', 'sub-0303']
+SKIP = ['mriqc', 'physiology', 'freesurfer', 'dwipreproc', 'vbm']
+
+
+def _write(f, contents):
+    os.makedirs(op.dirname(f), exist_ok=True)
+    with open(f, 'w') as f_out:
+        f_out.write(contents)
+
+
+@pytest.fixture
+def dataset(tmp_path, monkeypatch):
+    """ Creates a minimal dataset (<tmp>/proj/bids) and seed file. """
+    monkeypatch.setenv('XDG_CACHE_HOME', op.join(str(tmp_path), 'cache'))
+    bids_dir = op.join(str(tmp_path), 'proj', 'bids')
+    fmriprep_dir = op.join(bids_dir, 'derivatives', 'fmriprep')
+    _write(op.join(bids_dir, 'participants.tsv'),
+           'participant_id\tage\n' + ''.join(f'{sub}\t{i}\n' for i, sub in enumerate(SUBS)))
+    _write(op.join(bids_dir, 'dataset_description.json'), '{"Name": "test"}')
+    for sub in SUBS:
+        _write(op.join(bids_dir, sub, 'anat', f'{sub}_T1w.json'), f'{{"id": "{sub}"}}')
+        _write(op.join(fmriprep_dir, sub, 'anat', f'{sub}_desc-preproc_T1w.json'), f'"{sub}"')
+        _write(op.join(fmriprep_dir, f'{sub}.html'), f'<p>Subject ID: {sub[4:]}</p> {sub}')
+        _write(op.join(fmriprep_dir, 'logs', f'{sub}_crash.txt'), f'crash of {sub} subject_{sub[4:]}')
+
+    seed_file = op.join(str(tmp_path), 'seeds.yml')
+    _write(seed_file, 'proj: 42\n')
+    return bids_dir, op.join(str(tmp_path), 'proj', 'anon'), seed_file
+
+
+def _run(bids_dir, out_dir, seed_file, n_jobs=1):
+    cmd = [sys.executable, SCRIPT, 'run', bids_dir, out_dir, seed_file] + SKIP + ['--n_jobs', str(n_jobs)]
+    return subprocess.run(cmd, capture_output=True, text=True)
+
+
+def _read_key(bids_dir):
+    key_file = op.join(op.dirname(bids_dir), 'shuffle-key.tsv')
+    return pd.read_csv(key_file, sep='\t', index_col=0)['new_id'].to_dict()
+
+
+def test_files_outside_subject_dirs(dataset):
+    """ Reports and logs at the top level of a derivatives directory are
+    renamed and anonymized based on their file names. """
+    bids_dir, out_dir, seed_file = dataset
+    res = _run(bids_dir, out_dir, seed_file)
+    assert res.returncode == 0, res.stderr
+
+    fmriprep_dir = op.join(out_dir, 'derivatives', 'fmriprep')
+    for old_id, new_id in _read_key(bids_dir).items():
+        with open(op.join(fmriprep_dir, f'{new_id}.html')) as f_in:
+            assert f_in.read() == f'<p>Subject ID: {new_id[4:]}</p> {new_id}'
+
+        with open(op.join(fmriprep_dir, 'logs', f'{new_id}_crash.txt')) as f_in:
+            assert f_in.read() == f'crash of {new_id} subject_{new_id[4:]}'
+
+
+def test_existing_key_is_not_overwritten(dataset):
+    """ A run with a different mapping fails before writing anything. """
+    bids_dir, out_dir, seed_file = dataset
+    key_file = op.join(op.dirname(bids_dir), 'shuffle-key.tsv')
+    with open(key_file, 'w') as f_out:
+        f_out.write('old_id\tnew_id\nsub-0101\tsub-0003\nsub-0202\tsub-0001\nsub-0303\tsub-0002\n')
+
+    with open(key_file, 'r') as f_in:
+        key = f_in.read()
+
+    res = _run(bids_dir, out_dir, seed_file)
+    assert res.returncode != 0
+    assert 'different ID mapping' in res.stderr
+    with open(key_file, 'r') as f_in:
+        assert f_in.read() == key
+
+    assert not op.exists(out_dir)
+    assert not op.exists(op.join(op.dirname(bids_dir), 'anon-journal.sqlite'))
+    assert not [f for f in os.listdir(bids_dir) if f.startswith('.')]
+
+
+def test_rerun_with_same_key(dataset):
+    """ A rerun with the same mapping (and existing key) succeeds. """
+    bids_dir, out_dir, seed_file = dataset
+    assert _run(bids_dir, out_dir, seed_file).returncode == 0
+    key = _read_key(bids_dir)
+    res = _run(bids_dir, out_dir, seed_file)
+    assert res.returncode == 0, res.stderr
+    assert _read_key(bids_dir) == key
+
+
+def test_parallel(dataset):
+    """ Runs with multiple processes give the same output as serial runs. """
+    bids_dir, out_dir, seed_file = dataset
+    res = _run(bids_dir, out_dir, seed_file, n_jobs=2)
+    assert res.returncode == 0, res.stderr
+
+    for old_id, new_id in _read_key(bids_dir).items():
+        with open(op.join(out_dir, new_id, 'anat', f'{new_id}_T1w.json')) as f_in:
+            assert f_in.read() == f'{{"id": "{new_id}"}}'
+
+        with open(op.join(out_dir, 'derivatives', 'fmriprep', 'logs', f'{new_id}_crash.txt')) as f_in:
+            assert f_in.read() == f'crash of {new_id} subject_{new_id[4:]}'
+
+
+def test_resume_from_journal(dataset):
+    """ After an interrupted run, unfinished units (not in the journal) are
+    redone from scratch and finished ones are skipped. """
+    bids_dir, out_dir, seed_file = dataset
+    assert _run(bids_dir, out_dir, seed_file).returncode == 0
+    key = _read_key(bids_dir)
+
+    # Simulate an interruption while copying the first subject
+    journal = op.join(op.dirname(bids_dir), 'anon-journal.sqlite')
+    conn = sqlite3.connect(journal)
+    with conn:
+        conn.execute("DELETE FROM units WHERE unit = ?", (SUBS[0],))
+    conn.close()
+
+    new_id = key[SUBS[0]]
+    partial = op.join(out_dir, new_id, 'anat', f'{new_id}_T1w.json')
+    with open(partial, 'w') as f_out:
+        f_out.write('{"id": "sub-')
+    _write(op.join(out_dir, new_id, 'anat', 'stray.txt'), '')
+
+    finished = op.join(out_dir, key[SUBS[1]], 'anat', f'{key[SUBS[1]]}_T1w.json')
+    mtime = os.stat(finished).st_mtime_ns
+
+    res = _run(bids_dir, out_dir, seed_file)
+    assert res.returncode == 0, res.stderr
+    with open(partial) as f_in:
+        assert f_in.read() == f'{{"id": "{new_id}"}}'
+
+    assert not op.exists(op.join(out_dir, new_id, 'anat', 'stray.txt'))
+    assert os.stat(finished).st_mtime_ns == mtime
+
+
+def _verify(out_dir, key_file):
+    cmd = [sys.executable, SCRIPT, 'verify', out_dir, key_file, '--n_jobs', '-1']
+    res = subprocess.run(cmd, capture_output=True, text=True)
+    with open(op.join(op.dirname(key_file), 'leak-report.json')) as f_in:
+        return res, json.load(f_in)
+
+
+def test_verify_finds_leaks(tmp_path):
+    """ Planted old IDs are reported by verify; old IDs that are also new IDs
+    are reported as ambiguous outside subject files. """
+    key_file = op.join(str(tmp_path), 'shuffle-key.tsv')
+    _write(key_file, 'old_id\tnew_id\nsub-0001\tsub-0002\nsub-0002\tsub-0001\nsub-0101\tsub-0003\n')
+    out_dir = op.join(str(tmp_path), 'anon')
+    _write(op.join(out_dir, 'sub-0003', 'anat', 'sub-0003_T1w.json'), '{"id": "sub-0003"}')
+    _write(op.join(out_dir, 'sub-0001', 'anat', 'sub-0001_T1w.json'), '{"id": "sub-0001"}')
+    _write(op.join(out_dir, 'sub-0002', 'anat', 'sub-0002_T1w.json'), '{"id": "sub-0002"}')
+
+    res, report = _verify(out_dir, key_file)
+    assert res.returncode == 0, res.stderr
+    assert report['n_leaks'] == 0 and report['n_ambiguous'] == 0
+    assert report['n_overlapping_ids'] == 2
+
+    _write(op.join(out_dir, 'sub-0003', 'anat', 'sub-0003_T1w.json'), '{"id": "sub-0101"}')
+    _write(op.join(out_dir, 'sub-0002', 'anat', 'sub-0002_T1w.json'), '{"id": "sub-0002", "x": "subject_0101"}')
+    _write(op.join(out_dir, 'README'), 'Subject ID: 0101, sub-0001')
+    res, report = _verify(out_dir, key_file)
+    assert res.returncode == 1
+    leaks = {(leak['file'], leak['id'], leak['reason']) for leak in report['leaks']}
+    assert leaks == {
+        (op.join('sub-0003', 'anat', 'sub-0003_T1w.json'), 'sub-0101', 'old ID of this subject'),
+        (op.join('sub-0002', 'anat', 'sub-0002_T1w.json'), 'sub-0101', 'ID of another subject'),
+        ('README', 'sub-0101', 'old ID')
+    }
+    assert [(leak['file'], leak['id']) for leak in report['ambiguous']] == [('README', 'sub-0001')]
@@ -0,0 +1,98 @@
+""" Tests for the streaming ID substitution and file transfer helpers
+(misc_qc/id_substitution.py). """
+import io
+import os
+import sys
+import os.path as op
+import pytest
+
+sys.path.insert(0, op.join(op.dirname(op.abspath(__file__)), '..', 'misc_qc'))
+import id_substitution
+from id_substitution import IDSubstitutor
+
+TEXT = (
+    b'{"subject_id": "0101"}\n'
+    b'/work/subject_0101/anat sub-0101_T1w.nii.gz\n'
+    b'<p>Subject ID: 0101</p> --participant-label 0101\n'
+    b'sub-0102 is not sub-0101\n'
+)
+
+
+@pytest.mark.parametrize('chunk_size', list(range(1, 51)) + [len(TEXT)])
+def test_stream_across_chunks(chunk_size, monkeypatch):
+    """ IDs split across chunk boundaries are replaced like with sub(). """
+    monkeypatch.setattr(id_substitution, 'CHUNK_SIZE', chunk_size)
+    substitutor = IDSubstitutor('sub-0101', 'sub-0003')
+    f_out = io.BytesIO()
+    substitutor.stream(io.BytesIO(TEXT), f_out)
+    assert f_out.getvalue() == substitutor.sub(TEXT)
+    assert b'0101' not in f_out.getvalue()
+    assert f_out.getvalue().count(b'0003') == TEXT.count(b'0101')
+
+
+def test_stream_binary(monkeypatch):
+    """ Binary data (with a null byte in the first chunk) is copied as is. """
+    monkeypatch.setattr(id_substitution, 'CHUNK_SIZE', 16)
+    data = b'\0' + TEXT
+    f_out = io.BytesIO()
+    IDSubstitutor('sub-0101', 'sub-0003').stream(io.BytesIO(data), f_out)
+    assert f_out.getvalue() == data
+
+
+def test_sub_without_id():
+    """ Data without the ID is returned as is (same object). """
+    data = b'nothing to see here'
+    assert IDSubstitutor('sub-0101', 'sub-0003').sub(data) is data
+
+
+@pytest.mark.parametrize('transfer', id_substitution.TRANSFER_MODES)
+def test_transfer_file(tmp_path, transfer):
+    """ Each transfer mode gives an identical file (hardlinks share the inode). """
+    src, dst = op.join(str(tmp_path), 'src.txt'), op.join(str(tmp_path), 'dst.txt')
+    with open(src, 'wb') as f_out:
+        f_out.write(TEXT * 1000)
+
+    id_substitution.transfer_file(src, dst, transfer)
+    with open(dst, 'rb') as f_in:
+        assert f_in.read() == TEXT * 1000
+
+    if transfer == 'hardlink':
+        assert os.stat(src).st_ino == os.stat(dst).st_ino
+    else:
+        assert os.stat(dst).st_mode & 0o777 == 0o644
+
+
+@pytest.mark.parametrize('transfer', id_substitution.TRANSFER_MODES)
+def test_transfer_file_fallback(tmp_path, transfer, monkeypatch):
+    """ If linking, cloning and in-kernel copying are not supported, files
+    are copied in user space. """
+    def _fail(*args, **kwargs):
+        raise OSError("not supported")
+
+    monkeypatch.setattr(os, 'link', _fail)
+    monkeypatch.setattr(os, 'copy_file_range', _fail, raising=False)
+    monkeypatch.setattr(id_substitution.fcntl, 'ioctl', _fail)
+    src, dst = op.join(str(tmp_path), 'src.txt'), op.join(str(tmp_path), 'dst.txt')
+    with open(src, 'wb') as f_out:
+        f_out.write(TEXT * 1000)
+
+    id_substitution.transfer_file(src, dst, transfer)
+    with open(dst, 'rb') as f_in:
+        assert f_in.read() == TEXT * 1000
+
+    assert os.stat(src).st_ino != os.stat(dst).st_ino
+
+
+def test_stream_file_links_small_files_without_ids(tmp_path):
+    """ Small files without IDs are hardlinked; files with IDs are rewritten. """
+    substitutor = IDSubstitutor('sub-0101', 'sub-0003')
+    for name, data in (('no_id.txt', b'nothing here'), ('id.txt', TEXT)):
+        src, dst = op.join(str(tmp_path), name), op.join(str(tmp_path), 'out_' + name)
+        with open(src, 'wb') as f_out:
+            f_out.write(data)
+
+        id_substitution.stream_file(src, dst, substitutor, transfer='hardlink')
+        with open(dst, 'rb') as f_in:
+            assert f_in.read() == substitutor.sub(data)
+
+        assert (os.stat(src).st_ino == os.stat(dst).st_ino) == (data is not TEXT)